@@ -1,25 +1,68 @@
-from flask import Flask, render_template, request, session, redirect, url_for, flash
+from flask import Flask, render_template, request, session, redirect, url_for, flash, g, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-import os, re, time, csv, sqlite3, threading
+import os, time, sqlite3, threading
 import sys
 import signal
-import spidev
+import logging
+from log_config import setup_logging
+from hardware import spidev  # Simulated when DISPENSER_HARDWARE=sim
 
 # Import RPi servo controller
 from rpi_servo import get_servo_controller, cleanup_servo_controller
-from weblookup import get_directions_and_speak
+from tray_registry import load_registry
+from weblookup import get_directions_and_speak, get_directions, speak_directions, warm_label_cache, prerender_tray_audio
+from dispense_pipeline import DispensePipeline, DispenseJob
+from dispense_executor import DispenseExecutor
+from dispense_metrics import DispenseMetrics
+import metrics
+import weblookup
+from scheduler import DispenseScheduler, SystemClock
+from db import Database
+from migrations import migrate
+from medicine_search import MedicineSearch, PER_PAGE
+from medicine_import import import_upload
+from tray_state import TrayStateCache
+from tray_events import TrayEventBroadcaster
+from missed_doses import plan_catch_up, record_missed, MISSED_DOSE_POLICY
+from recurrence import compile_schedule, format_time, load_rule, parse_time
+from dispense_journal import DispenseJournal, SKIPPED
+from inventory import claim_refill_alert, forecast_trays, parse_capacity, take_dose
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'fallback_secret_key')
 
+setup_logging()  # JSON lines to LOG_FILE through a background thread
+log = logging.getLogger(__name__)
+
 DATABASE = 'users.db'
 
-servo_controller = get_servo_controller()  # Create a single instance
+REQUEST_SECONDS = metrics.histogram('dispenser_http_request_seconds', 'Flask request latency by route',
+                                    ['route', 'method', 'status'])
+PASSWORD_CHECKS = metrics.counter('dispenser_password_checks_total', 'Password verifications by hash method and result',
+                                  ['method', 'result'])
+
+db = Database(DATABASE)  # Pooled connections shared by every manager
+medicine_search = MedicineSearch(db)
+
+tray_registry = load_registry()  # Pins, angles and capacity of every tray on this unit
+servo_controller = get_servo_controller(tray_registry)  # Create a single instance
+
+def tray_capacities():
+    return {tray.number: tray.capacity for tray in tray_registry}
+
+tray_state = TrayStateCache(db, tray_capacities)  # Status rows shown on every page
+tray_events = TrayEventBroadcaster(tray_state)  # Pushes tray changes and dispenses to open pages
+dispense_journal = DispenseJournal(db)  # Every scheduled dose from intent to announcement, survives power loss
+
+def trays_changed():
+    """Tray rows were added, removed or rescheduled"""
+    tray_state.invalidate()
+    dispense_scheduler.notify_changed()
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully"""
-    print(f"\nReceived signal {signum}. Shutting down gracefully...")
+    log.info("Received signal %s. Shutting down gracefully...", signum)
     cleanup_servo_controller(servo_controller)
     sys.exit(0)
 
@@ -28,153 +71,66 @@ class DatabaseManager:
     
     @staticmethod
     def init_db():
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-
-        # Create users table if it doesn't exist
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL,
-            is_admin BOOLEAN DEFAULT 0
-        )
-        ''')
-
-        # Create tray_settings table with the new schema
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tray_settings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            user_id INTEGER NOT NULL,
-            tray_number INTEGER NOT NULL,
-            description TEXT NOT NULL,
-            alert BOOLEAN,
-            dispense_time DATETIME,
-            interval TEXT,
-            color TEXT,
-            dispense_count INTEGER DEFAULT 0,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-        ''')
-
-        # Add name column to tray_settings if it doesn't exist
-        try:
-            cursor.execute('ALTER TABLE tray_settings ADD COLUMN name TEXT')
-            print("Added name column to tray_settings table")
-        except sqlite3.OperationalError:
-            # Column already exists, ignore error
-            pass
-
-        # Add is_admin column to users if it doesn't exist
-        try:
-            cursor.execute('ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT 0')
-            print("Added is_admin column to users table")
-        except sqlite3.OperationalError:
-            # Column already exists, ignore error
-            pass
-
-        # Safely add dispense_count column if it doesn't exist
-        try:
-            cursor.execute('ALTER TABLE tray_settings ADD COLUMN dispense_count INTEGER DEFAULT 0')
-            print("Added dispense_count column to tray_settings table")
-        except sqlite3.OperationalError:
-            # Column already exists, ignore error
-            pass
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS medicine (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            generic_name TEXT,
-            brand_name TEXT,
-            dosage_strength TEXT,
-            dosage_form TEXT,
-            classification TEXT,
-            pharmacologic_category TEXT,
-            manufacturer TEXT
-        )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS dispense_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            username TEXT,
-            tray_number INTEGER,
-            medicine_description TEXT,
-            dispense_time TEXT
-        )
-        ''')
-
-        # Create admin account if it doesn't exist
-        admin_username = 'admin'
-        cursor.execute('SELECT * FROM users WHERE username = ?', (admin_username,))
-        admin_exists = cursor.fetchone()
+        with db.transaction() as cursor:
+            # Create or upgrade tables and indexes
+            migrate(cursor)
+
+            # Create admin account if it doesn't exist
+            admin_username = 'admin'
+            cursor.execute('SELECT * FROM users WHERE username = ?', (admin_username,))
+            admin_exists = cursor.fetchone()
         
-        if not admin_exists:
-            try:
-                admin_password = generate_password_hash('admin123', method='sha256')  # Use sha256 for compatibility
-                cursor.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)', 
-                              (admin_username, admin_password, 1))
-                print("Created admin account with username: admin, password: admin123")
-            except Exception as e:
-                print(f"Error creating admin account: {e}")
-                # Fallback to simple hash if needed
-                import hashlib
-                admin_password = hashlib.sha256('admin123'.encode()).hexdigest()
-                cursor.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)', 
-                              (admin_username, admin_password, 1))
-                print("Created admin account with fallback hashing")
-
-        conn.commit()
-        conn.close()
+            if not admin_exists:
+                try:
+                    admin_password = generate_password_hash('admin123', method='sha256')  # Use sha256 for compatibility
+                    cursor.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)', 
+                                  (admin_username, admin_password, 1))
+                    log.info("Created admin account with username: admin, password: admin123")
+                except Exception as e:
+                    log.error("Error creating admin account: %s", e)
+                    # Fallback to simple hash if needed
+                    import hashlib
+                    admin_password = hashlib.sha256('admin123'.encode()).hexdigest()
+                    cursor.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)', 
+                                  (admin_username, admin_password, 1))
+                    log.info("Created admin account with fallback hashing")
 
     @staticmethod
     def query_db(query, args=(), one=False):
-        conn = sqlite3.connect(DATABASE)
-        conn.execute('PRAGMA foreign_keys = ON')
-        cursor = conn.cursor()
-        cursor.execute(query, args)
-        rv = cursor.fetchall()
-        conn.commit()
-        conn.close()
-        return (rv[0] if rv else None) if one else rv
+        return db.query(query, args, one)
 
     @staticmethod
     def migrate_passwords():
         """Migrate existing passwords to compatible format if needed"""
         try:
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('SELECT id, password FROM users')
-            users = cursor.fetchall()
-            
-            for user_id, password in users:
-                # Check if password is already in simple hash format
-                if len(password) == 64 and all(c in '0123456789abcdef' for c in password.lower()):
-                    # Already in SHA256 format, skip
-                    continue
+            with db.transaction() as cursor:
+                cursor.execute('SELECT id, password FROM users')
+                users = cursor.fetchall()
                 
-                # Try to verify with werkzeug to see if it's a valid hash
-                try:
-                    # Test with a dummy password to see if the hash format is valid
-                    check_password_hash(password, 'dummy')
-                    # If no exception, the hash format is valid, skip migration
-                    continue
-                except Exception:
-                    # Hash format is not compatible, migrate to simple SHA256
-                    print(f"Migrating password for user ID {user_id}")
-                    # We can't recover the original password, so we'll set a default
-                    # In a real scenario, you'd want to force password reset
-                    import hashlib
-                    new_password = hashlib.sha256('changeme123'.encode()).hexdigest()
-                    cursor.execute('UPDATE users SET password = ? WHERE id = ?', (new_password, user_id))
+                for user_id, password in users:
+                    # Check if password is already in simple hash format
+                    if len(password) == 64 and all(c in '0123456789abcdef' for c in password.lower()):
+                        # Already in SHA256 format, skip
+                        continue
+                    
+                    # Try to verify with werkzeug to see if it's a valid hash
+                    try:
+                        # Test with a dummy password to see if the hash format is valid
+                        check_password_hash(password, 'dummy')
+                        # If no exception, the hash format is valid, skip migration
+                        continue
+                    except Exception:
+                        # Hash format is not compatible, migrate to simple SHA256
+                        log.info("Migrating password for user ID %s", user_id, extra={'user_id': user_id})
+                        # We can't recover the original password, so we'll set a default
+                        # In a real scenario, you'd want to force password reset
+                        import hashlib
+                        new_password = hashlib.sha256('changeme123'.encode()).hexdigest()
+                        cursor.execute('UPDATE users SET password = ? WHERE id = ?', (new_password, user_id))
             
-            conn.commit()
-            conn.close()
-            print("Password migration completed")
+            log.info("Password migration completed")
         except Exception as e:
-            print(f"Error during password migration: {e}")
+            log.error("Error during password migration: %s", e)
 
 class AuthenticationManager:
     """Handles user authentication, registration, and password verification"""
@@ -182,26 +138,24 @@ class AuthenticationManager:
     @staticmethod
     def verify_password(stored_password, provided_password):
         """Verify password with fallback support for different hashing methods"""
-        print(f"Verifying password for stored hash: {stored_password[:20]}...")
-        
         # First, try simple SHA256 hash comparison (since we know our passwords are stored this way)
         try:
             import hashlib
             hashed_provided = hashlib.sha256(provided_password.encode()).hexdigest()
             result = stored_password == hashed_provided
-            print(f"SHA256 verification result: {result}")
+            PASSWORD_CHECKS.inc('sha256', result)
             if result:
                 return True
         except Exception as e:
-            print(f"Error with SHA256 password check: {e}")
+            log.error("Error with SHA256 password check: %s", e)
         
         # Fallback to werkzeug's check_password_hash for legacy passwords
         try:
             result = check_password_hash(stored_password, provided_password)
-            print(f"Werkzeug verification result: {result}")
+            PASSWORD_CHECKS.inc('werkzeug', result)
             return result
         except Exception as e:
-            print(f"Error with werkzeug password check: {e}")
+            log.error("Error with werkzeug password check: %s", e)
             return False
 
     @staticmethod
@@ -212,7 +166,7 @@ class AuthenticationManager:
             DatabaseManager.query_db('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password))
             return True, "Registration successful! Please log in."
         except Exception as e:
-            print(f"Error hashing password: {e}")
+            log.error("Error hashing password: %s", e)
             # Fallback to simple hash if needed
             import hashlib
             hashed_password = hashlib.sha256(password.encode()).hexdigest()
@@ -232,127 +186,74 @@ class TrayManager:
     
     @staticmethod
     def get_tray_status_and_countdown():
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT ts.tray_number, ts.description, ts.dispense_time, ts.dispense_count, 
-                   ts.name, u.username 
-            FROM tray_settings ts 
-            LEFT JOIN users u ON ts.user_id = u.id
-        ''')
-        trays = cursor.fetchall()
-        conn.close()
-        status = []
-        now = datetime.now()
-        for tray in trays:
-            tray_number, description, dispense_time, dispense_count, name, username = tray
-            # Use name if available, otherwise fall back to username
-            display_name = name if name else username if username else "Unknown"
-            
-            if dispense_time:
-                try:
-                    dt = datetime.strptime(dispense_time, "%Y-%m-%dT%H:%M")
-                    countdown = int((dt - now).total_seconds())
-                    countdown = countdown if countdown > 0 else 0
-                    next_dispense = dt.strftime("%B %d, %Y, %I:%M %p")
-                except Exception:
-                    countdown = None
-                    next_dispense = dispense_time
-            else:
-                countdown = None
-                next_dispense = "N/A"
-            status.append({
-                'tray_number': tray_number,
-                'description': description,
-                'next_dispense': next_dispense,
-                'countdown': countdown,
-                'dispense_count': dispense_count,
-                'username': display_name
-            })
-        return status
+        """Served from the in-memory snapshot, countdowns computed from cached deadlines"""
+        return tray_state.snapshot()
 
     @staticmethod
-    def insert_tray_settings(user_id, tray_number, description, dispense_time, interval, color, name=None):
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Get username if name is not provided
-        if not name:
-            cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-            user_result = cursor.fetchone()
-            name = user_result[0] if user_result else "Unknown"
-        
-        cursor.execute('''
-        INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, color, name)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, tray_number, description, dispense_time, interval, color, name))
-        
-        conn.commit()
-        conn.close()
+    def insert_tray_settings(user_id, tray_number, description, dispense_time, interval, color, name=None, capacity=None):
+        """Raises ValueError if the schedule cannot be parsed"""
+        schedule, dispense_time = compile_schedule(interval, dispense_time)
+        with db.transaction() as cursor:
+            # Get username if name is not provided
+            if not name:
+                cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+                user_result = cursor.fetchone()
+                name = user_result[0] if user_result else "Unknown"
+            
+            cursor.execute('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, schedule, capacity, color, name)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, tray_number, description, dispense_time, interval, schedule, capacity, color, name))
+        trays_changed()
 
     @staticmethod
     def reset_tray(user_id, tray_number, is_admin=False):
         """Reset a tray (delete its settings)"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
-        existing = cursor.fetchone()
-        
-        if not existing:
-            conn.close()
-            return False, "Tray does not exist or is already reset."
-        
-        existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
-        
-        if existing_user_id != user_id and not is_admin:
-            conn.close()
-            return False, "You cannot reset a tray assigned to another user."
-        
-        cursor.execute('DELETE FROM tray_settings WHERE tray_number = ?', (tray_number,))
-        conn.commit()
-        conn.close()
+        with db.transaction() as cursor:
+            cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
+            existing = cursor.fetchone()
+            
+            if not existing:
+                return False, "Tray does not exist or is already reset."
+            
+            existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
+            
+            if existing_user_id != user_id and not is_admin:
+                return False, "You cannot reset a tray assigned to another user."
+            
+            cursor.execute('DELETE FROM tray_settings WHERE tray_number = ?', (tray_number,))
+        trays_changed()
         return True, f"Tray {tray_number} has been reset."
 
     @staticmethod
     def reset_dispense_count(user_id, tray_number, is_admin=False):
         """Reset dispense count for a tray"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
-        existing = cursor.fetchone()
-        
-        if not existing:
-            conn.close()
-            return False, "Tray does not exist."
-        
-        existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
-        
-        if existing_user_id != user_id and not is_admin:
-            conn.close()
-            return False, "You cannot reset dispense count for a tray assigned to another user."
-        
-        cursor.execute('UPDATE tray_settings SET dispense_count = 0 WHERE tray_number = ?', (tray_number,))
-        conn.commit()
-        conn.close()
+        with db.transaction() as cursor:
+            cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
+            existing = cursor.fetchone()
+            
+            if not existing:
+                return False, "Tray does not exist."
+            
+            existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
+            
+            if existing_user_id != user_id and not is_admin:
+                return False, "You cannot reset dispense count for a tray assigned to another user."
+            
+            cursor.execute('UPDATE tray_settings SET dispense_count = 0, refill_alerted = 0 WHERE tray_number = ?', (tray_number,))
+        tray_state.update(tray_number, dispense_count=0)
         return True, f"Dispense count for Tray {tray_number} has been reset to 0."
 
 class MedicineManager:
     """Handles medicine-related operations"""
     
     @staticmethod
-    def search_medicines(search_input):
-        """Search for medicines in the database"""
+    def search_medicines(search_input, page=1):
+        """Search for medicines in the database, returns (medicines, message, total)"""
         if not search_input.strip():
-            return [], 'Please enter a valid search query.'
+            return [], 'Please enter a valid search query.', 0
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM medicine
-            WHERE LOWER(brand_name) LIKE ?
-        ''', (f'%{search_input.strip().lower()}%',))
-        results = cursor.fetchall()
-        conn.close()
+        results, total = medicine_search.search(search_input.strip(), page)
         
         medicines = [
             {
@@ -368,102 +269,109 @@ class MedicineManager:
         ]
         
         if not medicines:
-            return [], 'No results found. Try searching for another Medicine Brand Name.'
+            return [], 'No results found. Try searching for another Medicine Brand Name.', 0
         
-        return medicines, ''
+        return medicines, '', total
 
 class DispenseManager:
     """Handles medicine dispensing operations"""
     
     @staticmethod
-    def move_tray_1(medicine_name, tray_id):
-        print("Moving Tray 1")
-        # Check dispense count first
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT dispense_count FROM tray_settings WHERE id = ?', (tray_id,))
-        result = cursor.fetchone()
-        if result:
-            dispense_count = result[0]
-            if dispense_count >= 30:
-                print(f"All medicine has been dispensed from Tray 1. {medicine_name}. Please refill the tray.")
-                conn.close()
-                return False
-            
-            # Increment dispense count
-            cursor.execute('UPDATE tray_settings SET dispense_count = ? WHERE id = ?', (dispense_count + 1, tray_id))
-            conn.commit()
-            conn.close()
-            
-            # Use persistent servo controller to dispense
-            if servo_controller:
-                servo_controller.dispense_from_tray_1(medicine_name)
-            
-            print(f"Medicine dispensed from Tray 1. {medicine_name}.")
-            
-            # Get drug information and speak it after dispensing
-            try:
-                print("Fetching drug information and speaking it...")
-                # Extract just the brand name for drug lookup (remove dosage info)
-                brand_name = medicine_name.split()[0]  # Take first word as brand name
-                drug_info = get_directions_and_speak(brand_name, 1)
-                print(f"Drug information for {brand_name}: {drug_info}")
-            except Exception as e:
-                print(f"Error getting drug information: {e}")
-            
-            return True
-        conn.close()
-        return False
+    def dispense(tray_number, medicine_name, tray_id, due=None, journal_id=None):
+        """Queue a dose, the motion workers actuate it as soon as the tray and power budget allow"""
+        return dispense_pipeline.submit(DispenseJob(tray_id, tray_number, medicine_name, due, journal_id))
 
     @staticmethod
-    def move_tray_2(medicine_name, tray_id):
-        print("Moving Tray 2")
-        # Check dispense count first
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT dispense_count FROM tray_settings WHERE id = ?', (tray_id,))
-        result = cursor.fetchone()
-        if result:
-            dispense_count = result[0]
-            if dispense_count >= 30:
-                print(f"All medicine has been dispensed from Tray 2. {medicine_name}. Please refill the tray.")
-                conn.close()
-                return False
-            
-            # Increment dispense count
-            cursor.execute('UPDATE tray_settings SET dispense_count = ? WHERE id = ?', (dispense_count + 1, tray_id))
-            conn.commit()
-            conn.close()
-            
+    def actuate_tray(job):
+        """Motion stage: check the dispense count and run the servo, journaling each step"""
+        log.info("Moving Tray %s", job.tray_number, extra={'tray': job.tray_number})
+        if job.tray_number not in tray_registry:
+            log.warning("Tray %s is not configured on this dispenser.", job.tray_number, extra={'tray': job.tray_number})
+            with db.transaction() as cursor:
+                dispense_journal.settle(cursor, job.journal_id, SKIPPED, 'Tray not configured')
+            return False
+        capacity = tray_registry.capacity(job.tray_number)
+        # Other trays may move meanwhile, this one waits for its own previous dose
+        with dispense_executor.tray_lock(job.tray_number):
+            # Committed before the servo moves, so a restart never moves it again for this dose
+            with db.transaction() as cursor:
+                if not dispense_journal.begin_motion(cursor, job.journal_id):
+                    log.warning("Dose of %s from Tray %s due %s was already dispensed", job.medicine_name,
+                                job.tray_number, job.due, extra={'tray': job.tray_number})
+                    return False
+                if not take_dose(cursor, job.tray_id, capacity):
+                    log.warning("All medicine has been dispensed from Tray %s. %s. Please refill the tray.",
+                                job.tray_number, job.medicine_name, extra={'tray': job.tray_number})
+                    dispense_journal.settle(cursor, job.journal_id, SKIPPED, 'Tray empty or removed')
+                    return False
+
             # Use persistent servo controller to dispense
-            if servo_controller:
-                servo_controller.dispense_from_tray_2(medicine_name)
-            
-            print(f"Medicine dispensed from Tray 2. {medicine_name}.")
-            
-            # Get drug information and speak it after dispensing
             try:
-                print("Fetching drug information and speaking it...")
-                # Extract just the brand name for drug lookup (remove dosage info)
-                brand_name = medicine_name.split()[0]  # Take first word as brand name
-                drug_info = get_directions_and_speak(brand_name, 2)
-                print(f"Drug information for {brand_name}: {drug_info}")
+                # Power budget only for the motion, not the journal and inventory work around it
+                with dispense_executor.power(job):
+                    if servo_controller:
+                        servo_controller.dispense(job.tray_number, job.medicine_name)
             except Exception as e:
-                print(f"Error getting drug information: {e}")
-            
+                with db.transaction() as cursor:
+                    dispense_journal.interrupted(cursor, job.journal_id, f'Servo error: {e}')
+                tray_state.invalidate()
+                raise
+
+            # History row and journal state in one transaction
+            with db.transaction() as cursor:
+                dispense_count = dispense_journal.actuated(cursor, job.journal_id)
+            tray_state.update(job.tray_number, dispense_count=dispense_count)
+            DispenseManager.check_refill(job.tray_id)
+
+            log.info("Medicine dispensed from Tray %s. %s.", job.tray_number, job.medicine_name,
+                     extra={'tray': job.tray_number, 'medicine': job.medicine_name})
+            job.dispensed = True
             return True
-        conn.close()
-        return False
+
+    @staticmethod
+    def check_refill(tray_id):
+        """Alert the admin once a tray will run out within REFILL_ALERT_DAYS, again only after it is refilled"""
+        for forecast in forecast_trays(db, tray_capacities(), dispense_clock.now(), tray_id=tray_id):
+            if not forecast['refill_due']:
+                continue
+            with db.transaction() as cursor:
+                claimed = claim_refill_alert(cursor, tray_id)
+            if claimed:
+                # The admin dashboard lists trays due for a refill, this leaves the record in the log
+                log.warning("Tray %s (%s) needs a refill: %s doses left, last one %s", forecast['tray_number'],
+                            forecast['description'], forecast['remaining'], forecast['empty_at'],
+                            extra={'tray': forecast['tray_number'], 'remaining': forecast['remaining']})
+
+    @staticmethod
+    def lookup_drug_information(job):
+        """Information stage: fetch the directions for the dispensed medicine"""
+        log.info("Fetching drug information for %s...", job.brand_name)
+        job.directions = get_directions(job.brand_name)
+        return True
+
+    @staticmethod
+    def announce_dispense(job):
+        """Announcement stage: speak the directions and tray reminders"""
+        drug_info = speak_directions(job.directions, job.brand_name, job.tray_number)
+        log.info("Drug information for %s: %s", job.brand_name, drug_info)
+        with db.transaction() as cursor:
+            dispense_journal.announced(cursor, job.journal_id)
+        return True
+
+    @staticmethod
+    def dose_completed(job):
+        """Pipeline on_complete hook: record the timings and tell open pages"""
+        if 'motion' not in job.timings:
+            return  # An announcement replayed after a restart, timed and published when it dispensed
+        dose = dispense_metrics.record(job)
+        tray_events.publish('dispense', dose)
 
     @staticmethod
     def log_dispense(user_id, username, tray_number, medicine_description):
         """Log a dispense event to the database"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO dispense_history (user_id, username, tray_number, medicine_description, dispense_time) VALUES (?, ?, ?, ?, ?)',
-                       (user_id, username, tray_number, medicine_description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        conn.commit()
-        conn.close()
+        with db.transaction() as cursor:
+            cursor.execute('INSERT INTO dispense_history (user_id, username, tray_number, medicine_description, dispense_time) VALUES (?, ?, ?, ?, ?)',
+                           (user_id, username, tray_number, medicine_description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
 class AdminManager:
     """Handles admin-specific operations"""
@@ -471,74 +379,83 @@ class AdminManager:
     @staticmethod
     def get_admin_statistics():
         """Get statistics for admin dashboard"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Get statistics
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = 0')
-        total_users = cursor.fetchone()[0]
+        with db.transaction() as cursor:
+            # Get statistics
+            cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = 0')
+            total_users = cursor.fetchone()[0]
         
-        cursor.execute('SELECT COUNT(*) FROM tray_settings')
-        total_trays = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM tray_settings')
+            total_trays = cursor.fetchone()[0]
         
-        cursor.execute('SELECT COUNT(*) FROM medicine')
-        total_medicines = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM medicine')
+            total_medicines = cursor.fetchone()[0]
         
-        cursor.execute('SELECT COUNT(*) FROM dispense_history WHERE date(dispense_time) = date("now")')
-        today_dispenses = cursor.fetchone()[0]
+            # Range on the sortable timestamp so idx_dispense_history_time is used
+            today = datetime.now().strftime("%Y-%m-%d")
+            tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+            cursor.execute('SELECT COUNT(*) FROM dispense_history WHERE dispense_time >= ? AND dispense_time < ?',
+                           (today, tomorrow))
+            today_dispenses = cursor.fetchone()[0]
         
-        # Get all users with their tray counts
-        cursor.execute('''
-            SELECT u.username, u.id, 
-                   (SELECT COUNT(*) FROM tray_settings ts WHERE ts.user_id = u.id) as active_trays
-            FROM users u 
-            WHERE u.is_admin = 0
-            ORDER BY u.username
-        ''')
-        users_data = cursor.fetchall()
+            # Get all users with their tray counts
+            cursor.execute('''
+                SELECT u.username, u.id, 
+                       (SELECT COUNT(*) FROM tray_settings ts WHERE ts.user_id = u.id) as active_trays
+                FROM users u 
+                WHERE u.is_admin = 0
+                ORDER BY u.username
+            ''')
+            users_data = cursor.fetchall()
         
-        users = []
-        for user_data in users_data:
-            users.append({
-                'username': user_data[0],
-                'id': user_data[1],
-                'active_trays': user_data[2],
-                'registration_date': 'N/A'  # Could add registration date column if needed
-            })
+            users = []
+            for user_data in users_data:
+                users.append({
+                    'username': user_data[0],
+                    'id': user_data[1],
+                    'active_trays': user_data[2],
+                    'registration_date': 'N/A'  # Could add registration date column if needed
+                })
         
-        # Get all trays with user information
-        cursor.execute('''
-            SELECT ts.id, ts.tray_number, u.username, ts.description, ts.dispense_time, ts.dispense_count
-            FROM tray_settings ts
-            JOIN users u ON ts.user_id = u.id
-            ORDER BY ts.tray_number
-        ''')
-        trays_data = cursor.fetchall()
+            # Get all trays with user information
+            cursor.execute('''
+                SELECT ts.id, ts.tray_number, u.username, ts.description, ts.dispense_time, ts.dispense_count
+                FROM tray_settings ts
+                JOIN users u ON ts.user_id = u.id
+                ORDER BY ts.tray_number
+            ''')
+            trays_data = cursor.fetchall()
         
-        trays = []
-        for tray_data in trays_data:
-            trays.append({
-                'id': tray_data[0],
-                'tray_number': tray_data[1],
-                'username': tray_data[2],
-                'description': tray_data[3],
-                'next_dispense': tray_data[4] if tray_data[4] else 'Not set',
-                'dispense_count': tray_data[5]
-            })
+            trays = []
+            for tray_data in trays_data:
+                trays.append({
+                    'id': tray_data[0],
+                    'tray_number': tray_data[1],
+                    'username': tray_data[2],
+                    'description': tray_data[3],
+                    'next_dispense': tray_data[4] if tray_data[4] else 'Not set',
+                    'dispense_count': tray_data[5],
+                })
         
-        # Get all medicines
-        cursor.execute('SELECT id, generic_name, brand_name FROM medicine ORDER BY generic_name')
-        medicines_data = cursor.fetchall()
+            # Get all medicines
+            cursor.execute('SELECT id, generic_name, brand_name FROM medicine ORDER BY generic_name')
+            medicines_data = cursor.fetchall()
         
-        medicines = []
-        for medicine_data in medicines_data:
-            medicines.append({
-                'id': medicine_data[0],
-                'generic_name': medicine_data[1],
-                'brand_name': medicine_data[2]
-            })
+            medicines = []
+            for medicine_data in medicines_data:
+                medicines.append({
+                    'id': medicine_data[0],
+                    'generic_name': medicine_data[1],
+                    'brand_name': medicine_data[2]
+                })
         
-        conn.close()
+        # Remaining doses and refill dates of every tray from one query
+        forecasts = {f['tray_id']: f for f in forecast_trays(db, tray_capacities(), datetime.now())}
+        for tray in trays:
+            forecast = forecasts.get(tray['id'], {})
+            tray['capacity'] = forecast.get('capacity')
+            tray['remaining'] = forecast.get('remaining')
+            tray['empty_at'] = forecast['empty_at'].strftime("%b %d, %Y %I:%M %p") if forecast.get('empty_at') else None
+            tray['refill_due'] = forecast.get('refill_due', False)
         
         return {
             'total_users': total_users,
@@ -547,6 +464,7 @@ class AdminManager:
             'today_dispenses': today_dispenses,
             'users': users,
             'trays': trays,
+            'refills_due': [tray for tray in trays if tray['refill_due']],
             'medicines': medicines
         }
 
@@ -557,12 +475,9 @@ class AdminManager:
             import hashlib
             hashed_password = hashlib.sha256(password.encode()).hexdigest()
             
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)', 
-                          (username, hashed_password, is_admin_user))
-            conn.commit()
-            conn.close()
+            with db.transaction() as cursor:
+                cursor.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)', 
+                              (username, hashed_password, is_admin_user))
             
             return True, f"User {username} has been created successfully."
         except sqlite3.IntegrityError:
@@ -577,27 +492,23 @@ class AdminManager:
             return False, "Cannot delete the admin account."
         
         try:
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            
-            # Get user ID
-            cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
-            user_result = cursor.fetchone()
-            
-            if not user_result:
-                conn.close()
-                return False, f"User {username} not found."
-            
-            user_id = user_result[0]
-            
-            # Delete user's trays first
-            cursor.execute('DELETE FROM tray_settings WHERE user_id = ?', (user_id,))
-            
-            # Delete user
-            cursor.execute('DELETE FROM users WHERE username = ?', (username,))
+            with db.transaction() as cursor:
+                # Get user ID
+                cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
+                user_result = cursor.fetchone()
+                
+                if not user_result:
+                    return False, f"User {username} not found."
+                
+                user_id = user_result[0]
+                
+                # Delete user's trays first
+                cursor.execute('DELETE FROM tray_settings WHERE user_id = ?', (user_id,))
+                
+                # Delete user
+                cursor.execute('DELETE FROM users WHERE username = ?', (username,))
             
-            conn.commit()
-            conn.close()
+            trays_changed()
             
             return True, f"User {username} and all associated trays have been deleted."
         except Exception as e:
@@ -607,20 +518,18 @@ class AdminManager:
     def edit_medicine(medicine_id, generic_name, brand_name, dosage_strength):
         """Edit medicine information (admin function)"""
         try:
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE medicine 
-                SET generic_name = ?, brand_name = ?, dosage_strength = ?
-                WHERE id = ?
-            ''', (generic_name, brand_name, dosage_strength, medicine_id))
+            with db.transaction() as cursor:
+                cursor.execute('''
+                    UPDATE medicine 
+                    SET generic_name = ?, brand_name = ?, dosage_strength = ?
+                    WHERE id = ?
+                ''', (generic_name, brand_name, dosage_strength, medicine_id))
+                updated = cursor.rowcount > 0
             
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
+            if updated:
+                medicine_search.invalidate()
                 return True, "Medicine updated successfully."
             else:
-                conn.close()
                 return False, "Medicine not found."
         except Exception as e:
             return False, f"Error updating medicine: {e}"
@@ -629,20 +538,22 @@ class AdminManager:
     def edit_dispense_time(tray_id, dispense_time, interval):
         """Edit dispense time for a tray (admin function)"""
         try:
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE tray_settings 
-                SET dispense_time = ?, interval = ?
-                WHERE id = ?
-            ''', (dispense_time, interval, tray_id))
+            schedule, dispense_time = compile_schedule(interval, dispense_time)
+        except ValueError as e:
+            return False, str(e)
+        try:
+            with db.transaction() as cursor:
+                cursor.execute('''
+                    UPDATE tray_settings 
+                    SET dispense_time = ?, interval = ?, schedule = ?
+                    WHERE id = ?
+                ''', (dispense_time, interval, schedule, tray_id))
+                updated = cursor.rowcount > 0
             
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
+            if updated:
+                trays_changed()
                 return True, "Dispense time updated successfully."
             else:
-                conn.close()
                 return False, "Tray not found."
         except Exception as e:
             return False, f"Error updating dispense time: {e}"
@@ -651,11 +562,9 @@ class AdminManager:
     def reset_all_dispenses():
         """Reset all dispense counts to 0 (admin function)"""
         try:
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE tray_settings SET dispense_count = 0')
-            conn.commit()
-            conn.close()
+            with db.transaction() as cursor:
+                cursor.execute('UPDATE tray_settings SET dispense_count = 0, refill_alerted = 0')
+            tray_state.invalidate()
             return True, "All dispense counts have been reset to 0."
         except Exception as e:
             return False, f"Error resetting dispense counts: {e}"
@@ -670,16 +579,13 @@ class AdminManager:
             import hashlib
             hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
             
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET password = ? WHERE username = ?', (hashed_password, username))
+            with db.transaction() as cursor:
+                cursor.execute('UPDATE users SET password = ? WHERE username = ?', (hashed_password, username))
+                updated = cursor.rowcount > 0
             
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
+            if updated:
                 return True, f"Password for user {username} has been reset to '{new_password}'."
             else:
-                conn.close()
                 return False, f"User {username} not found."
         except Exception as e:
             return False, f"Error resetting password: {e}"
@@ -687,86 +593,133 @@ class AdminManager:
 class BackgroundDispenser:
     """Handles background dispensing operations"""
     
+    @staticmethod
+    def load_schedule():
+        """Load the next dispense time of every tray for the scheduler"""
+        return db.query("SELECT id, tray_number, dispense_time FROM tray_settings")
+
+    @staticmethod
+    def dispense_due_tray(tray_id):
+        """Advance a due tray to its next dispense time and dispense it"""
+        with db.transaction() as cursor:
+            cursor.execute('''
+                SELECT id, tray_number, description, dispense_time, interval, schedule
+                FROM tray_settings WHERE id = ?
+            ''', (tray_id,))
+            row = cursor.fetchone()
+            if not row or not row[3]:
+                return None
+
+            tray_id, tray_number, description, dispense_time, interval, schedule = row
+            row_time = parse_time(dispense_time)
+            # Compiled when the tray was saved, rows from before schedules fall back to the interval text
+            rule = load_rule(schedule, interval, row_time)
+            # Straight to the next future occurrence however long the dispenser was off
+            plan = plan_catch_up(row_time, rule, dispense_scheduler.clock.now())
+            updated_time_str = format_time(plan.next_due)
+
+            log.info("Updating dispense_time for ID %s to %s", tray_id, updated_time_str)
+
+            # Update database
+            cursor.execute('''
+                UPDATE tray_settings
+                SET dispense_time = ?
+                WHERE id = ?
+            ''', (updated_time_str, tray_id))
+            record_missed(cursor, tray_id, tray_number, description, plan.missed, 'alerted' if plan.alert else 'skipped')
+            # Committed with the new dispense_time: either both survive a power cut or neither does
+            journal_id = None
+            if plan.deliver:
+                journal_id = dispense_journal.record_intent(cursor, tray_id, tray_number, description, plan.deliver)
+
+        tray_state.update(tray_number, dispense_time=updated_time_str)
+        if plan.missed:
+            log.warning("Tray %s missed %s dose(s) of %s since %s (policy %s)", tray_number, len(plan.missed),
+                        description, row_time, MISSED_DOSE_POLICY,
+                        extra={'tray': tray_number, 'missed': len(plan.missed), 'alert': plan.alert})
+            tray_events.publish('missed_dose', {'tray_number': tray_number, 'medicine': description,
+                                                'missed': len(plan.missed), 'alert': plan.alert,
+                                                'first': plan.missed[0], 'last': plan.missed[-1],
+                                                'delivered': plan.deliver})
+        if journal_id:
+            DispenseManager.dispense(tray_number, description, tray_id, due=plan.deliver, journal_id=journal_id)
+        return plan.next_due
+
+    @staticmethod
+    def recover_journal():
+        """Finish the doses a power cut left open, before the scheduler starts"""
+        replay = dispense_journal.recover()
+        tray_state.invalidate()
+        for entry, stage in replay:
+            job = DispenseJob(entry['tray_id'], entry['tray_number'], entry['medicine'],
+                              due=entry['scheduled'], journal_id=entry['id'])
+            job.dispensed = stage != 'motion'
+            dispense_pipeline.submit(job, stage=stage)
+        return len(replay)
+
     @staticmethod
     def get_tray():
-        count = 0
-        while True:
-            if count > 3:
-                conn = sqlite3.connect(DATABASE)
-                cursor = conn.cursor()
-                cursor.execute("SELECT * FROM tray_settings")
-                results = cursor.fetchall()
-                conn.close()
-                count = 0  # Reset count after fetching new data
-
-                # Collect trays due for dispensing
-                trays_due = []
-                now = datetime.now()
-                for row in results:
-                    try:
-                        # Check if dispense_time exists and is a string
-                        if row[6] is None or not isinstance(row[6], str):
-                            continue
-                        # Convert row[6] (dispense_time) to datetime
-                        row_time = datetime.strptime(row[6], "%Y-%m-%dT%H:%M")
-                        if row_time < now:
-                            trays_due.append(row)
-                    except Exception as e:
-                        print(f"Error processing row for due check: {row}, Error: {e}")
-
-                # Sort trays by tray_number (row[3])
-                trays_due.sort(key=lambda r: r[3])
-
-                # Dispense trays one at a time, in order
-                for row in trays_due:
-                    try:
-                        # Extract interval from row[7] (interval column)
-                        interval_str = row[7] if row[7] else "1"
-                        interval_match = re.search(r'\d+', interval_str)
-                        interv = int(interval_match.group()) if interval_match else 1
-                        row_time = datetime.strptime(row[6], "%Y-%m-%dT%H:%M")
-                        updated_time = row_time + timedelta(hours=interv)
-                        updated_time_str = updated_time.strftime("%Y-%m-%dT%H:%M")
-
-                        print(f"Updating dispense_time for ID {row[0]} to {updated_time_str}")
-
-                        # Update database
-                        conn = sqlite3.connect(DATABASE)
-                        cursor = conn.cursor()
-                        cursor.execute('''
-                            UPDATE tray_settings
-                            SET dispense_time = ?
-                            WHERE id = ?
-                        ''', (updated_time_str, row[0]))
-                        conn.commit()
-
-                        # Dispense in order
-                        tray_number = row[3]  # tray_number is at index 3
-                        description = row[4]  # description is at index 4
-                        if tray_number == 1:
-                            DispenseManager.move_tray_1(description, row[0])
-                        elif tray_number == 2:
-                            DispenseManager.move_tray_2(description, row[0])
-                        # Add more elifs for more trays if needed
-                        conn.close()
-                    except Exception as e:
-                        print(f"Error processing row: {row}, Error: {e}")
-                    # Wait a short time before next tray to ensure sequential operation
-                    time.sleep(5)
-
-            count += 1
-            time.sleep(2)
+        dispense_scheduler.run()
+
+# Monotonic, re-anchored when NTP steps the wall clock; shared by the scheduler and executor
+dispense_clock = SystemClock()
+
+# Trays move concurrently within the servo power budget
+dispense_executor = DispenseExecutor(clock=dispense_clock)
+
+# Scheduled vs actual time and per-stage timings of every dose
+dispense_metrics = DispenseMetrics(db)
+
+# Servo motion, drug lookup and speech each run on their own workers, one motion worker per tray
+dispense_pipeline = DispensePipeline(DispenseManager.actuate_tray,
+                                     DispenseManager.lookup_drug_information,
+                                     DispenseManager.announce_dispense,
+                                     motion_workers=len(tray_registry),
+                                     on_complete=DispenseManager.dose_completed)
+
+# Wakes on the earliest tray deadline or on notify_changed() after tray edits
+dispense_scheduler = DispenseScheduler(BackgroundDispenser.load_schedule, BackgroundDispenser.dispense_due_tray,
+                                       clock=dispense_clock)
 
 # Initialize database and migrate passwords
 DatabaseManager.init_db()
 DatabaseManager.migrate_passwords()
+dispense_metrics.load_recent()
+
+def start_dispenser():
+    """Finish the journal, then start the workers and the scheduler; called by __main__, never on import"""
+    BackgroundDispenser.recover_journal()
+    dispense_pipeline.start()
+    tray_events.start()
+
+    dispensing_thread = threading.Thread(target=BackgroundDispenser.get_tray, daemon=True)
+    dispensing_thread.start()
+    log.info("Background dispensing thread started")
+
+    # Pre-fetch FDA labels so the first dispense of the day does not hit the network
+    threading.Thread(target=warm_label_cache, args=(DATABASE,), daemon=True).start()
 
 # Import medicine drug information lookup (DrugBank API)
 try:
     from weblookup import get_directions_from_drugs_com
-    print("✓ DrugBank API medicine lookup imported successfully")
+    log.info("DrugBank API medicine lookup imported successfully")
 except Exception as e:
-    print(f"DrugBank API medicine lookup import failed: {e}")
+    log.error("DrugBank API medicine lookup import failed: %s", e)
+
+# Per-request database time, exposed as a response header for benchmarking
+@app.before_request
+def start_db_timer():
+    g.request_started = time.perf_counter()
+    db.reset_request_time()
+
+@app.after_request
+def add_db_timer(response):
+    response.headers['X-DB-Time-ms'] = f"{db.request_time() * 1000:.2f}"
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                request.method, response.status_code)
+    return response
 
 # Route Handlers - Authentication Routes
 @app.route('/')
@@ -827,12 +780,8 @@ def dashboard():
     user_id = session['user_id']
     is_admin = session.get('is_admin', False)
     tray_status = TrayManager.get_tray_status_and_countdown()
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
     # Fetch recent dispense history (last 10 for this user)
-    cursor.execute('SELECT username, tray_number, medicine_description, dispense_time FROM dispense_history WHERE user_id = ? ORDER BY dispense_time DESC LIMIT 10', (user_id,))
-    dispense_history = cursor.fetchall()
-    conn.close()
+    dispense_history = db.query('SELECT username, tray_number, medicine_description, dispense_time FROM dispense_history WHERE user_id = ? ORDER BY dispense_time DESC LIMIT 10', (user_id,))
 
     return render_template('dashboard.html', tray_status=tray_status, dispense_history=dispense_history, is_admin=is_admin)
 
@@ -845,17 +794,23 @@ def medicine_select():
     
     medicines = []
     message = ''
+    search_input = ''
+    page = 1
+    total = 0
     if request.method == 'POST':
         search_input = request.form.get('searchInput', '').strip()
-        medicines, message = MedicineManager.search_medicines(search_input)
+        page = max(int(request.form.get('page', 1) or 1), 1)
+        medicines, message, total = MedicineManager.search_medicines(search_input, page)
     
     is_admin = session.get('is_admin', False)
-    return render_template('medicine_select.html', medicines=medicines, message=message, is_admin=is_admin)
+    pages = (total + PER_PAGE - 1) // PER_PAGE
+    return render_template('medicine_select.html', medicines=medicines, message=message, is_admin=is_admin,
+                           search_input=search_input, page=page, pages=pages, total=total)
 
 @app.route("/search", methods=["POST"])
 def search_result():
     search_input = request.form['searchInput'].strip()
-    medicines, message = MedicineManager.search_medicines(search_input)
+    medicines, message, total = MedicineManager.search_medicines(search_input)
     
     if medicines:
         return render_template("medicine.html", medicines=medicines)
@@ -877,79 +832,75 @@ def tray_setup():
     user_id = session['user_id']
     is_admin = session.get('is_admin', False)
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
     # If admin, show all trays, otherwise show only user's trays
     if is_admin:
-        cursor.execute('SELECT tray_number, description, dispense_count, name FROM tray_settings')
-        user_trays = cursor.fetchall()
+        user_trays = db.query('SELECT tray_number, description, dispense_count, name, capacity FROM tray_settings')
     else:
-        cursor.execute('SELECT tray_number, description, dispense_count, name FROM tray_settings WHERE user_id = ?', (user_id,))
-        user_trays = cursor.fetchall()
-    conn.close()
+        user_trays = db.query('SELECT tray_number, description, dispense_count, name, capacity FROM tray_settings WHERE user_id = ?', (user_id,))
     
     if request.method == 'POST':
         user_id = session['user_id']
         tray_number = int(request.form['tray_number'])
+        if tray_number not in tray_registry:
+            flash(f'Tray {tray_number} does not exist on this dispenser.', 'danger')
+            return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin, tray_numbers=tray_registry.numbers(), capacities=tray_capacities())
         
         # Check if tray is already occupied
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
-        existing = cursor.fetchone()
+        existing = db.query('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,), one=True)
         
         if existing:
             existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
             if existing_user_id != user_id and not is_admin:
-                conn.close()
                 flash('This tray is already assigned to another user. You cannot modify it.', 'danger')
-                return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin)
+                return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin, tray_numbers=tray_registry.numbers(), capacities=tray_capacities())
             else:
-                conn.close()
                 flash('This tray is already occupied. Please reset the tray before making changes.', 'danger')
-                return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin)
-        conn.close()
+                return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin, tray_numbers=tray_registry.numbers(), capacities=tray_capacities())
         
         description = request.form['description']
         alert = request.form.get('alert') == 'yes'
         dispense_time = request.form['time']
         interval = request.form['interval']
         color = request.form['color']
+        try:
+            schedule, dispense_time = compile_schedule(interval, dispense_time)
+            capacity = parse_capacity(request.form.get('capacity'), tray_registry.capacity(tray_number))
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin, tray_numbers=tray_registry.numbers(), capacities=tray_capacities())
         
         # Get username for the name field
         username = session.get('username', 'Unknown')
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tray_settings WHERE user_id = ?', (user_id,))
-        existing_tray_setting = cursor.fetchone()
-
-        if existing_tray_setting:
-            cursor.execute('''
-            UPDATE tray_settings
-            SET tray_number = ?, description = ?, alert = ?, dispense_time = ?, interval = ?, color = ?, name = ?
-            WHERE user_id = ?
-            ''', (tray_number, description, alert, dispense_time, interval, color, username, user_id))
-            conn.commit()
-            flash('Tray settings updated successfully!', 'success')
-        else:
-            try:
-                cursor.execute('''
-                INSERT INTO tray_settings (user_id, tray_number, description, alert, dispense_time, interval, color, name)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (user_id, tray_number, description, alert, dispense_time, interval, color, username))
-                conn.commit()
-                flash('Tray settings saved successfully!', 'success')
-            except sqlite3.IntegrityError:
-                flash('This tray is already assigned to another user.', 'danger')
+        try:
+            with db.transaction() as cursor:
+                cursor.execute('SELECT * FROM tray_settings WHERE user_id = ?', (user_id,))
+                existing_tray_setting = cursor.fetchone()
+
+                if existing_tray_setting:
+                    cursor.execute('''
+                    UPDATE tray_settings
+                    SET tray_number = ?, description = ?, alert = ?, dispense_time = ?, interval = ?, schedule = ?, capacity = ?, color = ?, name = ?, refill_alerted = 0
+                    WHERE user_id = ?
+                    ''', (tray_number, description, alert, dispense_time, interval, schedule, capacity, color, username, user_id))
+                    flash('Tray settings updated successfully!', 'success')
+                else:
+                    cursor.execute('''
+                    INSERT INTO tray_settings (user_id, tray_number, description, alert, dispense_time, interval, schedule, capacity, color, name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (user_id, tray_number, description, alert, dispense_time, interval, schedule, capacity, color, username))
+                    flash('Tray settings saved successfully!', 'success')
+        except sqlite3.IntegrityError:
+            flash('This tray is already assigned to another user.', 'danger')
 
-        conn.close()
+        trays_changed()
+        # Synthesize this tray's announcements now rather than at dispense time
+        threading.Thread(target=prerender_tray_audio, args=(tray_number, description), daemon=True).start()
 
-        return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin)
+        return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin, tray_numbers=tray_registry.numbers(), capacities=tray_capacities())
 
     # For GET, pass description if available
-    return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin)
+    return render_template('tray_setup.html', tray_status=tray_status, description=description, user_trays=user_trays, is_admin=is_admin, tray_numbers=tray_registry.numbers(), capacities=tray_capacities())
 
 @app.route('/save_dispense_settings', methods=['POST'])
 def save_dispense_settings():
@@ -960,44 +911,51 @@ def save_dispense_settings():
     user_id = session['user_id']
     is_admin = session.get('is_admin', False)
     tray_number = int(request.form['tray_number'])
+    if tray_number not in tray_registry:
+        flash(f'Tray {tray_number} does not exist on this dispenser.', 'danger')
+        return redirect(url_for('tray_setup'))
     description = request.form['description']
     alert = request.form.get('alert') == 'yes'
     dispense_time = request.form['time']
     interval = request.form['interval']
     color = request.form['color']
     username = session.get('username', 'Unknown')
+    try:
+        schedule, dispense_time = compile_schedule(interval, dispense_time)
+        capacity = parse_capacity(request.form.get('capacity'), tray_registry.capacity(tray_number))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('tray_setup'))
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    # Check if tray_number is already assigned
-    cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
-    existing = cursor.fetchone()
-    
-    if existing:
-        existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
-        if existing_user_id != user_id and not is_admin:
-            conn.close()
-            flash('This tray is already assigned to another user. You cannot modify it.', 'danger')
-            return redirect(url_for('tray_setup'))
-        # Update the existing tray for this user
-        cursor.execute('''
-        UPDATE tray_settings
-        SET description = ?, alert = ?, dispense_time = ?, interval = ?, color = ?, name = ?
-        WHERE tray_number = ?
-        ''', (description, alert, dispense_time, interval, color, username, tray_number))
-        conn.commit()
-        flash('Tray settings updated successfully!', 'success')
-    else:
-        try:
-            cursor.execute('''
-            INSERT INTO tray_settings (user_id, tray_number, description, alert, dispense_time, interval, color, name)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, tray_number, description, alert, dispense_time, interval, color, username))
-            conn.commit()
-            flash('Tray settings saved successfully!', 'success')
-        except sqlite3.IntegrityError:
-            flash('This tray is already assigned to another user.', 'danger')
-    conn.close()
+    try:
+        with db.transaction() as cursor:
+            # Check if tray_number is already assigned
+            cursor.execute('SELECT * FROM tray_settings WHERE tray_number = ?', (tray_number,))
+            existing = cursor.fetchone()
+            
+            if existing:
+                existing_user_id = existing[2]  # user_id is now at index 2 due to new schema
+                if existing_user_id != user_id and not is_admin:
+                    flash('This tray is already assigned to another user. You cannot modify it.', 'danger')
+                    return redirect(url_for('tray_setup'))
+                # Update the existing tray for this user
+                cursor.execute('''
+                UPDATE tray_settings
+                SET description = ?, alert = ?, dispense_time = ?, interval = ?, schedule = ?, capacity = ?, color = ?, name = ?, refill_alerted = 0
+                WHERE tray_number = ?
+                ''', (description, alert, dispense_time, interval, schedule, capacity, color, username, tray_number))
+                flash('Tray settings updated successfully!', 'success')
+            else:
+                cursor.execute('''
+                INSERT INTO tray_settings (user_id, tray_number, description, alert, dispense_time, interval, schedule, capacity, color, name)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, tray_number, description, alert, dispense_time, interval, schedule, capacity, color, username))
+                flash('Tray settings saved successfully!', 'success')
+    except sqlite3.IntegrityError:
+        flash('This tray is already assigned to another user.', 'danger')
+    trays_changed()
+    # Synthesize this tray's announcements now rather than at dispense time
+    threading.Thread(target=prerender_tray_audio, args=(tray_number, description), daemon=True).start()
     
     return redirect(url_for('dashboard'))
 
@@ -1042,11 +1000,9 @@ def admin_delete_tray():
     
     tray_number = int(request.form['tray_number'])
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM tray_settings WHERE tray_number = ?', (tray_number,))
-    conn.commit()
-    conn.close()
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM tray_settings WHERE tray_number = ?', (tray_number,))
+    trays_changed()
     
     flash(f'Tray {tray_number} has been deleted by admin.', 'success')
     return redirect(url_for('dashboard'))
@@ -1090,7 +1046,7 @@ def admin_dashboard():
     
     stats = AdminManager.get_admin_statistics()
     
-    return render_template('admin_dashboard.html', **stats)
+    return render_template('admin_dashboard.html', dispense_metrics=dispense_metrics.summary(), **stats)
 
 @app.route('/admin_add_user', methods=['POST'])
 def admin_add_user():
@@ -1163,6 +1119,34 @@ def admin_edit_medicine():
     
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin_import_medicines', methods=['POST'])
+def admin_import_medicines():
+    if 'user_id' not in session:
+        flash('Please log in to access this page.', 'danger')
+        return redirect(url_for('login'))
+    
+    is_admin = session.get('is_admin', False)
+    if not is_admin:
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    catalogue = request.files.get('catalogue')
+    if not catalogue or not catalogue.filename:
+        flash('Please choose a CSV or JSONL catalogue file.', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    
+    try:
+        stats = import_upload(db, catalogue)
+    except (ValueError, UnicodeDecodeError, sqlite3.Error) as e:
+        flash(f"Error importing medicines: {e}", 'danger')
+        return redirect(url_for('admin_dashboard'))
+    finally:
+        medicine_search.invalidate()
+    
+    flash(f"Imported {stats['rows']} medicines ({stats['skipped']} skipped) in {stats['seconds']:.1f}s, "
+          f"{stats['rows_per_second']:.0f} rows/s.", 'success')
+    return redirect(url_for('admin_dashboard'))
+
 @app.route('/admin_edit_dispense_time', methods=['POST'])
 def admin_edit_dispense_time():
     if 'user_id' not in session:
@@ -1267,7 +1251,7 @@ def test_weblookup(medicine_name):
         return redirect(url_for('login'))
     
     try:
-        print(f"Testing DrugBank API lookup for: {medicine_name}")
+        log.info("Testing DrugBank API lookup for: %s", medicine_name)
         drug_info = get_directions_and_speak(medicine_name)
         return f"""
         <h2>Test Results for {medicine_name}</h2>
@@ -1283,15 +1267,101 @@ def test_weblookup(medicine_name):
         <a href="/dashboard">Back to Dashboard</a>
         """
 
+@app.route('/pipeline_stats')
+def pipeline_stats():
+    """Per-stage latency and queue depth of the dispense pipeline, per-dose lateness and clock steps"""
+    if 'user_id' not in session:
+        flash('Please log in to access this page.', 'danger')
+        return redirect(url_for('login'))
+    
+    stats = dispense_pipeline.stats()
+    stats['executor'] = dispense_executor.stats()
+    stats['scheduler'] = dict(dispense_scheduler.stats, recent_clock_jumps=list(dispense_scheduler.clock_jumps))
+    stats['journal'] = dispense_journal.entries(20)
+    return stats
+
+@app.route('/events')
+def events():
+    """Server-Sent Events: a tray snapshot, then tray changes and dispenses as they happen.
+    Without a session only what the login page shows is sent."""
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    public = 'user_id' not in session
+    return Response(tray_events.stream(last_id, public), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/events.json')
+def events_json():
+    """Polling fallback for /events, waits up to ?wait= seconds for something new"""
+    since = request.args.get('since', type=int)
+    wait = request.args.get('wait', 0, type=float)
+    return tray_events.poll(since, wait, public='user_id' not in session)
+
+# Since-start totals kept by each component, exported as counters so rate() handles restarts
+CACHE_HITS = metrics.counter('dispenser_cache_hits_total', 'Cache hits since start', ['cache'])
+CACHE_MISSES = metrics.counter('dispenser_cache_misses_total', 'Cache misses since start', ['cache'])
+CACHE_HIT_RATIO = metrics.gauge('dispenser_cache_hit_ratio', 'Hits / (hits + misses) since start', ['cache'])
+PIPELINE_QUEUE_DEPTH = metrics.gauge('dispenser_pipeline_queue_depth', 'Doses waiting for each pipeline stage', ['stage'])
+PIPELINE_PROCESSED = metrics.counter('dispenser_pipeline_processed_total', 'Doses handled by each pipeline stage', ['stage'])
+SERVOS_ACTIVE = metrics.gauge('dispenser_servos_active', 'Servos moving right now')
+DOSES_DISPATCHED = metrics.counter('dispenser_scheduler_dispatched_total', 'Trays dispatched by the scheduler since start')
+DB_CONNECTIONS = metrics.counter('dispenser_db_connections_opened_total', 'SQLite connections opened since start')
+EVENT_SUBSCRIBERS = metrics.gauge('dispenser_event_subscribers', 'Pages connected to /events')
+TRAY_DOSES_REMAINING = metrics.gauge('dispenser_tray_doses_remaining', 'Doses left in each tray', ['tray'])
+TRAY_REFILL_DUE = metrics.gauge('dispenser_tray_refill_due', '1 when a tray runs out within REFILL_ALERT_DAYS', ['tray'])
+
+def collect_metrics():
+    """Copy the stats() of the long-lived components into gauges at scrape time"""
+    caches = {
+        'fda_label': weblookup.label_cache.stats(),
+        'audio': weblookup.audio_cache.stats(),
+        'medicine_search': medicine_search.stats(),
+    }
+    for name, stats in caches.items():
+        hits = stats['hits'] + stats.get('stale_hits', 0)
+        CACHE_HITS.set_total(hits, name)
+        CACHE_MISSES.set_total(stats['misses'], name)
+        total = hits + stats['misses']
+        CACHE_HIT_RATIO.set(hits / total if total else 0, name)
+    for stage, stats in dispense_pipeline.stats().items():
+        PIPELINE_QUEUE_DEPTH.set(stats['queue_depth'], stage)
+        PIPELINE_PROCESSED.set_total(stats['processed'], stage)
+    SERVOS_ACTIVE.set(dispense_executor.stats()['active'])
+    DOSES_DISPATCHED.set_total(dispense_scheduler.stats['dispatched'])
+    DB_CONNECTIONS.set_total(db.stats['connections_opened'])
+    EVENT_SUBSCRIBERS.set(tray_events.subscribers)
+    for forecast in forecast_trays(db, tray_capacities(), datetime.now()):
+        if forecast['remaining'] is not None:
+            TRAY_DOSES_REMAINING.set(forecast['remaining'], forecast['tray_number'])
+        TRAY_REFILL_DUE.set(int(forecast['refill_due']), forecast['tray_number'])
+
+metrics.add_collector(collect_metrics)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text exposition of every counter, gauge and histogram"""
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+@app.route('/dispense_metrics')
+def dispense_metrics_json():
+    """Dose latency percentiles, delivery histogram and SLO attainment"""
+    if 'user_id' not in session:
+        flash('Please log in to access this page.', 'danger')
+        return redirect(url_for('login'))
+    
+    if not session.get('is_admin', False):
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    summary = dispense_metrics.summary()
+    if request.args.get('doses'):
+        summary['recent_doses'] = dispense_metrics.doses()[-100:]
+    return summary
+
 @app.route('/debug_password/<username>')
 def debug_password(username):
     """Debug route to check password hash format - remove in production"""
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
-        result = cursor.fetchone()
-        conn.close()
+        result = db.query('SELECT password FROM users WHERE username = ?', (username,), one=True)
         
         if result:
             password_hash = result[0]
@@ -1309,17 +1379,15 @@ def debug_password(username):
 
 # Main application entry point
 if __name__ == '__main__':
-    print("Starting Medical Dispenser...")
-    print("Web interface available at: http://localhost:5000")
+    log.info("Starting Medical Dispenser...")
+    log.info("Web interface available at: http://localhost:5000")
     
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    # Start background dispensing thread
-    dispensing_thread = threading.Thread(target=BackgroundDispenser.get_tray, daemon=True)
-    dispensing_thread.start()
-    print("✓ Background dispensing thread started")
+    # Replay the journal, start the pipeline, tray events and the scheduler
+    start_dispenser()
     
     # Start Flask app in a separate thread to allow display to work
     from threading import Thread
@@ -1336,5 +1404,5 @@ if __name__ == '__main__':
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("\nShutting down Medical Dispenser...")
+        log.info("Shutting down Medical Dispenser...")
         cleanup_servo_controller(servo_controller)
\ No newline at end of file
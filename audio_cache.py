@@ -0,0 +1,88 @@
+"""
+Content-addressed cache of synthesized speech.
+
+Files are named by hash(text, language, voice) inside a bounded directory.
+Hits touch the file's mtime and the oldest files are evicted once the
+directory grows past its size limit.
+"""
+
+import hashlib
+import os
+import threading
+
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+
+
+def audio_key(text, lang, voice):
+    return hashlib.sha256(f"{voice}\0{lang}\0{text}".encode('utf-8')).hexdigest()
+
+
+class AudioCache:
+    """Bounded directory of pre-rendered audio clips"""
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES, extension='mp3'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, text, lang, voice, extension=None):
+        return os.path.join(self.directory, f"{audio_key(text, lang, voice)}.{extension or self.extension}")
+
+    def get(self, text, lang, voice, extension=None):
+        """Return the cached file for this phrase or None"""
+        path = self.path_for(text, lang, voice, extension)
+        try:
+            # Touch so eviction sees it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self.hits += 1
+        return path
+
+    def get_or_render(self, text, lang, voice, render, extension=None):
+        """Return a cached file, calling render(text, path) to synthesize on a miss"""
+        path = self.get(text, lang, voice, extension)
+        if path:
+            return path
+        self.misses += 1
+        path = self.path_for(text, lang, voice, extension)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            render(text, tmp_path)
+            # Atomic so a player never sees a half-written file
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used clips until the directory fits max_bytes"""
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            return total
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
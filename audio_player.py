@@ -0,0 +1,297 @@
+"""
+Long-lived audio playback service.
+
+A single worker drains a priority queue of announcements and hands each
+clip to a persistent sink: one mpg123 in remote-control mode for MP3 and
+one raw-PCM aplay for WAV, so no process is forked per phrase. Reminders
+are re-armed on the worker's timer heap instead of sleeping threads.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import subprocess
+import threading
+import time
+import wave
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+PLAYBACK_SECONDS = metrics.histogram('dispenser_audio_playback_seconds', 'Time spent playing each announcement',
+                                     buckets=(0.5, 1, 2, 5, 10, 20, 30, 60))
+
+URGENT = 0
+NORMAL = 1
+REMINDER = 2
+
+
+class Announcement:
+    """A clip waiting to be played, optionally repeated and followed by others"""
+
+    def __init__(self, path, priority=NORMAL, key=None, repeat=1, gap=0):
+        self.path = path
+        self.priority = priority
+        self.key = key or path
+        self.remaining = repeat
+        self.gap = gap
+        self.followups = []  # (delay, announcement) armed after the last repeat
+        self.cancelled = False
+        self.done = False
+
+
+class Mpg123Sink:
+    """One mpg123 process in remote-control mode (-R) playing every MP3"""
+
+    def __init__(self, command=('mpg123', '-R')):
+        self.command = list(command)
+        self._proc = None
+
+    def _ensure(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        return self._proc
+
+    def play(self, path, stop_event):
+        proc = self._ensure()
+        proc.stdin.write(f"LOAD {os.path.abspath(path)}\n")
+        proc.stdin.flush()
+        for line in proc.stdout:
+            # @P 0 is sent when the track ends or is stopped
+            if line.startswith('@P 0'):
+                return not stop_event.is_set()
+            if line.startswith('@E'):
+                raise RuntimeError(f"mpg123: {line.strip()}")
+        self._proc = None
+        raise RuntimeError("mpg123 exited during playback")
+
+    def stop(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.stdin.write("STOP\n")
+            self._proc.stdin.flush()
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc = None
+
+
+class PcmSink:
+    """One aplay process fed raw PCM frames for every WAV clip"""
+
+    def __init__(self, rate=22050, channels=1, sampwidth=2):
+        self.format = (rate, channels, sampwidth)
+        self._proc = None
+
+    def _ensure(self):
+        if self._proc is None or self._proc.poll() is not None:
+            rate, channels, _ = self.format
+            self._proc = subprocess.Popen(['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', str(channels),
+                                           '-r', str(rate), '-'], stdin=subprocess.PIPE)
+        return self._proc
+
+    def play(self, path, stop_event):
+        with wave.open(path) as wav_file:
+            if (wav_file.getframerate(), wav_file.getnchannels(), wav_file.getsampwidth()) != self.format:
+                # Rare voice with another sample format, play it on its own
+                subprocess.run(['aplay', '-q', path])
+                return True
+            rate = self.format[0]
+            duration = wav_file.getnframes() / rate
+            proc = self._ensure()
+            started = time.monotonic()
+            while not stop_event.is_set():
+                chunk = wav_file.readframes(rate // 10)
+                if not chunk:
+                    break
+                proc.stdin.write(chunk)
+            proc.stdin.flush()
+        # Writes return once the pipe has room, wait for the buffered tail
+        stop_event.wait(max(0.0, started + duration - time.monotonic()))
+        return not stop_event.is_set()
+
+    def stop(self):
+        pass
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc = None
+
+
+class NullSink:
+    """Records what would have been played, for tests and simulation"""
+
+    def __init__(self, seconds=0.0):
+        self.seconds = seconds
+        self.played = []
+
+    def play(self, path, stop_event):
+        self.played.append(path)
+        stop_event.wait(self.seconds)
+        return not stop_event.is_set()
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def default_sinks():
+    return {'mp3': Mpg123Sink(), 'wav': PcmSink()}
+
+
+class AudioPlayer:
+    """Priority queue of announcements played by one worker thread"""
+
+    def __init__(self, sinks=None, clock=time.monotonic):
+        self.sinks = sinks if sinks is not None else default_sinks()
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._queue = []    # (priority, seq, announcement)
+        self._timers = []   # (due, seq, announcement)
+        self._pending = {}  # key -> queued announcement, for deduplication
+        self._seq = itertools.count()
+        self._stop = threading.Event()
+        self._current = None
+        self._running = False
+        self._thread = None
+        self.stats = {'played': 0, 'deduplicated': 0, 'interrupted': 0, 'errors': 0, 'playback_time': 0.0}
+
+    def say(self, path, priority=NORMAL, key=None, repeat=1, gap=0, delay=0, after=None):
+        """Queue a clip, or arm it delay seconds after `after` finishes
+
+        Returns the queued announcement, which is the already pending one
+        when an identical announcement is waiting.
+        """
+        announcement = Announcement(path, priority, key, repeat, gap)
+        with self._cond:
+            self._start_locked()
+            if after is not None and after.cancelled:
+                announcement.cancelled = True  # Followups of a cancelled clip are dropped with it
+            elif after is not None and not after.done:
+                after.followups.append((delay, announcement))
+            elif delay > 0:
+                heapq.heappush(self._timers, (self.clock() + delay, next(self._seq), announcement))
+            else:
+                announcement = self._enqueue_locked(announcement)
+            self._cond.notify()
+        return announcement
+
+    def _enqueue_locked(self, announcement):
+        pending = self._pending.get(announcement.key)
+        if pending is not None and not pending.cancelled:
+            self.stats['deduplicated'] += 1
+            return pending
+        self._pending[announcement.key] = announcement
+        heapq.heappush(self._queue, (announcement.priority, next(self._seq), announcement))
+        return announcement
+
+    def _start_locked(self):
+        if not self._running:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='audio-player', daemon=True)
+            self._thread.start()
+
+    def interrupt(self):
+        """Stop the clip that is playing now, queued clips continue"""
+        with self._cond:
+            current = self._current
+        if current is not None:
+            self._stop.set()
+            self._sink_for(current.path).stop()
+
+    def cancel(self, key):
+        """Drop every pending, armed or playing announcement with this key"""
+        with self._cond:
+            for _, _, announcement in self._queue + self._timers:
+                if announcement.key == key:
+                    announcement.cancelled = True
+            playing = self._current is not None and self._current.key == key
+            if playing:
+                self._current.cancelled = True
+        if playing:
+            self.interrupt()
+
+    def _sink_for(self, path):
+        return self.sinks[os.path.splitext(path)[1].lstrip('.').lower()]
+
+    def _next_announcement(self):
+        with self._cond:
+            while self._running:
+                now = self.clock()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, announcement = heapq.heappop(self._timers)
+                    if not announcement.cancelled:
+                        self._enqueue_locked(announcement)
+                if self._queue:
+                    _, _, announcement = heapq.heappop(self._queue)
+                    if self._pending.get(announcement.key) is announcement:
+                        del self._pending[announcement.key]
+                    if announcement.cancelled:
+                        continue
+                    self._current = announcement
+                    self._stop.clear()
+                    return announcement
+                self._cond.wait(self._timers[0][0] - now if self._timers else None)
+        return None
+
+    def _run(self):
+        while True:
+            announcement = self._next_announcement()
+            if announcement is None:
+                return
+            started = time.perf_counter()
+            try:
+                completed = self._sink_for(announcement.path).play(announcement.path, self._stop)
+            except Exception as e:
+                log.error("Error playing %s: %s", announcement.path, e)
+                self.stats['errors'] += 1
+                completed = None
+            elapsed = time.perf_counter() - started
+            self.stats['playback_time'] += elapsed
+            PLAYBACK_SECONDS.observe(elapsed)
+            with self._cond:
+                self._current = None
+                if completed:
+                    self.stats['played'] += 1
+                elif completed is False:
+                    self.stats['interrupted'] += 1
+                if announcement.cancelled:
+                    # Only cancel() drops the followups
+                    announcement.done = True
+                    continue
+                announcement.remaining -= 1
+                now = self.clock()
+                if completed and announcement.remaining > 0:
+                    heapq.heappush(self._timers, (now + announcement.gap, next(self._seq), announcement))
+                else:
+                    # A failed or interrupted clip still releases what was waiting for it
+                    announcement.done = True
+                    for delay, followup in announcement.followups:
+                        heapq.heappush(self._timers, (now + delay, next(self._seq), followup))
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is queued, armed or playing, for tests and shutdown"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if not self._queue and not self._timers and self._current is None:
+                    return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self.interrupt()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        for sink in self.sinks.values():
+            sink.close()
@@ -0,0 +1,148 @@
+"""
+Shared SQLite connection layer.
+
+Connections are pooled and reused instead of opened and closed for every
+query. Each one runs in WAL mode with synchronous=NORMAL and a busy
+timeout, and keeps its own prepared statement cache. A thread that is
+inside transaction() keeps the same connection for nested calls.
+"""
+
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+TRANSACTION_SECONDS = metrics.histogram('dispenser_db_transaction_seconds',
+                                        'Time spent inside SQLite transactions by calling function', ['caller'])
+
+
+def _caller():
+    """Qualified name of the function that opened the transaction, e.g. TrayManager.reset_tray"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__') in ('db', 'contextlib'):
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+
+
+class Database:
+    """Pool of SQLite connections to one database file"""
+
+    def __init__(self, path, pool_size=8, busy_timeout=5000, cached_statements=256):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {'transactions': 0, 'connections_opened': 0, 'total_time': 0.0}
+
+    def _open(self):
+        # Connections move between Flask's short-lived request threads through the pool
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000,
+                               cached_statements=self.cached_statements, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute('PRAGMA foreign_keys = ON')
+        with self._lock:
+            self.stats['connections_opened'] += 1
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Yield a cursor, commit on success and roll back on error
+
+        Nested calls on the same thread share the outer transaction.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn.cursor()
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        started = time.perf_counter()
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn)
+            elapsed = time.perf_counter() - started
+            TRANSACTION_SECONDS.observe(elapsed, _caller())
+            self._local.request_time = getattr(self._local, 'request_time', 0.0) + elapsed
+            with self._lock:
+                self.stats['transactions'] += 1
+                self.stats['total_time'] += elapsed
+
+    def query(self, query, args=(), one=False):
+        with self.transaction() as cursor:
+            cursor.execute(query, args)
+            rv = cursor.fetchall()
+        return (rv[0] if rv else None) if one else rv
+
+    def reset_request_time(self):
+        self._local.request_time = 0.0
+
+    def request_time(self):
+        """Seconds this thread has spent in transactions since reset_request_time()"""
+        return getattr(self._local, 'request_time', 0.0)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def benchmark(path, iterations=500):
+    """Compare connect-per-query with the pooled connections on a typical page query"""
+    query = '''
+        SELECT ts.tray_number, ts.description, ts.dispense_time, ts.dispense_count,
+               ts.name, u.username
+        FROM tray_settings ts
+        LEFT JOIN users u ON ts.user_id = u.id
+    '''
+    start = time.perf_counter()
+    for _ in range(iterations):
+        conn = sqlite3.connect(path)
+        conn.execute(query).fetchall()
+        conn.close()
+    per_connect = (time.perf_counter() - start) / iterations
+
+    db = Database(path)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        db.query(query)
+    pooled = (time.perf_counter() - start) / iterations
+    db.close()
+
+    print(f"connect per query: {per_connect * 1000:.3f} ms, pooled: {pooled * 1000:.3f} ms")
+    return per_connect, pooled
+
+
+if __name__ == '__main__':
+    # Usage: python db.py [users.db]
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'users.db')
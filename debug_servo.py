@@ -4,21 +4,19 @@ import time
 if __name__ == "__main__":
     print("Starting servo debug test...")
     controller = get_servo_controller()
+    trays = controller.registry.numbers()
     try:
-        print("Resetting both Tray 1 and Tray 2 to 0 at start")
-        controller._move_servo(controller.servo1, 0)
-        controller._move_servo(controller.servo2, 0)
+        print(f"Resetting trays {trays} to 0 at start")
+        for tray_number in trays:
+            controller.move(tray_number, 0)
         time.sleep(2)
-        print("Both trays set to 0 at start.")
-        print("Moving Tray 1 to 130")
-        controller._move_servo(controller.servo1, 0)
-        print("Tray 1 angle test complete.")
-
-        print("Moving Tray 2 to 130")
-        controller._move_servo(controller.servo2, 0)
-        print("Tray 2 angle test complete.")
+        print("All trays set to 0 at start.")
+        for tray_number in trays:
+            print(f"Moving Tray {tray_number} to 130")
+            controller.move(tray_number, 0)
+            print(f"Tray {tray_number} angle test complete.")
     finally:
-        print("Resetting both Tray 1 and Tray 2 to 0")
-        controller._move_servo(controller.servo1, 0)
-        controller._move_servo(controller.servo2, 0)
-        print("Both trays set to 0.") 
\ No newline at end of file
+        print(f"Resetting trays {trays} to 0")
+        for tray_number in trays:
+            controller.move(tray_number, 0)
+        print("All trays set to 0.") 
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""
+Concurrent tray actuation.
+
+Doses for different trays may move at the same time, but never two doses
+for the same tray, and never more servos at once than the power supply
+can feed (SERVO_POWER_BUDGET). The tray lock covers a whole dose, the
+power budget only the servo motion, so a tray busy with the database
+does not hold power another tray could use. Each dose records how late
+its servo started against the scheduled dispense time.
+"""
+
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from scheduler import SystemClock, seconds_between
+
+# Servos allowed to move at once, an SG90 stalls at ~650 mA
+SERVO_POWER_BUDGET = int(os.getenv('SERVO_POWER_BUDGET', '2'))
+
+
+class DispenseExecutor:
+    """Per-tray locks plus a power budget shared by every motion worker"""
+
+    def __init__(self, max_parallel=SERVO_POWER_BUDGET, clock=None, history=100):
+        self.max_parallel = max(1, max_parallel)
+        self.clock = clock or SystemClock()
+        self._power = threading.BoundedSemaphore(self.max_parallel)
+        self._tray_locks = {}
+        self._lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.dispatched = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.recent = deque(maxlen=history)  # (tray number, due, started, lateness)
+
+    def tray_lock(self, tray_number):
+        with self._lock:
+            lock = self._tray_locks.get(tray_number)
+            if lock is None:
+                lock = self._tray_locks[tray_number] = threading.Lock()
+            return lock
+
+    @contextmanager
+    def power(self, job):
+        """Hold one unit of power budget while the servo moves"""
+        with self._power:
+            started = self.clock.now()
+            lateness = max(0.0, seconds_between(job.due, started)) if job.due else 0.0
+            with self._lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                self.dispatched += 1
+                self.total_lateness += lateness
+                self.max_lateness = max(self.max_lateness, lateness)
+                self.recent.append((job.tray_number, job.due, started, lateness))
+            job.started = started
+            job.lateness = lateness
+            try:
+                yield
+            finally:
+                job.finished = self.clock.now()
+                with self._lock:
+                    self.active -= 1
+
+    @contextmanager
+    def slot(self, job):
+        """Hold the tray and one unit of power budget, for a dose that is nothing but motion"""
+        with self.tray_lock(job.tray_number), self.power(job):
+            yield
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_parallel': self.max_parallel,
+                'active': self.active,
+                'max_active': self.max_active,
+                'dispatched': self.dispatched,
+                'avg_lateness': round(self.total_lateness / self.dispatched, 3) if self.dispatched else 0.0,
+                'max_lateness': round(self.max_lateness, 3),
+                'recent': [{'tray_number': tray_number,
+                            'due': due.isoformat() if due else None,
+                            'started': started.isoformat(),
+                            'lateness': round(lateness, 3)}
+                           for tray_number, due, started, lateness in self.recent],
+            }
@@ -0,0 +1,194 @@
+"""
+Write-ahead dispense journal.
+
+Every scheduled dose is tracked in the dispense_journal table, one
+transaction per step:
+
+    intent     committed with the tray's next dispense_time, before anything moves
+    actuating  committed just before the servo moves, with the dose taken from the tray
+    actuated   committed with the dispense_history row
+    announced  committed once the directions were spoken
+
+A power cut leaves each dose in the last state committed. recover() runs
+at startup, before the scheduler, and finishes every open entry without
+ever moving a servo twice for the same dose:
+
+    intent     never moved: dispensed now if still within DISPENSE_REPLAY_MINUTES
+               of its time, otherwise recorded as a missed dose
+    actuating  the servo may have moved: logged as dispensed and settled as
+               'interrupted' for a caregiver to check, never moved again
+    actuated   dispensed but not announced: the announcement is replayed if recent
+
+A tray and scheduled time have at most one entry, so a dose dispatched
+twice is journaled, and dispensed, once.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+
+import metrics
+from missed_doses import record_missed
+from recurrence import format_time, parse_time
+
+log = logging.getLogger(__name__)
+
+DISPENSE_REPLAY_MINUTES = float(os.getenv('DISPENSE_REPLAY_MINUTES', '30'))
+
+STORED_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+INTENT = 'intent'
+ACTUATING = 'actuating'
+ACTUATED = 'actuated'
+ANNOUNCED = 'announced'
+# Final states other than announced
+SKIPPED = 'skipped'
+EXPIRED = 'expired'
+INTERRUPTED = 'interrupted'
+UNANNOUNCED = 'unannounced'
+
+OPEN_STATES = (INTENT, ACTUATING, ACTUATED)
+
+JOURNAL_SETTLED = metrics.counter('dispenser_journal_settled_total', 'Dispense journal entries by final state', ['state'])
+JOURNAL_RECOVERED = metrics.counter('dispenser_journal_recovered_total',
+                                    'Journal entries left open by a restart, by the state they were found in',
+                                    ['state'])
+
+
+def create_dispense_journal_table(cursor):
+    """Schema migration for the dispense_journal table"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dispense_journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tray_id INTEGER,
+            tray_number INTEGER,
+            medicine TEXT,
+            scheduled_time TEXT,
+            state TEXT,
+            note TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_dispense_journal_dose ON dispense_journal(tray_id, scheduled_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dispense_journal_state ON dispense_journal(state)')
+
+
+class DispenseJournal:
+    """Dose state transitions, each inside the caller's transaction"""
+
+    def __init__(self, db, clock=datetime.now, replay_window=None, fault=None):
+        self.db = db
+        self.clock = clock
+        self.replay_window = timedelta(minutes=DISPENSE_REPLAY_MINUTES) if replay_window is None else replay_window
+        # Fault injection: called with the step name just before it commits, raise to lose power there
+        self.fault = fault or (lambda step: None)
+
+    def _now(self):
+        return self.clock().strftime(STORED_FORMAT)
+
+    def _move(self, cursor, entry_id, from_states, state, note=None):
+        cursor.execute(f'''
+            UPDATE dispense_journal SET state = ?, note = COALESCE(?, note), updated_at = ?
+            WHERE id = ? AND state IN ({', '.join('?' for _ in from_states)})
+        ''', (state, note, self._now(), entry_id) + tuple(from_states))
+        return cursor.rowcount == 1
+
+    def record_intent(self, cursor, tray_id, tray_number, medicine, scheduled):
+        """Journal a dose about to be dispatched, None if this dose already has an entry"""
+        now = self._now()
+        cursor.execute('''
+            INSERT OR IGNORE INTO dispense_journal
+                (tray_id, tray_number, medicine, scheduled_time, state, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (tray_id, tray_number, medicine, format_time(scheduled, STORED_FORMAT), INTENT, now, now))
+        entry_id = cursor.lastrowid if cursor.rowcount == 1 else None
+        self.fault(INTENT)
+        return entry_id
+
+    def begin_motion(self, cursor, entry_id):
+        """Claim the dose for the servo, False if it has already moved or been settled"""
+        claimed = self._move(cursor, entry_id, (INTENT,), ACTUATING)
+        self.fault(ACTUATING)
+        return claimed
+
+    def actuated(self, cursor, entry_id):
+        """The pills dropped: log the dose, returns the tray's dispense count"""
+        count = self._log_dose(cursor, entry_id)
+        self._move(cursor, entry_id, (ACTUATING,), ACTUATED)
+        self.fault(ACTUATED)
+        return count
+
+    def announced(self, cursor, entry_id):
+        if self._move(cursor, entry_id, (ACTUATED,), ANNOUNCED):
+            JOURNAL_SETTLED.inc(ANNOUNCED)
+        self.fault(ANNOUNCED)
+
+    def interrupted(self, cursor, entry_id, note):
+        """The servo may have moved: log the dose rather than risk moving it again"""
+        self._log_dose(cursor, entry_id)
+        return self.settle(cursor, entry_id, INTERRUPTED, note)
+
+    def settle(self, cursor, entry_id, state, note=None):
+        """Close an open entry without dispensing, e.g. an empty tray"""
+        if self._move(cursor, entry_id, OPEN_STATES, state, note):
+            JOURNAL_SETTLED.inc(state)
+            return True
+        return False
+
+    def _log_dose(self, cursor, entry_id):
+        cursor.execute('SELECT tray_id, tray_number, medicine FROM dispense_journal WHERE id = ?', (entry_id,))
+        tray_id, tray_number, medicine = cursor.fetchone()
+        cursor.execute('''
+            SELECT ts.dispense_count, ts.user_id, u.username
+            FROM tray_settings ts LEFT JOIN users u ON ts.user_id = u.id
+            WHERE ts.id = ?
+        ''', (tray_id,))
+        count, user_id, username = cursor.fetchone() or (None, None, None)
+        cursor.execute('''
+            INSERT INTO dispense_history (user_id, username, tray_number, medicine_description, dispense_time)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, username, tray_number, medicine, self._now()))
+        return count
+
+    def recover(self):
+        """Finish the entries a crash left open, returns [(entry, pipeline stage to replay from)]"""
+        now = self.clock()
+        replay = []
+        with self.db.transaction() as cursor:
+            cursor.execute(f'''
+                SELECT id, tray_id, tray_number, medicine, scheduled_time, state
+                FROM dispense_journal WHERE state IN ({', '.join('?' for _ in OPEN_STATES)})
+                ORDER BY id
+            ''', OPEN_STATES)
+            for entry_id, tray_id, tray_number, medicine, scheduled_time, state in cursor.fetchall():
+                scheduled = parse_time(scheduled_time, STORED_FORMAT)
+                entry = {'id': entry_id, 'tray_id': tray_id, 'tray_number': tray_number,
+                         'medicine': medicine, 'scheduled': scheduled, 'state': state}
+                recent = now.timestamp() - scheduled.timestamp() <= self.replay_window.total_seconds()
+                JOURNAL_RECOVERED.inc(state)
+                if state == INTENT and recent:
+                    replay.append((entry, 'motion'))
+                elif state == INTENT:
+                    self.settle(cursor, entry_id, EXPIRED, 'Power lost before dispensing')
+                    record_missed(cursor, tray_id, tray_number, medicine, [scheduled], 'expired')
+                elif state == ACTUATING:
+                    # Whether the pills dropped is unknown, moving again could double the dose
+                    self.interrupted(cursor, entry_id, 'Power lost while the servo was moving')
+                    log.warning("Tray %s lost power mid-dispense of %s scheduled %s, logged as dispensed",
+                                tray_number, medicine, scheduled, extra={'tray': tray_number})
+                elif recent:
+                    replay.append((entry, 'information'))
+                else:
+                    self.settle(cursor, entry_id, UNANNOUNCED, 'Power lost before the announcement')
+        if replay:
+            log.info("Replaying %s dispense journal entries", len(replay))
+        return replay
+
+    def entries(self, limit=100):
+        rows = self.db.query('''
+            SELECT id, tray_number, medicine, scheduled_time, state, note, updated_at
+            FROM dispense_journal ORDER BY id DESC LIMIT ?
+        ''', (limit,))
+        return [dict(zip(('id', 'tray_number', 'medicine', 'scheduled_time', 'state', 'note', 'updated_at'), row))
+                for row in rows]
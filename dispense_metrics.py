@@ -0,0 +1,160 @@
+"""
+Per-dose dispense timings.
+
+Every dose that leaves the dispense pipeline is recorded with its
+scheduled and actual time, motion queue wait and the time spent in
+motion, drug lookup and speech. Recent doses are kept in a ring buffer
+for the percentiles, and every dose is stored in the dispense_metrics
+table for longer-term review.
+"""
+
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+from scheduler import seconds_between
+
+# Service level objective: a dose is on time if its pills drop within this many seconds of schedule
+DOSE_SLO_SECONDS = float(os.getenv('DOSE_SLO_SECONDS', '5'))
+
+# Timings summarised by percentiles, in seconds
+METRICS = ('lateness', 'delivery', 'queue_wait', 'motion', 'lookup', 'speech')
+
+# Upper bounds of the delivery histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 30, 60, 300)
+
+COLUMNS = ('tray_number', 'medicine', 'scheduled_time', 'started_time', 'dispensed') + METRICS
+
+
+def create_metrics_table(cursor):
+    """Schema migration for the dispense_metrics table"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dispense_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tray_number INTEGER,
+            medicine TEXT,
+            scheduled_time TEXT,
+            started_time TEXT,
+            dispensed BOOLEAN,
+            lateness REAL,
+            delivery REAL,
+            queue_wait REAL,
+            motion REAL,
+            lookup REAL,
+            speech REAL,
+            recorded_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dispense_metrics_recorded_at ON dispense_metrics(recorded_at)')
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))  # ceil
+    return sorted_values[int(rank) - 1]
+
+
+def timings_of(job):
+    """Metric values in seconds for one finished DispenseJob, None where a stage did not run"""
+    def stage(name, part):
+        return job.timings[name][part] if name in job.timings else None
+
+    delivery = None
+    if job.due and job.finished:
+        delivery = max(0.0, seconds_between(job.due, job.finished))
+    return {
+        'lateness': job.lateness if job.due else None,
+        'delivery': delivery,
+        'queue_wait': stage('motion', 0),
+        'motion': stage('motion', 1),
+        'lookup': stage('information', 1),
+        'speech': stage('announcement', 1),
+    }
+
+
+class DispenseMetrics:
+    """Ring buffer of recent dose timings, persisted to dispense_metrics"""
+
+    def __init__(self, db=None, capacity=1000, slo_seconds=DOSE_SLO_SECONDS):
+        self.db = db
+        self.slo_seconds = slo_seconds
+        self._doses = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def record(self, job):
+        """Pipeline on_complete hook"""
+        dose = {
+            'tray_number': job.tray_number,
+            'medicine': job.medicine_name,
+            'scheduled_time': job.due.strftime('%Y-%m-%d %H:%M:%S') if job.due else None,
+            'started_time': job.started.strftime('%Y-%m-%d %H:%M:%S') if job.started else None,
+            'dispensed': bool(job.dispensed),
+        }
+        dose.update(timings_of(job))
+        self.add(dose)
+        return dose
+
+    def add(self, dose):
+        with self._lock:
+            self._doses.append(dose)
+        if self.db is not None:
+            with self.db.transaction() as cursor:
+                cursor.execute(f'''
+                    INSERT INTO dispense_metrics ({', '.join(COLUMNS)}, recorded_at)
+                    VALUES ({', '.join('?' for _ in COLUMNS)}, ?)
+                ''', [dose[c] for c in COLUMNS] + [datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
+
+    def load_recent(self):
+        """Refill the ring buffer from the table after a restart"""
+        if self.db is None:
+            return 0
+        rows = self.db.query(f'''
+            SELECT {', '.join(COLUMNS)} FROM dispense_metrics ORDER BY id DESC LIMIT ?
+        ''', (self._doses.maxlen,))
+        with self._lock:
+            self._doses.clear()
+            for row in reversed(rows):
+                self._doses.append(dict(zip(COLUMNS, row)))
+        return len(rows)
+
+    def doses(self):
+        with self._lock:
+            return list(self._doses)
+
+    def summary(self):
+        """p50/p95/p99 of every metric, the delivery histogram and SLO attainment"""
+        doses = self.doses()
+        percentiles = {}
+        for metric in METRICS:
+            values = sorted(d[metric] for d in doses if d[metric] is not None)
+            percentiles[metric] = {
+                'count': len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+                'max': values[-1] if values else None,
+            }
+
+        delivered = [d['delivery'] for d in doses if d['dispensed'] and d['delivery'] is not None]
+        histogram = []
+        lower = 0
+        for upper in HISTOGRAM_BUCKETS + (None,):
+            count = sum(1 for v in delivered if v >= lower and (upper is None or v < upper))
+            histogram.append({'below': upper, 'count': count})
+            lower = upper
+        on_time = sum(1 for v in delivered if v <= self.slo_seconds)
+        return {
+            'doses': len(doses),
+            'dispensed': sum(1 for d in doses if d['dispensed']),
+            'percentiles': percentiles,
+            'delivery_histogram': histogram,
+            'slo': {
+                'target_seconds': self.slo_seconds,
+                'on_time': on_time,
+                'measured': len(delivered),
+                'percent': round(100.0 * on_time / len(delivered), 2) if delivered else None,
+            },
+        }
@@ -0,0 +1,169 @@
+"""
+Staged dispense pipeline.
+
+Motion, drug information lookup and announcement each run on their own
+workers with a bounded queue, so the scheduler only waits for the servo.
+The motion stage can run several workers so trays actuate concurrently.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DispenseJob:
+    """A single dose travelling through the pipeline"""
+
+    def __init__(self, tray_id, tray_number, medicine_name, due=None, journal_id=None):
+        self.tray_id = tray_id
+        self.tray_number = tray_number
+        self.medicine_name = medicine_name
+        # Extract just the brand name for drug lookup (remove dosage info)
+        self.brand_name = medicine_name.split()[0] if medicine_name else ""
+        self.directions = None
+        self.dispensed = False
+        self.error = None
+        self.timings = {}  # stage name -> (queue wait, run time) in seconds
+        self.motion_done = threading.Event()
+        self.enqueued_at = None
+        self.due = due  # Scheduled dispense time, for lateness
+        self.started = None  # When the servo actually started moving
+        self.finished = None  # When the pills had dropped
+        self.lateness = None
+        self.journal_id = journal_id  # dispense_journal entry tracking this dose across restarts
+
+    def wait_for_motion(self, timeout=None):
+        """Block until the pills have dropped, returns whether they did"""
+        self.motion_done.wait(timeout)
+        return self.dispensed
+
+
+class PipelineStage:
+    """Worker threads draining a bounded queue"""
+
+    def __init__(self, name, handler, maxsize=16, workers=1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.next_stage = None
+        self.on_complete = None  # Called with each job that leaves the pipeline here
+        self.processed = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"pipeline-{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def put(self, job, timeout=None):
+        job.enqueued_at = time.perf_counter()
+        # Blocks when full so a slow downstream stage applies backpressure
+        self.queue.put(job, timeout=timeout)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            started = time.perf_counter()
+            try:
+                proceed = self.handler(job)
+            except Exception as e:
+                log.error("Error in %s stage for Tray %s: %s", self.name, job.tray_number, e,
+                          extra={'stage': self.name, 'tray': job.tray_number})
+                with self._lock:
+                    self.errors += 1
+                job.error = e
+                proceed = False
+            elapsed = time.perf_counter() - started
+            job.timings[self.name] = (started - job.enqueued_at, elapsed)
+            with self._lock:
+                self.processed += 1
+                self.total_latency += elapsed
+                self.last_latency = elapsed
+                self.max_latency = max(self.max_latency, elapsed)
+            if self.name == 'motion':
+                job.motion_done.set()
+            if proceed is not False and self.next_stage is not None:
+                self.next_stage.put(job)
+            elif self.on_complete is not None:
+                try:
+                    self.on_complete(job)
+                except Exception as e:
+                    log.error("Error completing dose for Tray %s: %s", job.tray_number, e, extra={'tray': job.tray_number})
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'workers': self.workers,
+            'processed': self.processed,
+            'errors': self.errors,
+            'last_latency': round(self.last_latency, 4),
+            'avg_latency': round(self.total_latency / self.processed, 4) if self.processed else 0.0,
+            'max_latency': round(self.max_latency, 4),
+        }
+
+
+class DispensePipeline:
+    """Motion -> information -> announcement"""
+
+    def __init__(self, motion, information, announcement, maxsize=16, motion_workers=1, on_complete=None):
+        self.stages = [
+            PipelineStage('motion', motion, maxsize, motion_workers),
+            PipelineStage('information', information, maxsize),
+            PipelineStage('announcement', announcement, maxsize),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+        for stage in self.stages:
+            stage.on_complete = on_complete
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if not self._started:
+                for stage in self.stages:
+                    stage.start()
+                self._started = True
+
+    def submit(self, job, timeout=None, stage='motion'):
+        """Queue a dose for dispensing, starting the workers on first use
+
+        A later stage replays only the rest of a dose, e.g. the announcement
+        of one that was dispensed before a restart.
+        """
+        self.start()
+        first = next(s for s in self.stages if s.name == stage)
+        if first is not self.stages[0]:
+            job.motion_done.set()
+        first.put(job, timeout=timeout)
+        return job
+
+    def stop(self):
+        with self._lock:
+            for stage in self.stages:
+                stage.stop()
+            self._started = False
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
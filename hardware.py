@@ -0,0 +1,128 @@
+"""
+Real or simulated dispenser hardware.
+
+DISPENSER_HARDWARE=sim runs the app on any machine: servos go to the
+recording SimulatedServoDriver and SPI to SimulatedSpiDev, neither of which
+needs RPi.GPIO or spidev installed. simulate() drives the scheduler,
+dispense pipeline and servos on a virtual clock to load-test the dispense
+flow far faster than real time.
+"""
+
+import logging
+import os
+import sys
+import time
+import types
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+DISPENSER_HARDWARE = os.getenv('DISPENSER_HARDWARE', 'pi')
+
+
+def simulated():
+    return DISPENSER_HARDWARE == 'sim'
+
+
+class SimulatedSpiDev:
+    """Drop-in for spidev.SpiDev, records every transfer and answers zeros"""
+
+    def __init__(self, bus=None, device=None):
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = []
+        if bus is not None:
+            self.open(bus, device)
+
+    def open(self, bus, device):
+        self.bus = bus
+        self.device = device
+
+    def xfer2(self, data):
+        self.transfers.append(list(data))
+        return [0] * len(data)
+
+    xfer = xfer2
+
+    def readbytes(self, count):
+        return [0] * count
+
+    def writebytes(self, data):
+        self.transfers.append(list(data))
+
+    def close(self):
+        pass
+
+
+if simulated():
+    spidev = types.SimpleNamespace(SpiDev=SimulatedSpiDev)
+else:
+    try:
+        import spidev
+    except ImportError:
+        log.warning("spidev is not installed, SPI is simulated (set DISPENSER_HARDWARE=sim to silence this)")
+        spidev = types.SimpleNamespace(SpiDev=SimulatedSpiDev)
+
+
+def simulate(trays=16, days=7, interval_hours=8, registry=None):
+    """Run every tray on its interval for some days of virtual time, returns the run statistics"""
+    from dispense_pipeline import DispensePipeline, DispenseJob
+    from rpi_servo import ServoController
+    from scheduler import DispenseScheduler, FakeClock
+    from servo_drivers import SimulatedServoDriver
+    from tray_registry import TrayRegistry
+
+    start = datetime(2024, 1, 1, 8, 0)
+    clock = FakeClock(start)
+    registry = registry or TrayRegistry([{'number': n, 'channel': n - 1, 'capacity': 10 ** 9}
+                                         for n in range(1, trays + 1)])
+    driver = SimulatedServoDriver(clock)
+    controller = ServoController(registry, driver, clock)
+    schedule = {tray.number: start for tray in registry}
+    end = start + timedelta(days=days)
+
+    def actuate(job):
+        controller.dispense(job.tray_number, job.medicine_name)
+        job.dispensed = True
+        return False  # Nothing to look up or announce
+
+    pipeline = DispensePipeline(actuate, lambda job: False, lambda job: False)
+    pipeline.start()
+
+    def on_due(tray_number):
+        job = pipeline.submit(DispenseJob(tray_number, tray_number, f"Tray {tray_number} medicine"))
+        job.wait_for_motion(timeout=60)
+        schedule[tray_number] += timedelta(hours=interval_hours)
+        return schedule[tray_number] if schedule[tray_number] < end else None
+
+    scheduler = DispenseScheduler(lambda: [(n, n, due) for n, due in schedule.items()], on_due, clock)
+    wall = time.perf_counter()
+    while True:
+        if scheduler.run_pending():
+            continue
+        deadline = scheduler.next_deadline()
+        if deadline is None:
+            break
+        clock.advance(max((deadline - clock.now()).total_seconds(), 0))
+    wall = time.perf_counter() - wall
+    pipeline.stop()
+
+    dispensed = scheduler.stats['dispatched']
+    stats = {
+        'dispenses': dispensed,
+        'servo_moves': len(driver.moves),
+        'simulated_hours': round((clock.now() - start).total_seconds() / 3600, 2),
+        'wall_seconds': round(wall, 3),
+        'dispenses_per_second': round(dispensed / wall, 1) if wall > 0 else 0.0,
+        'max_lateness': scheduler.stats['max_lateness'],
+    }
+    print(f"Simulated {dispensed} dispenses over {stats['simulated_hours']} hours in "
+          f"{stats['wall_seconds']:.2f}s ({stats['dispenses_per_second']:.0f}/s), "
+          f"max lateness {stats['max_lateness']:.1f}s")
+    return stats
+
+
+if __name__ == '__main__':
+    # Usage: python hardware.py [trays] [days]
+    simulate(int(sys.argv[1]) if len(sys.argv) > 1 else 16,
+             int(sys.argv[2]) if len(sys.argv) > 2 else 7)
@@ -0,0 +1,97 @@
+"""
+Tray inventory and refill forecasting.
+
+A tray holds tray_settings.capacity doses when the caregiver loaded
+fewer than it can take, otherwise the capacity of the tray in the
+registry. take_dose() counts a dose out with one conditional UPDATE, so
+concurrent workers can never take the last dose twice and an empty tray
+is refused without reading the count first.
+
+forecast_trays() works out, for every tray in one query, when the last
+dose left will be dispensed according to the tray's compiled schedule.
+A tray is due for a refill once that is within REFILL_ALERT_DAYS.
+claim_refill_alert() lets the alert go out once per filling, the flag
+is cleared when the tray is reset or saved again.
+"""
+
+import os
+from datetime import timedelta
+
+from recurrence import load_rule, parse_time
+
+REFILL_ALERT_DAYS = float(os.getenv('REFILL_ALERT_DAYS', '3'))
+
+
+def parse_capacity(text, tray_capacity):
+    """Doses loaded as typed on the setup form, None to fill the tray to its capacity"""
+    if text is None or not str(text).strip():
+        return None
+    try:
+        capacity = int(text)
+    except ValueError:
+        raise ValueError("Doses loaded must be a whole number") from None
+    if not 1 <= capacity <= tray_capacity:
+        raise ValueError(f"Doses loaded must be between 1 and {tray_capacity}, the capacity of the tray")
+    return capacity
+
+
+def take_dose(cursor, tray_id, tray_capacity):
+    """Count one dose out of a tray, False if it is empty or no longer set up"""
+    cursor.execute('''
+        UPDATE tray_settings SET dispense_count = dispense_count + 1
+        WHERE id = ? AND dispense_count < COALESCE(capacity, ?)
+    ''', (tray_id, tray_capacity))
+    return cursor.rowcount == 1
+
+
+def claim_refill_alert(cursor, tray_id):
+    """True the first time a tray's refill alert is claimed since it was filled"""
+    cursor.execute('UPDATE tray_settings SET refill_alerted = 1 WHERE id = ? AND refill_alerted = 0', (tray_id,))
+    return cursor.rowcount == 1
+
+
+def last_dose_at(rule, next_due, remaining):
+    """When the last of `remaining` doses is dispensed, starting with the one due at next_due"""
+    if remaining <= 0:
+        return None
+    if remaining == 1:
+        return next_due
+    return rule.occurrences(next_due, remaining - 1)[-1]
+
+
+def forecast_trays(db, tray_capacities, now, alert_days=REFILL_ALERT_DAYS, tray_id=None):
+    """Remaining doses and exhaustion time of every tray, or of one tray by id"""
+    query = '''
+        SELECT id, tray_number, description, dispense_time, interval, schedule, dispense_count, capacity
+        FROM tray_settings
+    '''
+    args = ()
+    if tray_id is not None:
+        query += ' WHERE id = ?'
+        args = (tray_id,)
+    rows = db.query(query + ' ORDER BY tray_number', args)
+
+    alert_window = timedelta(days=alert_days)
+    forecasts = []
+    for row_id, tray_number, description, dispense_time, interval, schedule, dispense_count, capacity in rows:
+        capacity = capacity or tray_capacities.get(tray_number)
+        remaining = max(0, capacity - (dispense_count or 0)) if capacity else None
+        empty_at = None
+        if remaining:
+            try:
+                next_due = parse_time(dispense_time)
+                empty_at = last_dose_at(load_rule(schedule, interval, next_due), next_due, remaining)
+            except (TypeError, ValueError):
+                pass  # Not scheduled, nothing to forecast
+        forecasts.append({
+            'tray_id': row_id,
+            'tray_number': tray_number,
+            'description': description,
+            'capacity': capacity,
+            'dispense_count': dispense_count,
+            'remaining': remaining,
+            'empty_at': empty_at,
+            'days_left': round((empty_at - now).total_seconds() / 86400, 1) if empty_at else None,
+            'refill_due': remaining == 0 or (empty_at is not None and empty_at - now <= alert_window),
+        })
+    return forecasts
@@ -0,0 +1,173 @@
+"""
+Persistent SQLite cache for FDA label lookups.
+
+Entries are keyed by normalized brand name. Fresh entries are served
+directly, stale ones are served while a background refresh runs, and
+"not found" answers are cached for a shorter time. The table is capped
+and the least recently used entries are evicted first.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+ERROR = 'error'
+
+LABEL_CACHE_PATH = os.getenv('LABEL_CACHE_PATH', 'label_cache.db')
+LABEL_CACHE_TTL = int(os.getenv('LABEL_CACHE_TTL', 7 * 24 * 3600))
+LABEL_CACHE_NEGATIVE_TTL = int(os.getenv('LABEL_CACHE_NEGATIVE_TTL', 24 * 3600))
+LABEL_CACHE_MAX_ENTRIES = int(os.getenv('LABEL_CACHE_MAX_ENTRIES', 500))
+
+
+def normalize_brand(brand_name):
+    return ' '.join((brand_name or '').lower().split())
+
+
+class LabelCache:
+    """Brand name -> label directions, backed by a small SQLite file"""
+
+    def __init__(self, path=LABEL_CACHE_PATH, ttl=LABEL_CACHE_TTL,
+                 negative_ttl=LABEL_CACHE_NEGATIVE_TTL, max_entries=LABEL_CACHE_MAX_ENTRIES,
+                 clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._init_db()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS fda_labels (
+            brand_key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            directions TEXT,
+            fetched_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_fda_labels_last_used ON fda_labels(last_used)')
+        conn.commit()
+        conn.close()
+
+    def get(self, brand_name, fetch):
+        """Return directions for brand_name, calling fetch(brand_name) on a miss
+
+        fetch returns (status, text) where status is FOUND, NOT_FOUND or ERROR.
+        Errors are never cached.
+        """
+        key = normalize_brand(brand_name)
+        now = self.clock()
+        conn = self._connect()
+        row = conn.execute('SELECT status, directions, fetched_at FROM fda_labels WHERE brand_key = ?',
+                           (key,)).fetchone()
+        if row:
+            conn.execute('UPDATE fda_labels SET last_used = ? WHERE brand_key = ?', (now, key))
+            conn.commit()
+        conn.close()
+
+        if row:
+            status, directions, fetched_at = row
+            ttl = self.ttl if status == FOUND else self.negative_ttl
+            if now - fetched_at < ttl:
+                self.hits += 1
+            else:
+                # Serve the stale label immediately and refresh it off the caller's thread
+                self.stale_hits += 1
+                self._refresh_async(brand_name, key, fetch)
+            return directions
+
+        self.misses += 1
+        status, directions = fetch(brand_name)
+        if status != ERROR:
+            self.put(key, status, directions)
+        return directions
+
+    def put(self, key, status, directions):
+        now = self.clock()
+        conn = self._connect()
+        conn.execute('''
+            INSERT OR REPLACE INTO fda_labels (brand_key, status, directions, fetched_at, last_used)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (key, status, directions, now, now))
+        self._evict(conn)
+        conn.commit()
+        conn.close()
+
+    def _evict(self, conn):
+        count = conn.execute('SELECT COUNT(*) FROM fda_labels').fetchone()[0]
+        if count > self.max_entries:
+            conn.execute('''
+                DELETE FROM fda_labels WHERE brand_key IN (
+                    SELECT brand_key FROM fda_labels ORDER BY last_used ASC LIMIT ?
+                )
+            ''', (count - self.max_entries,))
+
+    def refresh(self, brand_name, fetch):
+        """Fetch brand_name now and store the result, keeping the old entry on error"""
+        status, directions = fetch(brand_name)
+        if status != ERROR:
+            self.put(normalize_brand(brand_name), status, directions)
+        return status
+
+    def _refresh_async(self, brand_name, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(brand_name, fetch)
+            except Exception as e:
+                log.error("Error refreshing label cache for %s: %s", brand_name, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_fresh(self, brand_name):
+        conn = self._connect()
+        row = conn.execute('SELECT status, fetched_at FROM fda_labels WHERE brand_key = ?',
+                           (normalize_brand(brand_name),)).fetchone()
+        conn.close()
+        if not row:
+            return False
+        ttl = self.ttl if row[0] == FOUND else self.negative_ttl
+        return self.clock() - row[1] < ttl
+
+    def warm(self, brand_names, fetch):
+        """Pre-fetch every brand that is missing or stale, returns how many were fetched"""
+        fetched = 0
+        for brand_name in dict.fromkeys(normalize_brand(b) for b in brand_names if b):
+            if not self.is_fresh(brand_name):
+                self.refresh(brand_name, fetch)
+                fetched += 1
+        return fetched
+
+    def stats(self):
+        conn = self._connect()
+        entries = conn.execute('SELECT COUNT(*) FROM fda_labels').fetchone()[0]
+        conn.close()
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+        }
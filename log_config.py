@@ -0,0 +1,200 @@
+"""
+Structured, non-blocking logging.
+
+Modules log through logging.getLogger(__name__) with %-style arguments
+and any structured fields in extra={...}. setup_logging() routes every
+record through a bounded queue, so the calling thread (a Flask request,
+the scheduler, a motion worker) never waits on a slow journald or SD
+card; a background listener writes JSON lines to a rotating file and a
+short text line to the console.
+
+Repeated warnings and errors with the same message template are rate
+limited, and the file is flushed in batches and rotated at a small size
+to keep SD card writes down.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+LOG_FILE = os.getenv('LOG_FILE', 'dispenser.log')  # Empty to log to the console only
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_CONSOLE = os.getenv('LOG_CONSOLE', 'text')  # text, json or off
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(1024 * 1024)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '3'))
+LOG_FLUSH_SECONDS = float(os.getenv('LOG_FLUSH_SECONDS', '5'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Warnings and errors with the same template: at most RATE_LIMIT_BURST per RATE_LIMIT_PERIOD seconds
+RATE_LIMIT_BURST = int(os.getenv('LOG_RATE_LIMIT_BURST', '5'))
+RATE_LIMIT_PERIOD = float(os.getenv('LOG_RATE_LIMIT_PERIOD', '60'))
+
+# Attributes every LogRecord has, anything else came from extra={...}
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def fields_of(record):
+    """Structured fields passed with extra={...}"""
+    return {k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the extra fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        entry.update(fields_of(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop repeats of the same warning or error template beyond a burst per period"""
+
+    def __init__(self, burst=RATE_LIMIT_BURST, period=RATE_LIMIT_PERIOD, level=logging.WARNING, clock=time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.level = level
+        self.clock = clock
+        self._windows = {}  # (logger, level, template) -> [window start, emitted, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = self.clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Drop the record and count it rather than block when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Arguments may change once the call returns, render the message and traceback
+        # on the calling thread and leave the formatting to the listener
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Flush to the SD card every flush_seconds, or at once for warnings and errors"""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, flush_seconds=LOG_FLUSH_SECONDS):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self.flush_seconds = flush_seconds
+        self._last_flush = time.monotonic()
+        self._urgent = False
+
+    def emit(self, record):
+        self._urgent = record.levelno >= logging.WARNING
+        super().emit(record)
+
+    def flush(self):
+        now = time.monotonic()
+        if self._urgent or now - self._last_flush >= self.flush_seconds:
+            super().flush()
+            self._last_flush = now
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s', '%H:%M:%S')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = fields_of(record)
+        if fields:
+            line += ' ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        return line
+
+
+_listener = None
+_queue_handler = None
+
+
+def setup_logging(log_file=LOG_FILE, level=LOG_LEVEL, console=LOG_CONSOLE):
+    """Route the root logger through the queue, idempotent"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _queue_handler
+
+    handlers = []
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = BatchedRotatingFileHandler(log_file)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    if console != 'off':
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(JsonFormatter() if console == 'json' else TextFormatter())
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    _queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _queue_handler
+
+
+def stop_logging():
+    """Drain the queue and close the file"""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener = None
+    _queue_handler = None
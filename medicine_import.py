@@ -0,0 +1,135 @@
+"""
+Bulk medicine catalogue importer.
+
+Streams a CSV or JSON Lines formulary into the medicine table in batched
+transactions. Rows are upserted on the natural key (generic name, brand,
+strength, form), so re-importing an updated catalogue refreshes rows in
+place. The search index triggers are dropped for the duration of the load
+and the index is rebuilt once at the end.
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+from itertools import islice
+
+from medicine_search import create_search_index, drop_search_triggers
+
+log = logging.getLogger(__name__)
+
+FIELDS = ('generic_name', 'brand_name', 'dosage_strength', 'dosage_form',
+          'classification', 'pharmacologic_category', 'manufacturer')
+
+NATURAL_KEY = ('generic_name', 'brand_name', 'dosage_strength', 'dosage_form')
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
+
+UPSERT = f'''
+    INSERT INTO medicine ({', '.join(FIELDS)})
+    VALUES ({', '.join('?' for _ in FIELDS)})
+    ON CONFLICT ({', '.join(NATURAL_KEY)}) DO UPDATE SET
+    {', '.join(f'{f} = excluded.{f}' for f in FIELDS if f not in NATURAL_KEY)}
+'''
+
+
+def field_name(header):
+    """'Brand Name', 'brand-name' and 'BRAND_NAME' all map to brand_name"""
+    return '_'.join(str(header).lower().replace('-', ' ').replace('_', ' ').split())
+
+
+def read_records(stream, fmt):
+    """Yield (line number, record) for every record in a text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        try:
+            for record in reader:
+                yield reader.line_num, record
+        except csv.Error as e:
+            # Malformed CSV is a bad upload like a bad JSONL line, not a server error;
+            # the failing record starts after the lines read so far
+            raise ValueError(f"line {reader.line_num + 1}: {e}") from None
+    elif fmt in ('jsonl', 'json'):
+        for n, line in enumerate(stream, 1):
+            if line.strip():
+                yield n, json.loads(line)
+    else:
+        raise ValueError(f"Unsupported catalogue format: {fmt}")
+
+
+def to_row(record, n=None):
+    """Map a record onto FIELDS, returns None if it names no medicine"""
+    if not isinstance(record, dict):
+        raise ValueError(f"line {n}: expected a JSON object")
+    values = {field_name(key): value for key, value in record.items() if key is not None}
+    row = tuple(str(values.get(field) or '').strip() for field in FIELDS)
+    if not row[0] and not row[1]:
+        return None
+    return row
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    return 'jsonl' if extension in ('jsonl', 'json', 'ndjson') else 'csv'
+
+
+def import_medicines(db, stream, fmt='csv', batch_size=IMPORT_BATCH_SIZE):
+    """Load a catalogue from a text stream, returns the import statistics"""
+    stats = {'rows': 0, 'skipped': 0, 'batches': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+    started = time.perf_counter()
+    rows = (to_row(record, n) for n, record in read_records(stream, fmt))
+
+    with db.transaction() as cursor:
+        drop_search_triggers(cursor)
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            valid = [row for row in batch if row is not None]
+            stats['skipped'] += len(batch) - len(valid)
+            with db.transaction() as cursor:
+                cursor.executemany(UPSERT, valid)
+            stats['rows'] += len(valid)
+            stats['batches'] += 1
+    finally:
+        # Restores the triggers and re-indexes every batch that was committed
+        with db.transaction() as cursor:
+            create_search_index(cursor)
+
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    if stats['seconds'] > 0:
+        stats['rows_per_second'] = round(stats['rows'] / stats['seconds'], 1)
+    log.info("Imported %s medicines (%s skipped) in %.2fs, %.0f rows/s",
+             stats['rows'], stats['skipped'], stats['seconds'], stats['rows_per_second'], extra=stats)
+    return stats
+
+
+def import_file(db, path, fmt=None, batch_size=IMPORT_BATCH_SIZE):
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        return import_medicines(db, stream, fmt or detect_format(path), batch_size)
+
+
+def import_upload(db, upload, batch_size=IMPORT_BATCH_SIZE):
+    """Import an uploaded werkzeug FileStorage without reading it into memory"""
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    return import_medicines(db, stream, detect_format(upload.filename or ''), batch_size)
+
+
+if __name__ == '__main__':
+    # Usage: python medicine_import.py catalogue.csv|catalogue.jsonl [users.db]
+    from db import Database
+    from migrations import migrate
+    from log_config import setup_logging
+
+    if len(sys.argv) < 2:
+        print("Usage: python medicine_import.py CATALOGUE [DATABASE]")
+        sys.exit(1)
+    setup_logging(log_file='')
+    database = Database(sys.argv[2] if len(sys.argv) > 2 else 'users.db')
+    with database.transaction() as cursor:
+        migrate(cursor)
+    import_file(database, sys.argv[1])
@@ -0,0 +1,193 @@
+"""
+Full-text medicine search.
+
+medicine_fts indexes generic name, brand name, classification,
+pharmacologic category and manufacturer for ranked prefix queries.
+medicine_trigram uses the trigram tokenizer so misspelled queries still
+find the closest names; SQLite before 3.34 has no trigram tokenizer and
+those searches fall back to a substring LIKE. Both are external-content
+tables kept in sync with medicine by triggers. Hot queries are answered from an in-memory LRU
+that is cleared whenever the catalogue changes.
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+SEARCH_COLUMNS = ('generic_name', 'brand_name', 'classification', 'pharmacologic_category', 'manufacturer')
+
+# bm25 weights in SEARCH_COLUMNS order, a brand name hit ranks highest
+RANK_WEIGHTS = (5.0, 10.0, 1.0, 1.0, 0.5)
+
+PER_PAGE = 25
+
+
+def fts5_available(cursor, options=None):
+    """Whether this SQLite can create an FTS5 table, with options such as a tokenizer"""
+    columns = f'x, {options}' if options else 'x'
+    try:
+        cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_probe USING fts5({columns})')
+        cursor.execute('DROP TABLE temp.fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def trigram_available(cursor):
+    return fts5_available(cursor, "tokenize = 'trigram'")
+
+
+def create_search_index(cursor):
+    """Create the FTS tables and sync triggers, used by the schema migration"""
+    if not fts5_available(cursor):
+        log.warning("SQLite was built without FTS5, medicine search falls back to LIKE")
+        return
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join(f'new.{c}' for c in SEARCH_COLUMNS)
+    old_values = ', '.join(f'old.{c}' for c in SEARCH_COLUMNS)
+    tables = [('medicine_fts', "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'")]
+    if trigram_available(cursor):
+        tables.append(('medicine_trigram', "tokenize = 'trigram'"))
+    else:
+        log.warning("SQLite %s has no trigram tokenizer, misspelled medicine searches fall back to LIKE",
+                    sqlite3.sqlite_version)
+    for table, options in tables:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+                {columns}, content = 'medicine', content_rowid = 'id', {options}
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON medicine BEGIN
+                INSERT INTO {table}(rowid, {columns}) VALUES (new.id, {new_values});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON medicine BEGIN
+                INSERT INTO {table}({table}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE ON medicine BEGIN
+                INSERT INTO {table}({table}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {table}(rowid, {columns}) VALUES (new.id, {new_values});
+            END
+        ''')
+    rebuild_search_index(cursor)
+
+
+def drop_search_triggers(cursor):
+    """Stop per-row index maintenance, create_search_index() restores it"""
+    for table in ('medicine_fts', 'medicine_trigram'):
+        for suffix in ('ai', 'ad', 'au'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {table}_{suffix}')
+
+
+def rebuild_search_index(cursor):
+    """Re-index every medicine row, e.g. after a bulk import with triggers dropped"""
+    for table in ('medicine_fts', 'medicine_trigram'):
+        if has_table(cursor, table):
+            cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+
+
+def has_table(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def has_search_index(cursor):
+    return has_table(cursor, 'medicine_fts')
+
+
+def prefix_query(search_input):
+    """'para 500' -> '"para"* AND "500"*'"""
+    tokens = re.findall(r'\w+', search_input.lower())
+    return ' AND '.join(f'"{token}"*' for token in tokens)
+
+
+def trigram_query(search_input):
+    """Any shared three-letter run counts, bm25 ranks the closest names first"""
+    text = ' '.join(re.findall(r'\w+', search_input.lower()))
+    grams = dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2) if ' ' not in text[i:i + 3])
+    return ' OR '.join(f'"{gram}"' for gram in grams)
+
+
+class MedicineSearch:
+    """Ranked, paginated search over the medicine table with an LRU of hot queries"""
+
+    def __init__(self, db, cache_size=256):
+        self.db = db
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """Forget cached results, call after any change to the medicine table"""
+        with self._lock:
+            self._cache.clear()
+
+    def search(self, search_input, page=1, per_page=PER_PAGE):
+        """Return (rows, total) for one page of results"""
+        key = (' '.join(search_input.lower().split()), page, per_page)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+
+        result = self._search(key[0], page, per_page)
+
+        with self._lock:
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _search(self, search_input, page, per_page):
+        offset = (max(page, 1) - 1) * per_page
+        with self.db.transaction() as cursor:
+            if not has_search_index(cursor):
+                return self._like_search(cursor, search_input, per_page, offset)
+            match = prefix_query(search_input)
+            rows, total = self._match(cursor, 'medicine_fts', match, per_page, offset) if match else ([], 0)
+            if total == 0 and len(search_input) >= 3:
+                # No word starts with the query, fall back to typo-tolerant trigram overlap
+                if not has_table(cursor, 'medicine_trigram'):
+                    return self._like_search(cursor, search_input, per_page, offset)
+                match = trigram_query(search_input)
+                if match:
+                    rows, total = self._match(cursor, 'medicine_trigram', match, per_page, offset)
+        return rows, total
+
+    def _match(self, cursor, table, match, limit, offset):
+        weights = ', '.join(str(w) for w in RANK_WEIGHTS)
+        cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {table} MATCH ?', (match,))
+        total = cursor.fetchone()[0]
+        if total == 0:
+            return [], 0
+        cursor.execute(f'''
+            SELECT m.* FROM {table} f
+            JOIN medicine m ON m.id = f.rowid
+            WHERE {table} MATCH ?
+            ORDER BY bm25({table}, {weights}), m.id
+            LIMIT ? OFFSET ?
+        ''', (match, limit, offset))
+        return cursor.fetchall(), total
+
+    def _like_search(self, cursor, search_input, limit, offset):
+        pattern = f'%{search_input}%'
+        cursor.execute('SELECT COUNT(*) FROM medicine WHERE LOWER(brand_name) LIKE ?', (pattern,))
+        total = cursor.fetchone()[0]
+        cursor.execute('SELECT * FROM medicine WHERE LOWER(brand_name) LIKE ? ORDER BY id LIMIT ? OFFSET ?',
+                       (pattern, limit, offset))
+        return cursor.fetchall(), total
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached_queries': len(self._cache)}
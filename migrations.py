@@ -0,0 +1,209 @@
+"""
+Versioned schema migrations.
+
+The schema version is kept in PRAGMA user_version. Each migration runs
+once, in order, inside the caller's transaction. Add new migrations to the
+end of MIGRATIONS, never edit one that has shipped.
+"""
+
+import logging
+from datetime import datetime
+
+from medicine_search import create_search_index
+from dispense_metrics import create_metrics_table
+from missed_doses import create_missed_doses_table
+from dispense_journal import create_dispense_journal_table
+from recurrence import TIME_FORMAT, load_rule
+
+log = logging.getLogger(__name__)
+
+
+def table_columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+def add_column(cursor, table, column, definition):
+    """Add a column to a table created by an older release"""
+    if column not in table_columns(cursor, table):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        log.info("Added %s column to %s table", column, table)
+
+
+def move_conflicts(cursor, table, condition):
+    """Move the rows a new unique index cannot keep to {table}_conflicts, returns their ids"""
+    cursor.execute(f'SELECT id FROM {table} WHERE {condition} ORDER BY id')
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return ids
+    # Same columns as the table at this schema version, kept for review rather than deleted
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {table}_conflicts AS SELECT * FROM {table} WHERE 0')
+    cursor.execute(f'INSERT INTO {table}_conflicts SELECT * FROM {table} WHERE {condition}')
+    cursor.execute(f'DELETE FROM {table} WHERE {condition}')
+    log.warning("Moved %s conflicting %s rows to %s_conflicts, ids %s", len(ids), table, table,
+                ', '.join(map(str, ids)))
+    return ids
+
+
+def initial_schema(cursor):
+    """Tables as of the first release, plus columns added since"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        is_admin BOOLEAN DEFAULT 0
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tray_settings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        user_id INTEGER NOT NULL,
+        tray_number INTEGER NOT NULL,
+        description TEXT NOT NULL,
+        alert BOOLEAN,
+        dispense_time DATETIME,
+        interval TEXT,
+        color TEXT,
+        dispense_count INTEGER DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+
+    # Databases created before these columns existed
+    add_column(cursor, 'tray_settings', 'name', 'TEXT')
+    add_column(cursor, 'users', 'is_admin', 'BOOLEAN DEFAULT 0')
+    add_column(cursor, 'tray_settings', 'dispense_count', 'INTEGER DEFAULT 0')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS medicine (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        generic_name TEXT,
+        brand_name TEXT,
+        dosage_strength TEXT,
+        dosage_form TEXT,
+        classification TEXT,
+        pharmacologic_category TEXT,
+        manufacturer TEXT
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS dispense_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        tray_number INTEGER,
+        medicine_description TEXT,
+        dispense_time TEXT
+    )
+    ''')
+
+
+def sortable_dispense_times(cursor):
+    """Store every timestamp as zero-padded ISO text so string order is time order"""
+    # dispense_history uses 'YYYY-MM-DD HH:MM:SS', older rows may use the 'T' separator
+    cursor.execute('''
+        UPDATE dispense_history
+        SET dispense_time = strftime('%Y-%m-%d %H:%M:%S', dispense_time)
+        WHERE dispense_time IS NOT NULL
+          AND strftime('%Y-%m-%d %H:%M:%S', dispense_time) IS NOT NULL
+          AND dispense_time != strftime('%Y-%m-%d %H:%M:%S', dispense_time)
+    ''')
+    # tray_settings uses the datetime-local form value 'YYYY-MM-DDTHH:MM'
+    cursor.execute('''
+        UPDATE tray_settings
+        SET dispense_time = strftime('%Y-%m-%dT%H:%M', dispense_time)
+        WHERE dispense_time IS NOT NULL
+          AND strftime('%Y-%m-%dT%H:%M', dispense_time) IS NOT NULL
+          AND dispense_time != strftime('%Y-%m-%dT%H:%M', dispense_time)
+    ''')
+
+
+def hot_query_indexes(cursor):
+    """Indexes for the tray lookups, dashboard history and admin statistics"""
+    # A tray can only hold one prescription, the earliest row keeps the tray
+    move_conflicts(cursor, 'tray_settings', 'id NOT IN (SELECT MIN(id) FROM tray_settings GROUP BY tray_number)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_tray_settings_tray_number ON tray_settings(tray_number)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tray_settings_user_id ON tray_settings(user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dispense_history_user_time ON dispense_history(user_id, dispense_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dispense_history_time ON dispense_history(dispense_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_is_admin ON users(is_admin, username)')
+
+
+def medicine_natural_key(cursor):
+    """One row per generic name, brand, strength and form so catalogue imports can upsert"""
+    # NULLs never conflict in a unique index, only rows with the whole key can clash; the newest keeps it
+    move_conflicts(cursor, 'medicine', '''
+        generic_name IS NOT NULL AND brand_name IS NOT NULL
+        AND dosage_strength IS NOT NULL AND dosage_form IS NOT NULL
+        AND id NOT IN (SELECT MAX(id) FROM medicine
+                       GROUP BY generic_name, brand_name, dosage_strength, dosage_form)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_medicine_natural_key
+        ON medicine(generic_name, brand_name, dosage_strength, dosage_form)
+    ''')
+
+
+def tray_schedules(cursor):
+    """Structured recurrence rule per tray, compiled from the free-text interval of existing rows"""
+    add_column(cursor, 'tray_settings', 'schedule', 'TEXT')
+    cursor.execute('SELECT id, dispense_time, interval FROM tray_settings WHERE schedule IS NULL')
+    backfill = []
+    for tray_id, dispense_time, interval in cursor.fetchall():
+        try:
+            anchor = datetime.strptime(dispense_time, TIME_FORMAT)
+        except (TypeError, ValueError):
+            continue  # Never scheduled, compiled when it is next saved
+        backfill.append((load_rule(None, interval, anchor).to_json(), tray_id))
+    cursor.executemany('UPDATE tray_settings SET schedule = ? WHERE id = ?', backfill)
+    if backfill:
+        log.info("Compiled schedules for %s trays", len(backfill))
+
+
+def tray_capacity(cursor):
+    """Doses loaded per tray, NULL means the capacity of the tray in the registry"""
+    add_column(cursor, 'tray_settings', 'capacity', 'INTEGER')
+
+
+def refill_alerts(cursor):
+    """Whether the refill alert for a tray has been sent since it was last filled"""
+    add_column(cursor, 'tray_settings', 'refill_alerted', 'INTEGER NOT NULL DEFAULT 0')
+
+
+# (version, description, function)
+MIGRATIONS = [
+    (1, 'initial schema', initial_schema),
+    (2, 'sortable dispense times', sortable_dispense_times),
+    (3, 'hot query indexes', hot_query_indexes),
+    (4, 'medicine full-text search', create_search_index),
+    (5, 'medicine natural key', medicine_natural_key),
+    (6, 'dispense metrics', create_metrics_table),
+    (7, 'missed doses', create_missed_doses_table),
+    (8, 'tray schedules', tray_schedules),
+    (9, 'dispense journal', create_dispense_journal_table),
+    (10, 'tray capacity', tray_capacity),
+    (11, 'refill alerts', refill_alerts),
+]
+
+
+def schema_version(cursor):
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+def migrate(cursor):
+    """Apply every migration newer than the database, returns the final version"""
+    version = schema_version(cursor)
+    for target, description, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        migration(cursor)
+        # PRAGMA does not accept bound parameters
+        cursor.execute(f'PRAGMA user_version = {int(target)}')
+        log.info("Applied schema migration %s: %s", target, description)
+        version = target
+    return version
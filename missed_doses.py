@@ -0,0 +1,108 @@
+"""
+Missed-dose catch-up.
+
+When the dispenser has been off, a tray's stored dispense time can lie
+many occurrences in the past. Instead of stepping one occurrence per
+dispatch (and dropping a dose every few seconds until it catches up),
+plan_catch_up() asks the tray's schedule for the next future occurrence
+and decides what to do with the doses in between:
+
+    skip         dispense nothing, record every missed occurrence
+    deliver_one  dispense the most recent missed dose once, record the rest
+    alert        dispense nothing, record every missed occurrence and alert
+
+A dose within MISSED_DOSE_GRACE_MINUTES of its time is on time and is
+always dispensed, whatever the policy.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import metrics
+from recurrence import EveryRule
+
+MISSED_DOSE_POLICY = os.getenv('MISSED_DOSE_POLICY', 'deliver_one')
+MISSED_DOSE_GRACE_MINUTES = float(os.getenv('MISSED_DOSE_GRACE_MINUTES', '30'))
+
+POLICIES = ('skip', 'deliver_one', 'alert')
+
+
+def check_policy(policy):
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown missed dose policy {policy!r}, choose from {', '.join(POLICIES)}")
+
+
+# A typo in the environment stops start-up instead of failing every dispatch
+check_policy(MISSED_DOSE_POLICY)
+
+MISSED_DOSES = metrics.counter('dispenser_missed_doses_total', 'Dose occurrences not dispensed on time', ['action'])
+
+
+def create_missed_doses_table(cursor):
+    """Schema migration for the missed_doses table"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS missed_doses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tray_id INTEGER,
+            tray_number INTEGER,
+            medicine TEXT,
+            scheduled_time TEXT,
+            action TEXT,
+            recorded_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_missed_doses_tray_time ON missed_doses(tray_number, scheduled_time)')
+
+
+class CatchUpPlan:
+    """What to do with a tray whose dose fell due at `due`"""
+
+    def __init__(self, due, next_due, deliver=None, missed=(), alert=False):
+        self.due = due
+        self.next_due = next_due
+        self.deliver = deliver  # Scheduled time of the dose to dispense now, None to dispense nothing
+        self.missed = list(missed)  # Scheduled times not dispensed
+        self.alert = alert
+
+    def __repr__(self):
+        return (f"CatchUpPlan(deliver={self.deliver}, missed={len(self.missed)}, "
+                f"alert={self.alert}, next_due={self.next_due})")
+
+
+def plan_catch_up(due, rule, now, policy=MISSED_DOSE_POLICY, grace=None):
+    """Plan the dispense of an overdue tray and its next due time
+
+    rule is the tray's recurrence rule, or a timedelta for every interval from due.
+    """
+    check_policy(policy)
+    if isinstance(rule, timedelta):
+        rule = EveryRule(rule / timedelta(hours=1), due)
+    grace = timedelta(minutes=MISSED_DOSE_GRACE_MINUTES) if grace is None else grace
+
+    # Compared in epoch seconds, naive comparisons ignore which 01:30 of a DST fall-back is meant
+    if now.timestamp() < due.timestamp():
+        # Woken early, nothing is due yet
+        return CatchUpPlan(due, due)
+    # The stored due time counts even if the schedule was edited since
+    due_occurrences = [due] + rule.between(due, now)
+    latest = due_occurrences[-1]
+    next_due = rule.next_after(now)
+    if now.timestamp() - latest.timestamp() <= grace.total_seconds() or policy == 'deliver_one':
+        # Either the current dose is on time and only the ones before it were missed,
+        # or the most recent missed dose is delivered late
+        return CatchUpPlan(due, next_due, deliver=latest, missed=due_occurrences[:-1])
+    return CatchUpPlan(due, next_due, missed=due_occurrences, alert=policy == 'alert')
+
+
+def record_missed(cursor, tray_id, tray_number, medicine, scheduled_times, action):
+    """Store every missed occurrence in one executemany"""
+    if not scheduled_times:
+        return 0
+    recorded_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany('''
+        INSERT INTO missed_doses (tray_id, tray_number, medicine, scheduled_time, action, recorded_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(tray_id, tray_number, medicine, t.strftime('%Y-%m-%d %H:%M:%S'), action, recorded_at)
+          for t in scheduled_times])
+    MISSED_DOSES.inc(action, amount=len(scheduled_times))
+    return len(scheduled_times)
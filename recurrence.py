@@ -0,0 +1,256 @@
+"""
+Structured dispense schedules.
+
+The schedule a user types when setting up a tray ("8", "every 6 hours",
+"08:00 and 20:00 daily", "Mon/Wed/Fri 9am") is parsed once, when it is
+saved, into one of two rules and stored as JSON in
+tray_settings.schedule:
+
+    {"every_hours": 8, "anchor": "2024-01-01T08:00"}
+    {"times": ["08:00", "20:00"], "weekday_mask": 21}
+
+weekday_mask has bit 0 for Monday through bit 6 for Sunday, 127 is
+every day. Both rules answer next_after(), latest_at_or_before() and
+occurrences() directly, so the scheduler, the missed-dose catch-up and
+the dashboard never parse text again.
+"""
+
+import json
+import re
+from datetime import datetime, timedelta
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+EVERY_DAY = 0b1111111
+
+MAX_INTERVAL_HOURS = 24 * 7
+
+# Longest gap between two occurrences of a times-of-day rule, one week plus a day
+_MAX_DAYS_AHEAD = 8
+
+
+def format_time(moment, fmt=TIME_FORMAT):
+    """Stored form of a naive local time, with its UTC offset when a DST change makes the local time ambiguous.
+
+    fromtimestamp() marks the second 01:30 of a fall-back with fold=1,
+    which strftime() drops, so such times carry "-0500" to tell them apart.
+    """
+    text = moment.strftime(fmt)
+    if moment.replace(fold=0).timestamp() != moment.replace(fold=1).timestamp():
+        text += moment.astimezone().strftime('%z')
+    return text
+
+
+def parse_time(text, fmt=TIME_FORMAT):
+    """Naive local time from format_time(), fold set again when an offset was stored"""
+    try:
+        return datetime.strptime(text, fmt)
+    except ValueError:
+        aware = datetime.strptime(text, fmt + '%z')
+    return datetime.fromtimestamp(aware.timestamp())
+
+
+class Rule:
+    """Shared queries, subclasses provide next_after() and latest_at_or_before()"""
+
+    def first_at_or_after(self, moment):
+        return self.next_after(moment - timedelta(microseconds=1))
+
+    def occurrences(self, after, count):
+        """The next count occurrences after `after`, in one call"""
+        found = []
+        moment = after
+        for _ in range(count):
+            moment = self.next_after(moment)
+            found.append(moment)
+        return found
+
+    def between(self, start, end):
+        """Occurrences after start and at or before end"""
+        found = []
+        moment = self.next_after(start)
+        while moment <= end:
+            found.append(moment)
+            moment = self.next_after(moment)
+        return found
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+
+class EveryRule(Rule):
+    """Every N real hours from an anchor time.
+
+    Counted in epoch seconds and converted back to naive local time, so
+    across a DST change the doses stay N hours apart and their clock time
+    moves by the hour instead.
+    """
+
+    def __init__(self, hours, anchor):
+        if not 1 <= hours <= MAX_INTERVAL_HOURS:
+            raise ValueError(f"Interval must be between 1 and {MAX_INTERVAL_HOURS} hours")
+        self.hours = hours
+        self.anchor = anchor.replace(second=0, microsecond=0)
+        self._anchor_ts = self.anchor.timestamp()
+        self._seconds = hours * 3600
+
+    def _latest_ts(self, moment):
+        ts = moment.timestamp()
+        if ts < self._anchor_ts:
+            return None
+        return self._anchor_ts + self._seconds * ((ts - self._anchor_ts) // self._seconds)
+
+    def next_after(self, moment):
+        latest = self._latest_ts(moment)
+        return self.anchor if latest is None else datetime.fromtimestamp(latest + self._seconds)
+
+    def latest_at_or_before(self, moment):
+        latest = self._latest_ts(moment)
+        return None if latest is None else datetime.fromtimestamp(latest)
+
+    def between(self, start, end):
+        # Arithmetic, not a walk
+        first = self.next_after(start).timestamp()
+        count = int((end.timestamp() - first) // self._seconds) + 1
+        return [datetime.fromtimestamp(first + self._seconds * k) for k in range(max(count, 0))]
+
+    def describe(self):
+        return "Every hour" if self.hours == 1 else f"Every {self.hours} hours"
+
+    def to_dict(self):
+        return {'every_hours': self.hours, 'anchor': self.anchor.strftime(TIME_FORMAT)}
+
+
+class TimesRule(Rule):
+    """Fixed times of day, on the weekdays in a mask"""
+
+    def __init__(self, times, weekday_mask=EVERY_DAY):
+        if not times:
+            raise ValueError("At least one time of day is needed")
+        if not 0 < weekday_mask <= EVERY_DAY:
+            raise ValueError("At least one weekday is needed")
+        self.times = sorted(set(times))  # (hour, minute)
+        self.weekday_mask = weekday_mask
+
+    def _on(self, day):
+        return self.weekday_mask & (1 << day.weekday())
+
+    def next_after(self, moment):
+        day = moment.date()
+        for offset in range(_MAX_DAYS_AHEAD):
+            date = day + timedelta(days=offset)
+            if not self._on(date):
+                continue
+            for hour, minute in self.times:
+                candidate = datetime(date.year, date.month, date.day, hour, minute)
+                if candidate > moment:
+                    return candidate
+        raise ValueError("Schedule has no occurrences")
+
+    def latest_at_or_before(self, moment):
+        day = moment.date()
+        for offset in range(_MAX_DAYS_AHEAD):
+            date = day - timedelta(days=offset)
+            if not self._on(date):
+                continue
+            for hour, minute in reversed(self.times):
+                candidate = datetime(date.year, date.month, date.day, hour, minute)
+                if candidate <= moment:
+                    return candidate
+        return None
+
+    def describe(self):
+        times = ', '.join(f'{h:02d}:{m:02d}' for h, m in self.times)
+        if self.weekday_mask == EVERY_DAY:
+            return f"{times} daily"
+        days = ', '.join(name for i, name in enumerate(WEEKDAYS) if self.weekday_mask & (1 << i))
+        return f"{times} on {days}"
+
+    def to_dict(self):
+        return {'times': [f'{h:02d}:{m:02d}' for h, m in self.times], 'weekday_mask': self.weekday_mask}
+
+
+def from_dict(data):
+    if 'every_hours' in data:
+        return EveryRule(int(data['every_hours']), datetime.strptime(data['anchor'], TIME_FORMAT))
+    return TimesRule([tuple(int(p) for p in t.split(':')) for t in data['times']],
+                     int(data.get('weekday_mask', EVERY_DAY)))
+
+
+def from_json(text):
+    return from_dict(json.loads(text))
+
+
+_TIME = re.compile(r'\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b|\b(\d{1,2}):(\d{2})\b')
+_DAY = re.compile(r'\b(mon|tue|wed|thu|fri|sat|sun)(?:day|sday|nesday|rsday|urday|s|r|rs)?\b')
+_HOURS = re.compile(r'^(?:every\s+)?(\d+)\s*(?:h|hr|hrs|hour|hours)?$')
+# Words that join times and days without changing the schedule
+_FILLER = re.compile(r'\b(?:weekdays|weekends|daily|everyday|every|day|days|and|on|at)\b|[,/&+]')
+
+
+def _parse_times(text):
+    times = []
+    for hour12, minute12, meridiem, hour24, minute24 in _TIME.findall(text):
+        if meridiem:
+            hour, minute = int(hour12) % 12 + (12 if meridiem == 'pm' else 0), int(minute12 or 0)
+        else:
+            hour, minute = int(hour24), int(minute24)
+        if hour > 23 or minute > 59:
+            raise ValueError(f"{hour:02d}:{minute:02d} is not a time of day")
+        times.append((hour, minute))
+    return times
+
+
+def parse_schedule(text, start):
+    """Compile what the user typed into a rule, start is the first dispense time they picked"""
+    text = (text or '').strip().lower()
+    if not text:
+        raise ValueError("Enter a schedule, e.g. 8 (hours), 08:00 and 20:00 daily, or Mon/Wed/Fri 9am")
+    match = _HOURS.match(text)
+    if match:
+        return EveryRule(int(match.group(1)), start)
+
+    # Everything must be a time, a day or filler, "twice daily" or "Mon 8" are not one time a day
+    leftover = _FILLER.sub(' ', _DAY.sub(' ', _TIME.sub(' ', text))).split()
+    if leftover:
+        raise ValueError(f"Could not understand {' '.join(leftover)!r} in the schedule {text!r}, "
+                         "list the times instead, e.g. 08:00 and 20:00 daily, or Mon/Wed/Fri 9am")
+
+    times = _parse_times(text)
+    mask = 0
+    for day in _DAY.findall(_TIME.sub(' ', text)):
+        mask |= 1 << WEEKDAYS.index(day.capitalize())
+    if 'weekdays' in text:
+        mask |= 0b0011111
+    if 'weekends' in text:
+        mask |= 0b1100000
+    if not times and not mask and not re.search(r'\b(daily|every day)\b', text):
+        raise ValueError(f"Could not understand the schedule {text!r}, "
+                         "try 8 (hours), 08:00 and 20:00 daily, or Mon/Wed/Fri 9am")
+    return TimesRule(times or [(start.hour, start.minute)], mask or EVERY_DAY)
+
+
+def load_rule(schedule_json, interval_text, anchor):
+    """Rule stored with a tray, or the old free-text hours for rows saved before schedules existed"""
+    if schedule_json:
+        return from_json(schedule_json)
+    match = re.search(r'\d+', interval_text or '')
+    hours = int(match.group()) if match else 1
+    return EveryRule(min(max(1, hours), MAX_INTERVAL_HOURS), anchor)
+
+
+def compile_schedule(text, dispense_time):
+    """(schedule JSON, first dispense time) for a tray being saved, ValueError if either is unusable"""
+    try:
+        start = datetime.strptime(dispense_time, TIME_FORMAT)
+    except (TypeError, ValueError):
+        raise ValueError("Pick the first dispense time") from None
+    rule = parse_schedule(text, start)
+    return rule.to_json(), format_time(rule.first_at_or_after(start))
@@ -1,53 +1,66 @@
-import RPi.GPIO as GPIO
+import logging
 import time
 
+from tray_registry import load_registry
+from servo_drivers import create_driver
+from servo_calibration import ServoProfile, load_profiles
+from scheduler import SystemClock
+import metrics
+
+log = logging.getLogger(__name__)
+
+SERVO_CYCLE_SECONDS = metrics.histogram('dispenser_servo_cycle_seconds', 'Open, dwell and close cycle of one dispense',
+                                        ['tray'], buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5))
+
 class ServoController:
-    def __init__(self):
-        self.tray1_pin = 29  # GPIO 32 for Tray 1 (SG90)
-        self.tray2_pin = 31  # GPIO 33 for Tray 2
-        self.frequency = 50  # 50Hz for standard servos
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.tray1_pin, GPIO.OUT)
-        GPIO.setup(self.tray2_pin, GPIO.OUT)
-        self.servo1 = GPIO.PWM(self.tray1_pin, self.frequency)
-        self.servo2 = GPIO.PWM(self.tray2_pin, self.frequency)
-        self.servo1.start(0)
-        self.servo2.start(0)
-        print("ServoController initialized (real hardware)")
-
-    def _move_servo(self, servo, angle):
-        # Convert angle (0-180) to duty cycle
-        duty = 2 + (angle / 18)
-        servo.ChangeDutyCycle(duty)
-        time.sleep(0.5)
-        servo.ChangeDutyCycle(0)
-
-    def dispense_from_tray_1(self, medicine_name):
-        print(f"Dispensing from Tray 1: {medicine_name}")
-        start_time = time.perf_counter()
-        self._move_servo(self.servo1, 90)  # Move to 90 degrees
-        time.sleep(1)
-        self._move_servo(self.servo1, 0)   # Return to 0 degrees
-        elapsed = time.perf_counter() - start_time
-        print(f"Dispense complete (Tray 1). [BENCHMARK] Took {elapsed:.2f} seconds.")
+    def __init__(self, registry=None, driver=None, clock=None, profiles=None):
+        self.registry = registry or load_registry()
+        self.clock = clock or SystemClock()  # FakeClock turns the sleeps into virtual time
+        self.driver = driver or create_driver(clock=self.clock)
+        self.profiles = load_profiles() if profiles is None else profiles
+        self.default_profile = ServoProfile()
+        self.positions = {}  # tray number -> last commanded angle
+        for tray in self.registry:
+            self.driver.setup(tray)
+        log.info("ServoController initialized (%s, %s trays)", self.driver.name, len(self.registry))
+
+    def profile(self, tray):
+        return self.profiles.get(tray.number, self.default_profile)
+
+    def _move_servo(self, tray, angle):
+        """Move and hold only until the servo has arrived, returns the seconds waited"""
+        profile = self.profile(tray)
+        settle = profile.settle_time(self.positions.get(tray.number), angle)
+        self.driver.set_angle(tray, angle, profile)
+        self.clock.sleep(settle)
+        self.driver.release(tray)
+        self.positions[tray.number] = angle
+        return settle
+
+    def move(self, tray_number, angle):
+        return self._move_servo(self.registry.get(tray_number), angle)
 
-    def dispense_from_tray_2(self, medicine_name):
-        print(f"Dispensing from Tray 2: {medicine_name}")
+    def dispense(self, tray_number, medicine_name):
+        tray = self.registry.get(tray_number)
+        profile = self.profile(tray)
+        dwell = profile.dwell if profile.dwell is not None else tray.dwell
+        log.info("Dispensing from Tray %s: %s", tray.number, medicine_name, extra={'tray': tray.number})
         start_time = time.perf_counter()
-        self._move_servo(self.servo2, 90)  # Move to 90 degrees
-        time.sleep(1)
-        self._move_servo(self.servo2, 0)   # Return to 0 degrees
+        planned = self._move_servo(tray, tray.open_angle)
+        self.clock.sleep(dwell)
+        planned += dwell + self._move_servo(tray, tray.close_angle)
         elapsed = time.perf_counter() - start_time
-        print(f"Dispense complete (Tray 2). [BENCHMARK] Took {elapsed:.2f} seconds.")
+        SERVO_CYCLE_SECONDS.observe(elapsed, tray.number)
+        log.info("Dispense complete (Tray %s). [BENCHMARK] Took %.2f seconds (motion plan %.2fs).", tray.number, elapsed, planned,
+                 extra={'tray': tray.number, 'elapsed': round(elapsed, 3), 'planned': round(planned, 3)})
+        return planned
 
     def cleanup(self):
-        self.servo1.stop()
-        self.servo2.stop()
-        GPIO.cleanup()
-        print("ServoController cleaned up.")
+        self.driver.cleanup()
+        log.info("ServoController cleaned up.")
 
-def get_servo_controller():
-    return ServoController()
+def get_servo_controller(registry=None, driver=None, clock=None):
+    return ServoController(registry, driver, clock)
 
 def cleanup_servo_controller(controller):
     controller.cleanup() 
\ No newline at end of file
@@ -0,0 +1,319 @@
+"""
+Event-driven dispense scheduler.
+
+Keeps a min-heap of the next due time of every tray and sleeps until the
+earliest one, instead of polling tray_settings every few seconds.
+
+SystemClock runs on time.monotonic() anchored to the wall clock, so time
+only moves forward at the rate it really passes. A Pi without an RTC
+boots at a stale time and NTP later steps it; the clock notices the
+step, re-anchors and wakes the scheduler to recompute its deadlines.
+Waits, the heap and every due check use epoch seconds, and every-N-hours
+rules count their intervals in epoch seconds too, so a DST change does
+not stretch or shorten them by an hour, and the repeated hour of a
+fall-back is not mistaken for the first one.
+"""
+
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import metrics
+from recurrence import parse_time
+
+log = logging.getLogger(__name__)
+
+# A wall clock that differs from the monotonic clock by more than this has been stepped
+CLOCK_JUMP_THRESHOLD = float(os.getenv('CLOCK_JUMP_THRESHOLD', '2'))
+
+# Longest the scheduler sleeps without checking the wall clock for a step
+CLOCK_CHECK_SECONDS = float(os.getenv('CLOCK_CHECK_SECONDS', '30'))
+
+# Delay before a tray whose dispatch failed (e.g. database is locked) is tried again
+DISPATCH_RETRY_SECONDS = float(os.getenv('DISPATCH_RETRY_SECONDS', '10'))
+
+SCHEDULER_LAG = metrics.histogram('dispenser_scheduler_lag_seconds',
+                                  'Delay between a tray falling due and the scheduler dispatching it',
+                                  buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300))
+CLOCK_JUMPS = metrics.counter('dispenser_clock_jumps_total', 'Wall clock steps detected against the monotonic clock',
+                              ['direction'])
+CLOCK_LAST_JUMP = metrics.gauge('dispenser_clock_last_jump_seconds', 'Size of the last wall clock step, negative if backwards')
+
+
+def seconds_between(earlier, later):
+    """Real seconds between two naive local times, right across DST changes"""
+    return later.timestamp() - earlier.timestamp()
+
+
+class SystemClock:
+    """Real clock used on the dispenser, monotonic between detected wall clock steps"""
+
+    def __init__(self, wall=time.time, monotonic=time.monotonic, threshold=CLOCK_JUMP_THRESHOLD,
+                 check_interval=CLOCK_CHECK_SECONDS):
+        self._wall = wall
+        self._monotonic = monotonic
+        self.threshold = threshold
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._anchor = (wall(), monotonic())  # (epoch, monotonic) at the last re-anchor
+        self._conditions = []
+        self._listeners = []
+        self.jumps = deque(maxlen=50)
+
+    def register(self, condition):
+        with self._lock:
+            self._conditions.append(condition)
+
+    def add_jump_listener(self, listener):
+        """listener(delta_seconds) runs on the thread that noticed the step"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def check(self):
+        """Re-anchor to the wall clock if it was stepped, returns the step in seconds or 0"""
+        monotonic = self._monotonic()
+        wall = self._wall()
+        with self._lock:
+            anchor_wall, anchor_monotonic = self._anchor
+            delta = wall - (anchor_wall + monotonic - anchor_monotonic)
+            if abs(delta) < self.threshold:
+                return 0.0
+            self._anchor = (wall, monotonic)
+            self.jumps.append({'detected_at': datetime.fromtimestamp(wall).isoformat(timespec='seconds'),
+                               'delta_seconds': round(delta, 3)})
+            listeners = list(self._listeners)
+            conditions = list(self._conditions)
+        CLOCK_JUMPS.inc('forward' if delta > 0 else 'backward')
+        CLOCK_LAST_JUMP.set(round(delta, 3))
+        log.warning("Wall clock stepped %+.1f seconds, re-anchoring", delta, extra={'delta_seconds': round(delta, 3)})
+        for listener in listeners:
+            listener(delta)
+        for condition in conditions:
+            with condition:
+                condition.notify_all()
+        return delta
+
+    def timestamp(self):
+        """Epoch seconds, advancing with the monotonic clock"""
+        self.check()
+        with self._lock:
+            anchor_wall, anchor_monotonic = self._anchor
+        return anchor_wall + self._monotonic() - anchor_monotonic
+
+    def now(self):
+        return datetime.fromtimestamp(self.timestamp())
+
+    def wait(self, condition, timeout):
+        # Caller holds the condition lock. Wake now and then to notice a wall clock step
+        # while sleeping towards a far deadline
+        condition.wait(self.check_interval if timeout is None else min(timeout, self.check_interval))
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class FakeClock:
+    """Manually advanced clock for tests and scheduling benchmarks"""
+
+    def __init__(self, start=None):
+        self._now = start or datetime(2024, 1, 1, 8, 0)
+        self._lock = threading.Lock()
+        self._conditions = []
+        self._listeners = []
+
+    def register(self, condition):
+        with self._lock:
+            self._conditions.append(condition)
+
+    def add_jump_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def now(self):
+        with self._lock:
+            return self._now
+
+    def _add(self, seconds):
+        # Epoch arithmetic, like SystemClock, so fake time crosses DST changes correctly
+        self._now = datetime.fromtimestamp(self._now.timestamp() + seconds)
+
+    def jump(self, seconds):
+        """Step the wall clock like NTP correcting a stale boot time"""
+        with self._lock:
+            self._add(seconds)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(seconds)
+        self.advance(0)
+
+    def advance(self, seconds):
+        """Move time forward and wake every scheduler waiting on this clock"""
+        with self._lock:
+            self._add(seconds)
+            conditions = list(self._conditions)
+        for condition in conditions:
+            with condition:
+                condition.notify_all()
+
+    def wait(self, condition, timeout):
+        # Timeouts are meaningless in fake time, advance() does the waking
+        condition.wait()
+
+    def sleep(self, seconds):
+        """Servo and settle delays cost no real time"""
+        self.advance(seconds)
+
+
+class DispenseScheduler:
+    """Dispatches trays exactly when they fall due"""
+
+    def __init__(self, load_schedule, on_due, clock=None, retry_seconds=DISPATCH_RETRY_SECONDS):
+        # load_schedule() -> iterable of (tray_id, tray_number, dispense_time)
+        # on_due(tray_id) -> next due datetime or None
+        self.load_schedule = load_schedule
+        self.on_due = on_due
+        self.retry_seconds = retry_seconds
+        self.clock = clock or SystemClock()
+        self._cond = threading.Condition()
+        self.clock.register(self._cond)
+        self.clock.add_jump_listener(self._clock_jumped)
+        self.clock_jumps = deque(maxlen=20)  # Each step and what it did to the schedule
+        self._heap = []  # (epoch seconds, tray_number, tray_id, due)
+        self._due = {}  # tray_id -> current due epoch seconds, stale heap entries are skipped
+        self._reload = True
+        self._running = False
+        self.stats = {
+            'wakeups': 0,
+            'reloads': 0,
+            'dispatched': 0,
+            'last_lateness': 0.0,
+            'max_lateness': 0.0,
+            'clock_jumps': 0,
+            'retries': 0,
+        }
+
+    def notify_changed(self):
+        """Wake the scheduler after tray_settings has been modified"""
+        with self._cond:
+            self._reload = True
+            self._cond.notify_all()
+
+    def schedule(self, tray_id, tray_number, due):
+        """Set the next due time of a single tray"""
+        with self._cond:
+            self._push(tray_id, tray_number, due)
+            self._cond.notify_all()
+
+    def _clock_jumped(self, delta):
+        """Record how a wall clock step moved the schedule, the run loop recomputes its wait"""
+        now = self.clock.now()
+        with self._cond:
+            overdue = sum(1 for due in self._due.values() if due <= now.timestamp())
+            deadline = self._peek()
+            self.stats['clock_jumps'] += 1
+            self.clock_jumps.append({
+                'delta_seconds': round(delta, 3),
+                'detected_at': now.isoformat(timespec='seconds'),
+                # Forward steps make doses due at once, the missed-dose policy decides what to dispense
+                'trays_now_due': overdue,
+                'next_deadline_in': round(seconds_between(now, deadline), 3) if deadline else None,
+            })
+            self._cond.notify_all()
+
+    def next_deadline(self):
+        with self._cond:
+            return self._peek()
+
+    def _push(self, tray_id, tray_number, due):
+        self._due[tray_id] = due.timestamp()
+        heapq.heappush(self._heap, (due.timestamp(), tray_number, tray_id, due))
+
+    def _peek(self):
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][3] if self._heap else None
+
+    def _rebuild(self):
+        self._heap = []
+        self._due = {}
+        self.stats['reloads'] += 1
+        for tray_id, tray_number, dispense_time in self.load_schedule():
+            if not dispense_time:
+                continue
+            try:
+                due = parse_dispense_time(dispense_time)
+            except ValueError as e:
+                log.error("Error processing row for due check: %s, Error: %s", tray_id, e, extra={'tray_id': tray_id})
+                continue
+            self._due[tray_id] = due.timestamp()
+            self._heap.append((due.timestamp(), tray_number, tray_id, due))
+        heapq.heapify(self._heap)
+
+    def _pop_due(self, now):
+        due_items = []
+        while self._peek() is not None and self._heap[0][0] <= now.timestamp():
+            _, tray_number, tray_id, due = heapq.heappop(self._heap)
+            del self._due[tray_id]
+            due_items.append((due, tray_number, tray_id))
+        return due_items
+
+    def run_pending(self):
+        """Dispatch every tray that is due now, returns how many were dispatched"""
+        with self._cond:
+            if self._reload:
+                self._reload = False
+                self._rebuild()
+            due_items = self._pop_due(self.clock.now())
+
+        # Dispatch outside the lock so tray changes never wait on a servo
+        for due, tray_number, tray_id in due_items:
+            self._dispatch(due, tray_number, tray_id)
+        return len(due_items)
+
+    def _dispatch(self, due, tray_number, tray_id):
+        lateness = max(0.0, seconds_between(due, self.clock.now()))
+        self.stats['dispatched'] += 1
+        self.stats['last_lateness'] = lateness
+        self.stats['max_lateness'] = max(self.stats['max_lateness'], lateness)
+        SCHEDULER_LAG.observe(lateness)
+        try:
+            next_due = self.on_due(tray_id)
+        except Exception as e:
+            # Still due, try again shortly rather than dropping the tray until the next reload
+            log.error("Error processing tray %s, retrying in %ss. Error: %s", tray_id, self.retry_seconds, e,
+                      extra={'tray_id': tray_id})
+            self.stats['retries'] += 1
+            next_due = datetime.fromtimestamp(self.clock.now().timestamp() + self.retry_seconds)
+        if next_due is not None:
+            self.schedule(tray_id, tray_number, next_due)
+
+    def run(self):
+        """Scheduler loop, sleeps until the earliest deadline or a tray change"""
+        self._running = True
+        while self._running:
+            self.run_pending()
+            with self._cond:
+                if self._reload or not self._running:
+                    continue
+                deadline = self._peek()
+                now = self.clock.now()
+                if deadline is not None and seconds_between(now, deadline) <= 0:
+                    continue
+                timeout = None if deadline is None else seconds_between(now, deadline)
+                self.clock.wait(self._cond, timeout)
+                self.stats['wakeups'] += 1
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+
+def parse_dispense_time(value):
+    if isinstance(value, datetime):
+        return value
+    return parse_time(value)
@@ -0,0 +1,120 @@
+"""
+Servo calibration profiles.
+
+Each tray's servo gets its own pulse range, speed and dwell instead of
+fixed sleeps. The controller waits only as long as the move needs: the
+travel at the calibrated speed plus a short settle margin. Profiles are
+kept in SERVO_CALIBRATION (servo_calibration.json), keyed by tray number.
+
+    python servo_calibration.py show
+    python servo_calibration.py set TRAY speed=450 dwell=0.4 min_pulse_us=520
+    python servo_calibration.py move TRAY ANGLE
+    python servo_calibration.py time TRAY [CYCLES]
+"""
+
+import json
+import os
+import sys
+
+from servo_drivers import MIN_PULSE_US, MAX_PULSE_US, pulse_width
+
+SERVO_CALIBRATION = os.getenv('SERVO_CALIBRATION', 'servo_calibration.json')
+
+
+class ServoProfile:
+    """Calibration of one servo"""
+
+    def __init__(self, min_pulse_us=MIN_PULSE_US, max_pulse_us=MAX_PULSE_US, speed=300.0, settle=0.05, dwell=None):
+        self.min_pulse_us = min_pulse_us
+        self.max_pulse_us = max_pulse_us
+        self.speed = speed  # Degrees per second under load, SG90 is rated ~500 at 4.8V
+        self.settle = settle  # Seconds to stop ringing once the horn arrives
+        self.dwell = dwell  # Seconds the gate stays open, None uses the tray's dwell
+
+    def pulse_width(self, angle):
+        return pulse_width(angle, self.min_pulse_us, self.max_pulse_us)
+
+    def settle_time(self, from_angle, to_angle):
+        """Seconds a move takes before the servo can be released"""
+        if from_angle is None:
+            # Unknown position, allow for travel from the far end
+            travel = max(to_angle, 180 - to_angle)
+        else:
+            travel = abs(to_angle - from_angle)
+        return travel / self.speed + self.settle
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def load_profiles(path=SERVO_CALIBRATION):
+    """Tray number -> ServoProfile, trays without a profile use the defaults"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    return {int(number): ServoProfile(**values) for number, values in data.items()}
+
+
+def save_profiles(profiles, path=SERVO_CALIBRATION):
+    data = {str(number): profile.to_dict() for number, profile in sorted(profiles.items())}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def parse_settings(pairs):
+    """['speed=450', 'dwell=0.4'] -> {'speed': 450.0, 'dwell': 0.4}"""
+    fields = ServoProfile().to_dict()
+    settings = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        if key not in fields:
+            raise ValueError(f"Unknown setting {key!r}, choose from {', '.join(fields)}")
+        settings[key] = None if value.lower() == 'none' else float(value)
+    return settings
+
+
+def main(argv):
+    command = argv[0] if argv else 'show'
+    profiles = load_profiles()
+
+    if command == 'show':
+        for number, profile in sorted(profiles.items()):
+            print(f"Tray {number}: {profile.to_dict()}")
+        if not profiles:
+            print(f"No calibration in {SERVO_CALIBRATION}, every tray uses {ServoProfile().to_dict()}")
+        return 0
+
+    if command == 'set' and len(argv) >= 3:
+        number = int(argv[1])
+        profile = profiles.get(number, ServoProfile())
+        for key, value in parse_settings(argv[2:]).items():
+            setattr(profile, key, value)
+        profiles[number] = profile
+        save_profiles(profiles)
+        print(f"Saved Tray {number}: {profile.to_dict()}")
+        return 0
+
+    if not ((command == 'move' and len(argv) == 3) or (command == 'time' and len(argv) in (2, 3))):
+        print(__doc__)
+        return 1
+
+    from rpi_servo import get_servo_controller, cleanup_servo_controller
+    controller = get_servo_controller()
+    try:
+        if command == 'move':
+            waited = controller.move(int(argv[1]), float(argv[2]))
+            print(f"Tray {argv[1]} at {argv[2]} degrees, waited {waited:.2f}s")
+        else:
+            # Prints the [BENCHMARK] cycle time of each dispense
+            for _ in range(int(argv[2]) if len(argv) > 2 else 3):
+                controller.dispense(int(argv[1]), "calibration")
+    finally:
+        cleanup_servo_controller(controller)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,266 @@
+"""
+Servo driver backends.
+
+ServoController talks to one of these instead of RPi.GPIO directly:
+
+    gpio     software PWM through RPi.GPIO (the original wiring, BOARD pins)
+    pigpio   hardware-timed pulses from the pigpio daemon (same BOARD pins)
+    pca9685  16-channel PCA9685 PWM board over I2C (tray channel numbers)
+    sim      no hardware, records every commanded angle
+
+SERVO_DRIVER picks the backend, DISPENSER_HARDWARE=sim defaults it to sim.
+Each driver only needs setup(tray), set_angle(tray, angle, profile),
+release(tray) and cleanup(). The profile is the tray's ServoProfile from
+servo_calibration, None means the default pulse range.
+"""
+
+import logging
+import os
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+SERVO_DRIVER = os.getenv('SERVO_DRIVER', 'sim' if os.getenv('DISPENSER_HARDWARE') == 'sim' else 'gpio')
+I2C_BUS = int(os.getenv('I2C_BUS', '1'))
+PCA9685_ADDRESS = int(os.getenv('PCA9685_ADDRESS', '0x40'), 0)
+
+SERVO_FREQUENCY = 50  # Hz, standard hobby servos
+
+# Default pulse range for 0 to 180 degrees, the 2-12% duty cycle the trays were first tuned with
+MIN_PULSE_US = 400
+MAX_PULSE_US = 2400
+
+# set_servo_pulsewidth() refuses anything but 0 (off) or 500 to 2500
+PIGPIO_MIN_PULSE_US = 500
+PIGPIO_MAX_PULSE_US = 2500
+
+# Physical header pin -> BCM GPIO number, pigpio only speaks BCM
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23,
+    18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5,
+    31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21,
+}
+
+
+def pulse_width(angle, min_pulse_us=MIN_PULSE_US, max_pulse_us=MAX_PULSE_US):
+    """Servo pulse width in microseconds for an angle between 0 and 180"""
+    angle = min(max(angle, 0), 180)
+    return min_pulse_us + (max_pulse_us - min_pulse_us) * angle / 180
+
+
+def profile_pulse(angle, profile):
+    return profile.pulse_width(angle) if profile is not None else pulse_width(angle)
+
+
+class ServoDriver:
+    """Base class, one instance drives every tray"""
+
+    name = 'base'
+
+    def setup(self, tray):
+        pass
+
+    def set_angle(self, tray, angle, profile=None):
+        raise NotImplementedError
+
+    def release(self, tray):
+        """Stop sending pulses so the servo does not hum or jitter while idle"""
+        pass
+
+    def cleanup(self):
+        pass
+
+
+class GPIOPWMDriver(ServoDriver):
+    """Software PWM through RPi.GPIO, jitters when the CPU is busy"""
+
+    name = 'gpio'
+
+    def __init__(self, frequency=SERVO_FREQUENCY):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.frequency = frequency
+        self.servos = {}
+        GPIO.setmode(GPIO.BOARD)
+
+    def setup(self, tray):
+        self.GPIO.setup(tray.pin, self.GPIO.OUT)
+        servo = self.GPIO.PWM(tray.pin, self.frequency)
+        servo.start(0)
+        self.servos[tray.number] = servo
+
+    def set_angle(self, tray, angle, profile=None):
+        # Pulse width as a percentage of the PWM period
+        duty = profile_pulse(angle, profile) * self.frequency / 10000
+        self.servos[tray.number].ChangeDutyCycle(duty)
+
+    def release(self, tray):
+        self.servos[tray.number].ChangeDutyCycle(0)
+
+    def cleanup(self):
+        for servo in self.servos.values():
+            servo.stop()
+        self.GPIO.cleanup()
+
+
+class PigpioDriver(ServoDriver):
+    """Pulses timed by the pigpio daemon's DMA, steady under any CPU load"""
+
+    name = 'pigpio'
+
+    def __init__(self, host=None, pi=None):
+        if pi is None:
+            import pigpio
+            pi = pigpio.pi(host) if host else pigpio.pi()
+        self.pi = pi
+        if not self.pi.connected:
+            raise RuntimeError("pigpio daemon is not running (sudo systemctl start pigpiod)")
+
+    def gpio(self, tray):
+        return BOARD_TO_BCM[tray.pin]
+
+    def set_angle(self, tray, angle, profile=None):
+        # The default 0 degree pulse is 400us, below what pigpio accepts
+        pulse = min(max(profile_pulse(angle, profile), PIGPIO_MIN_PULSE_US), PIGPIO_MAX_PULSE_US)
+        self.pi.set_servo_pulsewidth(self.gpio(tray), pulse)
+
+    def release(self, tray):
+        self.pi.set_servo_pulsewidth(self.gpio(tray), 0)
+
+    def cleanup(self):
+        self.pi.stop()
+
+
+class PCA9685Driver(ServoDriver):
+    """16 hardware PWM channels on one I2C address, boards can be chained"""
+
+    name = 'pca9685'
+
+    MODE1 = 0x00
+    PRESCALE = 0xFE
+    LED0_ON_L = 0x06
+    SLEEP = 0x10
+    AUTO_INCREMENT = 0x20
+    RESTART = 0x80
+    FULL_OFF = 0x10
+    OSCILLATOR_HZ = 25000000
+
+    def __init__(self, bus=None, address=PCA9685_ADDRESS, frequency=SERVO_FREQUENCY):
+        if bus is None:
+            from smbus2 import SMBus
+            bus = SMBus(I2C_BUS)
+        self.bus = bus
+        self.address = address
+        self.frequency = frequency
+        self.prescale = round(self.OSCILLATOR_HZ / (4096 * frequency)) - 1
+        # The prescaler can only be written while the oscillator sleeps
+        bus.write_byte_data(address, self.MODE1, self.SLEEP)
+        bus.write_byte_data(address, self.PRESCALE, self.prescale)
+        bus.write_byte_data(address, self.MODE1, self.AUTO_INCREMENT)
+        time.sleep(0.0005)  # Oscillator start-up
+        bus.write_byte_data(address, self.MODE1, self.AUTO_INCREMENT | self.RESTART)
+
+    def channel(self, tray):
+        return tray.channel if tray.channel is not None else tray.number - 1
+
+    def ticks(self, angle, profile=None):
+        """Off time in 1/4096ths of the PWM period"""
+        period_us = 1000000 / self.frequency
+        return round(profile_pulse(angle, profile) * 4096 / period_us)
+
+    def _write_channel(self, channel, on, off):
+        register = self.LED0_ON_L + 4 * channel
+        self.bus.write_i2c_block_data(self.address, register, [on & 0xFF, on >> 8, off & 0xFF, off >> 8])
+
+    def set_angle(self, tray, angle, profile=None):
+        self._write_channel(self.channel(tray), 0, self.ticks(angle, profile))
+
+    def release(self, tray):
+        self._write_channel(self.channel(tray), 0, self.FULL_OFF << 8)
+
+    def cleanup(self):
+        # Sleep the oscillator, every output goes idle
+        self.bus.write_byte_data(self.address, self.MODE1, self.SLEEP)
+
+
+class SimulatedServoDriver(ServoDriver):
+    """Records (timestamp, tray number, angle) for every command, released trays read None"""
+
+    name = 'sim'
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.moves = []
+        self.angles = {}
+
+    def _now(self):
+        return self.clock.now() if self.clock else datetime.now()
+
+    def set_angle(self, tray, angle, profile=None):
+        self.moves.append((self._now(), tray.number, angle))
+        self.angles[tray.number] = angle
+
+    def release(self, tray):
+        self.angles[tray.number] = None
+
+
+class FakeI2CBus:
+    """In-process stand-in for smbus2.SMBus, records every register write"""
+
+    def __init__(self):
+        self.registers = {}
+        self.writes = []
+
+    def write_byte_data(self, address, register, value):
+        self.writes.append((address, register, [value]))
+        self.registers[(address, register)] = value
+
+    def write_i2c_block_data(self, address, register, values):
+        # Register auto-increment
+        self.writes.append((address, register, list(values)))
+        for offset, value in enumerate(values):
+            self.registers[(address, register + offset)] = value
+
+    def read_byte_data(self, address, register):
+        return self.registers.get((address, register), 0)
+
+    def close(self):
+        pass
+
+
+class FakePigpio:
+    """In-process stand-in for pigpio.pi(), refuses the pulse widths the daemon refuses"""
+
+    connected = True
+
+    def __init__(self):
+        self.pulses = {}
+        self.stopped = False
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        if pulsewidth != 0 and not PIGPIO_MIN_PULSE_US <= pulsewidth <= PIGPIO_MAX_PULSE_US:
+            raise ValueError(f"PI_BAD_PULSEWIDTH: {pulsewidth}")
+        self.pulses[gpio] = pulsewidth
+
+    def stop(self):
+        self.stopped = True
+
+
+DRIVERS = {
+    'gpio': GPIOPWMDriver,
+    'pigpio': PigpioDriver,
+    'pca9685': PCA9685Driver,
+    'sim': SimulatedServoDriver,
+}
+
+
+def create_driver(name=SERVO_DRIVER, clock=None):
+    try:
+        driver_class = DRIVERS[name.strip().lower()]
+    except KeyError:
+        raise ValueError(f"Unknown servo driver {name!r}, choose from {', '.join(DRIVERS)}") from None
+    # Only the simulator keeps time, real drivers are timed by ServoController
+    driver = driver_class(clock) if driver_class is SimulatedServoDriver else driver_class()
+    log.info("Using %s servo driver", driver.name)
+    return driver
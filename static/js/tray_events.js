@@ -0,0 +1,72 @@
+// Live tray status. Elements inside [data-tray="N"] marked with data-field are
+// kept current from /events (Server-Sent Events), or by polling /events.json in
+// browsers without EventSource. Pages provide formatCountdown(seconds).
+(function() {
+    var script = document.currentScript;
+    var eventsUrl = script.getAttribute('data-events');
+    var pollUrl = script.getAttribute('data-poll');
+
+    function applyTray(tray) {
+        var box = document.querySelector('[data-tray="' + tray.tray_number + '"]');
+        if (!box) {
+            // A tray was set up elsewhere, the page has no row for it yet
+            window.location.reload();
+            return;
+        }
+        var values = {
+            'description': tray.description,
+            'username': tray.username,
+            'next_dispense': tray.next_dispense,
+            'schedule': tray.schedule || 'N/A',
+            'upcoming': tray.upcoming && tray.upcoming.length ? tray.upcoming.join('; ') : 'N/A',
+            'dispense_count': tray.dispense_count + '/' + (tray.capacity || '?')
+        };
+        box.querySelectorAll('[data-field]').forEach(function(el) {
+            var field = el.getAttribute('data-field');
+            if (field in values) el.textContent = values[field];
+        });
+        box.querySelectorAll('.countdown').forEach(function(el) {
+            el.setAttribute('data-seconds', tray.countdown === null ? '' : tray.countdown);
+            el.textContent = formatCountdown(tray.countdown);
+        });
+    }
+
+    function applySnapshot(trays) {
+        var numbers = trays.map(function(tray) { return String(tray.tray_number); });
+        var stale = Array.prototype.some.call(document.querySelectorAll('[data-tray]'), function(el) {
+            return numbers.indexOf(el.getAttribute('data-tray')) === -1;
+        });
+        if (stale) {
+            window.location.reload();
+            return;
+        }
+        trays.forEach(applyTray);
+    }
+
+    function handle(event, data) {
+        if (event === 'snapshot') applySnapshot(data.trays);
+        else if (event === 'tray') applyTray(data);
+        else if (event === 'tray_removed') window.location.reload();
+        else if (event === 'dispense') document.dispatchEvent(new CustomEvent('tray-dispense', {detail: data}));
+    }
+
+    if (window.EventSource) {
+        var source = new EventSource(eventsUrl);
+        ['snapshot', 'tray', 'tray_removed', 'dispense'].forEach(function(event) {
+            source.addEventListener(event, function(e) { handle(event, JSON.parse(e.data)); });
+        });
+        return;
+    }
+
+    function poll(since) {
+        var url = pollUrl + '?wait=25' + (since === null ? '' : '&since=' + since);
+        fetch(url).then(function(response) { return response.json(); }).then(function(body) {
+            if (body.snapshot) applySnapshot(body.snapshot);
+            (body.events || []).forEach(function(e) { handle(e.event, e.data); });
+            poll(body.last_id);
+        }).catch(function() {
+            setTimeout(function() { poll(since); }, 5000);
+        });
+    }
+    poll(null);
+})();
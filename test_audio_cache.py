@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Tests for the content-addressed speech audio cache
+"""
+
+import os
+
+from audio_cache import AudioCache
+
+
+def fake_render(calls):
+    def render(text, path):
+        calls.append(text)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+    return render
+
+
+def test_repeated_phrase_is_rendered_once(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=10_000)
+    calls = []
+    message = "Tray 1: Biogesic was dispensed. Please take your medicine now."
+
+    first = cache.get_or_render(message, 'en', 'gtts', fake_render(calls))
+    for _ in range(3):
+        assert cache.get_or_render(message, 'en', 'gtts', fake_render(calls)) == first
+    assert calls == [message]
+    assert cache.stats() == {'hits': 3, 'misses': 1}
+
+    # A different voice is a different clip
+    assert cache.get_or_render(message, 'en', 'piper', fake_render(calls)) != first
+
+
+def test_least_recently_used_clip_is_evicted(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=250)
+    calls = []
+    a = cache.get_or_render('a', 'en', 'gtts', fake_render(calls))
+    b = cache.get_or_render('b', 'en', 'gtts', fake_render(calls))
+    os.utime(a, (1, 1))
+    os.utime(b, (2, 2))
+    cache.get('a', 'en', 'gtts')
+
+    cache.get_or_render('c', 'en', 'gtts', fake_render(calls))
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(p) for p in (a, cache.path_for('c', 'en', 'gtts')))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tests for the persistent audio playback worker
+"""
+
+import threading
+import time
+
+from audio_player import AudioPlayer, NullSink, URGENT, REMINDER
+
+
+def make_player(seconds=0.0):
+    sink = NullSink(seconds)
+    return AudioPlayer(sinks={'mp3': sink, 'wav': sink}), sink
+
+
+def test_directions_then_repeated_reminder():
+    """A dispense plays directions once, then the reminder three times"""
+    player, sink = make_player()
+    try:
+        directions = player.say('directions.mp3')
+        player.say('reminder.mp3', priority=REMINDER, repeat=3, gap=0.01, delay=0.01, after=directions)
+        assert player.wait_idle(timeout=5)
+        assert sink.played == ['directions.mp3', 'reminder.mp3', 'reminder.mp3', 'reminder.mp3']
+    finally:
+        player.stop()
+
+
+def test_identical_pending_announcements_are_deduplicated():
+    gate = threading.Event()
+
+    class GatedSink(NullSink):
+        def play(self, path, stop_event):
+            self.played.append(path)
+            gate.wait(5)
+            return True
+
+    sink = GatedSink()
+    player = AudioPlayer(sinks={'wav': sink})
+    try:
+        player.say('busy.wav')
+        while not sink.played:
+            time.sleep(0.001)
+        first = player.say('tray1.wav')
+        assert player.say('tray1.wav') is first
+        player.say('alert.wav', priority=URGENT)
+        gate.set()
+        assert player.wait_idle(timeout=5)
+        assert sink.played == ['busy.wav', 'alert.wav', 'tray1.wav']
+        assert player.stats['deduplicated'] == 1
+    finally:
+        gate.set()
+        player.stop()
+
+
+def test_cancel_interrupts_playing_clip_and_its_repeats():
+    player, sink = make_player(seconds=5)
+    try:
+        player.say('reminder.wav', repeat=3, gap=0.01)
+        while not sink.played:
+            time.sleep(0.001)
+        player.cancel('reminder.wav')
+        assert player.wait_idle(timeout=2)
+        assert sink.played == ['reminder.wav']
+        assert player.stats['interrupted'] == 1
+    finally:
+        player.stop()
+
+
+def test_failed_clip_still_releases_its_followups():
+    """Reminders play even if the directions clip cannot be played"""
+
+    class BrokenDirectionsSink(NullSink):
+        def play(self, path, stop_event):
+            if path == 'directions.mp3':
+                raise OSError("mpg123: cannot decode")
+            return super().play(path, stop_event)
+
+    sink = BrokenDirectionsSink()
+    player = AudioPlayer(sinks={'mp3': sink})
+    try:
+        directions = player.say('directions.mp3')
+        player.say('reminder.mp3', priority=REMINDER, repeat=2, gap=0.01, after=directions)
+        assert player.wait_idle(timeout=5)
+        assert sink.played == ['reminder.mp3', 'reminder.mp3']
+        assert player.stats['errors'] == 1
+    finally:
+        player.stop()
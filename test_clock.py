@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Tests for the monotonic scheduling clock, wall clock step detection and DST
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from missed_doses import plan_catch_up
+from recurrence import EveryRule, format_time, parse_time
+from scheduler import DispenseScheduler, FakeClock, SystemClock, seconds_between
+
+START = datetime(2024, 1, 1, 8, 0)
+
+
+class Clocks:
+    """Controllable time.time and time.monotonic"""
+
+    def __init__(self, wall):
+        self.wall_now = wall
+        self.monotonic_now = 1000.0
+
+    def wall(self):
+        return self.wall_now
+
+    def monotonic(self):
+        return self.monotonic_now
+
+    def elapse(self, seconds):
+        self.wall_now += seconds
+        self.monotonic_now += seconds
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_ntp_step_is_detected_and_reanchored():
+    clocks = Clocks(START.timestamp())
+    clock = SystemClock(clocks.wall, clocks.monotonic, threshold=2)
+    steps = []
+    clock.add_jump_listener(steps.append)
+
+    clocks.elapse(60)
+    clocks.wall_now += 0.5  # Slew, not a step
+    assert clock.now() == START + timedelta(seconds=60)
+    assert steps == []
+
+    clocks.wall_now += 86400 * 30  # Booted a month stale, NTP corrects
+    assert clock.now() == START + timedelta(days=30, seconds=60.5)
+    assert steps == [pytest.approx(86400 * 30 + 0.5)]
+    assert clock.jumps[-1]['delta_seconds'] == pytest.approx(86400 * 30 + 0.5)
+
+    # Time keeps following the monotonic clock after the step
+    clocks.elapse(10)
+    assert clock.now() == START + timedelta(days=30, seconds=70.5)
+    assert len(steps) == 1
+
+
+def test_backward_step_never_moves_time_backwards_unnoticed():
+    clocks = Clocks(START.timestamp())
+    clock = SystemClock(clocks.wall, clocks.monotonic)
+    clocks.wall_now -= 3600
+    assert clock.check() == -3600
+    assert clock.now() == START - timedelta(hours=1)
+    assert clock.check() == 0.0
+
+
+def test_long_waits_are_capped_to_notice_steps():
+    clock = SystemClock(check_interval=0.05)
+
+    class Condition:
+        def wait(self, timeout):
+            self.timeout = timeout
+
+    condition = Condition()
+    clock.wait(condition, 8 * 3600)
+    assert condition.timeout == 0.05
+    clock.wait(condition, None)
+    assert condition.timeout == 0.05
+
+
+def test_dst_changes_are_not_clock_steps(new_york):
+    # 2024-03-10 02:00 EST jumps to 03:00 EDT
+    before = datetime(2024, 3, 10, 1, 30)
+    clocks = Clocks(before.timestamp())
+    clock = SystemClock(clocks.wall, clocks.monotonic)
+    clocks.elapse(3600)
+    assert clock.now() == datetime(2024, 3, 10, 3, 30)
+    assert list(clock.jumps) == []
+
+    # A naive subtraction says 3 hours, one of them never happened
+    assert seconds_between(datetime(2024, 3, 10, 1, 0), datetime(2024, 3, 10, 4, 0)) == 2 * 3600
+    # 2024-11-03 02:00 EDT falls back to 01:00 EST
+    assert seconds_between(datetime(2024, 11, 3, 0, 0), datetime(2024, 11, 3, 3, 0)) == 4 * 3600
+
+
+def test_every_rule_keeps_real_hours_across_dst(new_york):
+    rule = EveryRule(8, datetime(2024, 3, 9, 22, 0))
+    doses = rule.occurrences(rule.anchor, 3)
+    # Spring forward: 06:00 EST would be 7 real hours after 22:00, the dose moves to 07:00 EDT
+    assert doses == [datetime(2024, 3, 10, 7, 0), datetime(2024, 3, 10, 15, 0), datetime(2024, 3, 10, 23, 0)]
+    assert seconds_between(rule.anchor, doses[0]) == 8 * 3600
+    assert rule.latest_at_or_before(datetime(2024, 3, 10, 6, 59)) == rule.anchor
+    assert rule.between(rule.anchor, doses[-1]) == doses
+
+    # Fall back: 22:00 EDT + 8 real hours is 05:00 EST
+    rule = EveryRule(8, datetime(2024, 11, 2, 22, 0))
+    first = rule.next_after(rule.anchor)
+    assert first == datetime(2024, 11, 3, 5, 0)
+    assert seconds_between(rule.anchor, first) == 8 * 3600
+
+
+def test_dose_in_the_repeated_hour_fires_once_and_on_time(new_york):
+    # 18:30 EDT + 8 real hours is the second 01:30, in EST
+    anchor = datetime(2024, 11, 2, 18, 30)
+    rule = EveryRule(8, anchor)
+    stored = {1: format_time(anchor)}
+    clock = FakeClock(anchor - timedelta(minutes=1))
+    delivered = []
+
+    def on_due(tray_id):
+        plan = plan_catch_up(parse_time(stored[tray_id]), rule, clock.now(), 'skip')
+        if plan.deliver:
+            delivered.append(seconds_between(anchor, clock.now()))
+        stored[tray_id] = format_time(plan.next_due)
+        return parse_time(stored[tray_id])
+
+    scheduler = DispenseScheduler(lambda: [(1, 1, stored[1])], on_due, clock=clock)
+    for minute in range(17 * 60):
+        clock.advance(60)
+        scheduler.run_pending()
+        if minute == 60:
+            assert stored[1] == '2024-11-03T01:30-0500'
+    # Not at the first 01:30 (EDT), and not dispatched again and again while its naive time looks past
+    assert delivered == [0, 8 * 3600, 16 * 3600]
+    assert scheduler.stats['dispatched'] == 3
+
+
+def test_scheduler_records_the_effect_of_a_step():
+    clock = FakeClock(START)
+    schedule = {1: START + timedelta(hours=1), 2: START + timedelta(hours=20)}
+    dispatched = []
+
+    def on_due(tray_id):
+        dispatched.append(tray_id)
+        return None
+
+    scheduler = DispenseScheduler(
+        lambda: [(t, t, due.strftime("%Y-%m-%dT%H:%M")) for t, due in schedule.items()], on_due, clock=clock)
+    assert scheduler.run_pending() == 0
+
+    clock.jump(2 * 3600)
+    jump = scheduler.clock_jumps[-1]
+    assert jump['delta_seconds'] == 7200 and jump['trays_now_due'] == 1
+    assert jump['next_deadline_in'] == -3600  # Tray 1 is now an hour overdue
+    assert scheduler.run_pending() == 1 and dispatched == [1]
+    assert scheduler.stats['clock_jumps'] == 1
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Tests for the pooled SQLite connection layer
+"""
+
+import threading
+
+import pytest
+
+from db import Database
+
+
+def make_db(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    db.query('CREATE TABLE trays (tray_number INTEGER PRIMARY KEY, dispense_count INTEGER)')
+    return db
+
+
+def test_connections_use_wal_and_are_reused(tmp_path):
+    db = make_db(tmp_path)
+    assert db.query('PRAGMA journal_mode', one=True)[0] == 'wal'
+    assert db.query('PRAGMA synchronous', one=True)[0] == 1  # NORMAL
+
+    threads = [threading.Thread(target=db.query, args=('SELECT 1',)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert db.stats['connections_opened'] == 1
+
+
+def test_transaction_rolls_back_on_error(tmp_path):
+    db = make_db(tmp_path)
+    with pytest.raises(RuntimeError):
+        with db.transaction() as cursor:
+            cursor.execute('INSERT INTO trays VALUES (1, 0)')
+            raise RuntimeError("servo jammed")
+    assert db.query('SELECT COUNT(*) FROM trays', one=True)[0] == 0
+
+
+def test_nested_transactions_share_connection(tmp_path):
+    db = make_db(tmp_path)
+    with db.transaction() as outer:
+        outer.execute('INSERT INTO trays VALUES (1, 0)')
+        # Sees the outer transaction's uncommitted row
+        assert db.query('SELECT COUNT(*) FROM trays', one=True)[0] == 1
+    assert db.stats['transactions'] == 2
+    assert db.request_time() > 0
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Tests for concurrent tray actuation
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from dispense_executor import DispenseExecutor
+from dispense_pipeline import DispensePipeline, DispenseJob
+from scheduler import FakeClock
+
+
+def run_pipeline(executor, jobs, hold=0.05):
+    moving = []
+
+    def motion(job):
+        with executor.slot(job):
+            moving.append(job.tray_number)
+            time.sleep(hold)
+            job.dispensed = True
+        return False
+
+    pipeline = DispensePipeline(motion, lambda job: False, lambda job: False, motion_workers=len(jobs))
+    try:
+        for job in jobs:
+            pipeline.submit(job)
+        for job in jobs:
+            assert job.wait_for_motion(timeout=5)
+    finally:
+        pipeline.stop()
+    return moving
+
+
+def test_power_budget_limits_parallel_servos():
+    executor = DispenseExecutor(max_parallel=2)
+    started = time.perf_counter()
+    run_pipeline(executor, [DispenseJob(n, n, "Biogesic") for n in range(1, 7)], hold=0.1)
+    elapsed = time.perf_counter() - started
+    assert executor.stats()['max_active'] == 2
+    # Six 0.1s moves two at a time, not one after another
+    assert elapsed < 0.5
+
+
+def test_same_tray_never_moves_twice_at_once():
+    executor = DispenseExecutor(max_parallel=4)
+    run_pipeline(executor, [DispenseJob(1, 1, "Biogesic") for _ in range(4)], hold=0.02)
+    assert executor.stats()['max_active'] == 1
+    assert executor.stats()['dispatched'] == 4
+
+
+def test_tray_lock_does_not_hold_power():
+    executor = DispenseExecutor(max_parallel=1)
+    with executor.tray_lock(1):
+        # Tray 1 is journaling its dose, tray 2 can still move
+        with executor.power(DispenseJob(2, 2, "Advil")):
+            assert executor.stats()['active'] == 1
+    done = threading.Event()
+    with executor.tray_lock(1):
+        threading.Thread(target=lambda: (executor.slot(DispenseJob(1, 1, "x")).__enter__(), done.set())).start()
+        assert not done.wait(0.05)
+    assert done.wait(1)
+
+
+def test_lateness_is_measured_from_the_due_time():
+    start = datetime(2024, 1, 1, 8, 0)
+    clock = FakeClock(start + timedelta(seconds=90))
+    executor = DispenseExecutor(clock=clock)
+    job = DispenseJob(1, 1, "Biogesic", due=start)
+    with executor.slot(job):
+        pass
+    with executor.slot(DispenseJob(2, 2, "Advil", due=start + timedelta(minutes=5))):
+        pass
+    stats = executor.stats()
+    assert job.lateness == 90
+    assert stats['max_lateness'] == 90 and stats['avg_lateness'] == 45
+    assert stats['recent'][0] == {'tray_number': 1, 'due': '2024-01-01T08:00:00',
+                                  'started': '2024-01-01T08:01:30', 'lateness': 90.0}
+    assert stats['active'] == 0
+
+
+def test_failed_move_releases_slot():
+    executor = DispenseExecutor(max_parallel=1)
+    try:
+        with executor.slot(DispenseJob(1, 1, "Biogesic")):
+            raise RuntimeError("servo jammed")
+    except RuntimeError:
+        pass
+    done = threading.Event()
+    threading.Thread(target=lambda: (executor.slot(DispenseJob(1, 1, "x")).__enter__(), done.set())).start()
+    assert done.wait(1)
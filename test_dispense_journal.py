@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Fault-injection tests for the crash-safe dispense journal
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from db import Database
+from dispense_journal import (ACTUATED, ACTUATING, ANNOUNCED, EXPIRED, INTENT, INTERRUPTED, SKIPPED,
+                              UNANNOUNCED, DispenseJournal)
+from inventory import take_dose
+from migrations import migrate
+
+DUE = datetime(2024, 1, 1, 8, 0)
+
+
+class PowerLoss(Exception):
+    pass
+
+
+class Dispenser:
+    """The dispense steps of Medical_with_RPI against a real database, with a servo that counts moves"""
+
+    def __init__(self, path, crash_at=None, now=DUE + timedelta(seconds=5), capacity=30):
+        self.db = Database(path)
+        self.crash_at = crash_at
+        self.now = now
+        self.capacity = capacity
+        self.journal = DispenseJournal(self.db, clock=lambda: self.now, fault=self.fault)
+        self.moves = []
+        self.spoken = []
+
+    def fault(self, step):
+        if step == self.crash_at:
+            raise PowerLoss(step)
+
+    def dispense_due_tray(self, due=DUE):
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE tray_settings SET dispense_time = ? WHERE id = 1',
+                           ((due + timedelta(hours=8)).strftime('%Y-%m-%dT%H:%M'),))
+            entry_id = self.journal.record_intent(cursor, 1, 1, 'Biogesic 500mg', due)
+        if entry_id and self.actuate(entry_id):
+            self.announce(entry_id)
+
+    def actuate(self, entry_id):
+        with self.db.transaction() as cursor:
+            if not self.journal.begin_motion(cursor, entry_id):
+                return False
+            if not take_dose(cursor, 1, self.capacity):
+                self.journal.settle(cursor, entry_id, SKIPPED, 'Tray empty')
+                return False
+        self.fault('servo')
+        self.moves.append(entry_id)
+        with self.db.transaction() as cursor:
+            self.journal.actuated(cursor, entry_id)
+        return True
+
+    def announce(self, entry_id):
+        self.fault('speech')
+        self.spoken.append(entry_id)
+        with self.db.transaction() as cursor:
+            self.journal.announced(cursor, entry_id)
+
+    def recover(self):
+        for entry, stage in self.journal.recover():
+            if stage == 'motion' and self.actuate(entry['id']) or stage == 'information':
+                self.announce(entry['id'])
+
+    def state(self):
+        return self.db.query('SELECT state FROM dispense_journal', one=True)
+
+    def count(self):
+        return self.db.query('SELECT dispense_count FROM tray_settings WHERE id = 1', one=True)[0]
+
+    def history(self):
+        return self.db.query('SELECT COUNT(*) FROM dispense_history', one=True)[0]
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "test.db")
+    with Database(path).transaction() as cursor:
+        migrate(cursor)
+        cursor.execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+        cursor.execute('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, color)
+            VALUES (1, 1, 'Biogesic 500mg', '2024-01-01T08:00', '8', 'red')
+        ''')
+    return path
+
+
+@pytest.mark.parametrize('crash_at, moves, spoken, state', [
+    (None, 1, 1, ANNOUNCED),
+    (INTENT, 1, 1, ANNOUNCED),  # Rolled back with the dispense_time, the scheduler dispatches it again
+    (ACTUATING, 1, 1, ANNOUNCED),  # Still an intent, dispensed by recovery
+    ('servo', 0, 0, INTERRUPTED),  # Claimed for the servo, never moved again
+    (ACTUATED, 1, 0, INTERRUPTED),  # Moved but not logged, logged by recovery
+    ('speech', 1, 1, ANNOUNCED),  # Announcement replayed
+    (ANNOUNCED, 1, 2, ANNOUNCED),  # Spoken twice is harmless, dispensed twice is not
+])
+def test_power_loss_at_every_step_never_double_dispenses(path, crash_at, moves, spoken, state):
+    before = Dispenser(path, crash_at)
+    if crash_at is None:
+        before.dispense_due_tray()
+    else:
+        with pytest.raises(PowerLoss):
+            before.dispense_due_tray()
+
+    after = Dispenser(path)
+    after.recover()
+    # The scheduler dispatching the same dose again, as it does when the intent was lost
+    after.dispense_due_tray()
+    after.recover()
+
+    assert len(before.moves) + len(after.moves) == moves
+    assert len(before.spoken) + len(after.spoken) == spoken
+    assert after.state() == (state,)
+    assert after.count() == 1
+    assert after.history() == 1
+
+
+def test_long_outage_expires_intent_as_missed_dose(path):
+    with pytest.raises(PowerLoss):
+        Dispenser(path, ACTUATING).dispense_due_tray()
+    after = Dispenser(path, now=DUE + timedelta(hours=6))
+    after.recover()
+    assert after.moves == [] and after.state() == (EXPIRED,) and after.count() == 0
+    assert after.db.query('SELECT scheduled_time, action FROM missed_doses', one=True) == \
+        ('2024-01-01 08:00:00', 'expired')
+
+
+def test_stale_announcement_is_not_replayed(path):
+    with pytest.raises(PowerLoss):
+        Dispenser(path, 'speech').dispense_due_tray()
+    after = Dispenser(path, now=DUE + timedelta(days=1))
+    after.recover()
+    assert after.spoken == [] and after.state() == (UNANNOUNCED,) and after.count() == 1
+
+
+def test_only_one_worker_can_claim_a_dose(path):
+    dispenser = Dispenser(path)
+    with dispenser.db.transaction() as cursor:
+        entry_id = dispenser.journal.record_intent(cursor, 1, 1, 'Biogesic 500mg', DUE)
+        assert dispenser.journal.record_intent(cursor, 1, 1, 'Biogesic 500mg', DUE) is None
+        assert dispenser.journal.begin_motion(cursor, entry_id) is True
+        assert dispenser.journal.begin_motion(cursor, entry_id) is False
+    assert dispenser.journal.recover() == []
+    assert dispenser.journal.entries()[0]['state'] == INTERRUPTED
+
+
+def test_empty_tray_is_settled_without_moving(path):
+    dispenser = Dispenser(path, capacity=1)
+    dispenser.dispense_due_tray()
+    dispenser.dispense_due_tray(DUE + timedelta(hours=8))
+    assert len(dispenser.moves) == 1 and dispenser.count() == 1
+    assert [entry['state'] for entry in dispenser.journal.entries()] == [SKIPPED, ANNOUNCED]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Tests for per-dose dispense timings and latency percentiles
+"""
+
+import threading
+from datetime import datetime, timedelta
+
+from db import Database
+from dispense_executor import DispenseExecutor
+from dispense_metrics import DispenseMetrics, percentile
+from dispense_pipeline import DispensePipeline, DispenseJob
+from migrations import migrate
+from scheduler import FakeClock
+
+START = datetime(2024, 1, 1, 8, 0)
+
+
+def make_dose(delivery, dispensed=True):
+    return {'tray_number': 1, 'medicine': 'Biogesic', 'scheduled_time': None, 'started_time': None,
+            'dispensed': dispensed, 'lateness': delivery, 'delivery': delivery,
+            'queue_wait': 0.0, 'motion': 1.0, 'lookup': None, 'speech': None}
+
+
+def test_nearest_rank_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_summary_percentiles_histogram_and_slo():
+    metrics = DispenseMetrics(slo_seconds=5)
+    for delivery in [0.5] * 90 + [3] * 5 + [12] * 4 + [400]:
+        metrics.add(make_dose(delivery))
+    metrics.add(make_dose(None, dispensed=False))
+
+    summary = metrics.summary()
+    delivery = summary['percentiles']['delivery']
+    assert (delivery['p50'], delivery['p95'], delivery['p99'], delivery['max']) == (0.5, 3, 12, 400)
+    assert summary['percentiles']['lookup']['count'] == 0
+    assert summary['slo'] == {'target_seconds': 5, 'on_time': 95, 'measured': 100, 'percent': 95.0}
+    assert [b['count'] for b in summary['delivery_histogram']] == [90, 0, 5, 0, 4, 0, 0, 1]
+    assert summary['doses'] == 101 and summary['dispensed'] == 100
+
+
+def test_pipeline_records_every_dose(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        migrate(cursor)
+    clock = FakeClock(START + timedelta(seconds=2))
+    executor = DispenseExecutor(clock=clock)
+    metrics = DispenseMetrics(db)
+    recorded = threading.Semaphore(0)
+
+    def motion(job):
+        if job.tray_number == 2:
+            return False  # Empty tray
+        with executor.slot(job):
+            clock.advance(1.5)
+            job.dispensed = True
+        return True
+
+    def complete(job):
+        metrics.record(job)
+        recorded.release()
+
+    pipeline = DispensePipeline(motion, lambda job: True, lambda job: True, on_complete=complete)
+    try:
+        pipeline.submit(DispenseJob(1, 1, "Biogesic 500mg", due=START))
+        pipeline.submit(DispenseJob(2, 2, "Advil", due=START))
+        assert recorded.acquire(timeout=5) and recorded.acquire(timeout=5)
+    finally:
+        pipeline.stop()
+
+    doses = {d['tray_number']: d for d in metrics.doses()}
+    assert doses[1]['dispensed'] and doses[1]['lateness'] == 2.0 and doses[1]['delivery'] == 3.5
+    assert doses[1]['speech'] is not None and doses[1]['scheduled_time'] == '2024-01-01 08:00:00'
+    assert not doses[2]['dispensed'] and doses[2]['lookup'] is None
+
+    # Survives a restart through the dispense_metrics table
+    restarted = DispenseMetrics(db)
+    assert restarted.load_recent() == 2
+    assert restarted.summary()['percentiles']['delivery']['p50'] == 3.5
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Tests for the staged dispense pipeline
+"""
+
+import threading
+
+from dispense_pipeline import DispensePipeline, DispenseJob
+
+
+def test_motion_returns_before_announcement():
+    """Submitters are released as soon as the servo stage finishes"""
+    release_speech = threading.Event()
+    announced = []
+
+    def motion(job):
+        job.dispensed = True
+        return True
+
+    def information(job):
+        job.directions = f"Take {job.brand_name} with water"
+        return True
+
+    def announcement(job):
+        release_speech.wait(5)
+        announced.append(job.directions)
+        return True
+
+    pipeline = DispensePipeline(motion, information, announcement, maxsize=4)
+    try:
+        job = pipeline.submit(DispenseJob(1, 1, "Biogesic 500mg"))
+        assert job.wait_for_motion(timeout=5) is True
+        assert announced == []
+
+        release_speech.set()
+        pipeline.stop()
+        assert announced == ["Take Biogesic with water"]
+        stats = pipeline.stats()
+        assert stats['motion']['processed'] == 1
+        assert stats['announcement']['processed'] == 1
+        assert stats['information']['queue_depth'] == 0
+        assert set(job.timings) == {'motion', 'information', 'announcement'}
+    finally:
+        release_speech.set()
+        pipeline.stop()
+
+
+def test_failed_motion_skips_later_stages():
+    """An empty tray never reaches the lookup or speech stages"""
+    calls = []
+    pipeline = DispensePipeline(lambda job: False,
+                                lambda job: calls.append('information'),
+                                lambda job: calls.append('announcement'))
+    try:
+        job = pipeline.submit(DispenseJob(1, 2, "Neozep"))
+        assert job.wait_for_motion(timeout=5) is False
+    finally:
+        pipeline.stop()
+    assert calls == []
+
+
+def test_replay_from_a_later_stage():
+    """A dose dispensed before a restart only gets its announcement again"""
+    calls = []
+    pipeline = DispensePipeline(lambda job: calls.append('motion'),
+                                lambda job: calls.append('information'),
+                                lambda job: calls.append('announcement'))
+    try:
+        job = pipeline.submit(DispenseJob(1, 1, "Biogesic 500mg"), stage='information')
+        assert job.motion_done.is_set()
+    finally:
+        pipeline.stop()
+    assert calls == ['information', 'announcement']
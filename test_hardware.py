@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Tests for the simulated dispenser hardware
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from hardware import SimulatedSpiDev, simulate
+from rpi_servo import ServoController
+from scheduler import FakeClock
+from servo_drivers import SimulatedServoDriver, create_driver
+from tray_registry import TrayRegistry
+
+
+def test_simulated_spi_records_transfers():
+    spi = SimulatedSpiDev(0, 0)
+    assert spi.xfer2([1, 2, 3]) == [0, 0, 0]
+    assert spi.transfers == [[1, 2, 3]]
+
+
+def test_servo_moves_are_timestamped_on_virtual_clock():
+    start = datetime(2024, 1, 1, 8, 0)
+    clock = FakeClock(start)
+    driver = create_driver('sim', clock=clock)
+    assert isinstance(driver, SimulatedServoDriver)
+    controller = ServoController(TrayRegistry([{'number': 3, 'pin': 29, 'open_angle': 120, 'dwell': 2}]),
+                                 driver, clock, profiles={})
+    controller.dispense(3, 'Biogesic')
+
+    # 120 degrees at 300 deg/s plus 0.05s settle, each way
+    assert driver.moves == [(start, 3, 120), (start + timedelta(seconds=2.45), 3, 0)]
+    assert driver.angles == {3: None}
+    assert clock.now() == start + timedelta(seconds=2.9)
+
+
+def test_simulate_week_of_sixteen_trays():
+    stats = simulate(trays=16, days=7, interval_hours=8)
+    assert stats['dispenses'] == 16 * 7 * 3
+    assert stats['servo_moves'] == 2 * stats['dispenses']
+    # Trays due together are dispensed one after another, 1.7 virtual seconds each
+    assert stats['max_lateness'] == pytest.approx(15 * 1.7)
+    assert stats['dispenses_per_second'] > 100
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Tests for atomic tray inventory and refill forecasting
+"""
+
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from db import Database
+from inventory import claim_refill_alert, forecast_trays, last_dose_at, parse_capacity, take_dose
+from migrations import migrate
+from recurrence import EveryRule, TimesRule
+
+NOW = datetime(2024, 1, 1, 7, 0)  # A Monday
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        migrate(cursor)
+        cursor.execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+        cursor.executemany('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, schedule,
+                                       dispense_count, capacity, color)
+            VALUES (1, ?, ?, ?, ?, ?, ?, ?, 'red')
+        ''', [
+            (1, 'Biogesic 500mg', '2024-01-01T08:00', '8', None, 0, None),
+            (2, 'Neozep', '2024-01-01T09:00', 'Mon/Wed/Fri 9am',
+             '{"times": ["09:00"], "weekday_mask": 21}', 0, 4),
+            (3, 'Advil', '2024-01-01T08:00', '12', None, 10, 10),
+        ])
+    return db
+
+
+def test_capacity_from_the_form():
+    assert parse_capacity('', 30) is None
+    assert parse_capacity('20', 30) == 20
+    for text in ('0', '31', 'ten'):
+        with pytest.raises(ValueError):
+            parse_capacity(text, 30)
+
+
+def test_take_dose_stops_at_capacity(db):
+    with db.transaction() as cursor:
+        assert [take_dose(cursor, 2, 30) for _ in range(5)] == [True, True, True, True, False]
+        assert take_dose(cursor, 99, 30) is False  # Tray removed
+    assert db.query('SELECT dispense_count FROM tray_settings WHERE id = 2', one=True) == (4,)
+
+
+def test_concurrent_takes_never_overdraw(db):
+    results = []
+
+    def worker():
+        for _ in range(10):
+            with db.transaction() as cursor:
+                results.append(take_dose(cursor, 1, 30))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 30
+    assert db.query('SELECT dispense_count FROM tray_settings WHERE id = 1', one=True) == (30,)
+
+
+def test_last_dose_follows_the_schedule():
+    start = datetime(2024, 1, 1, 9, 0)
+    assert last_dose_at(EveryRule(8, start), start, 30) == start + timedelta(hours=8 * 29)
+    assert last_dose_at(TimesRule([(9, 0)], 0b0010101), start, 4) == datetime(2024, 1, 8, 9, 0)
+    assert last_dose_at(EveryRule(8, start), start, 1) == start
+    assert last_dose_at(EveryRule(8, start), start, 0) is None
+
+
+def test_forecasts_for_every_tray_in_one_call(db):
+    forecasts = {f['tray_number']: f for f in forecast_trays(db, {1: 30, 2: 30, 3: 30}, NOW)}
+    assert forecasts[1]['remaining'] == 30 and forecasts[1]['capacity'] == 30
+    assert forecasts[1]['empty_at'] == datetime(2024, 1, 11, 0, 0) and not forecasts[1]['refill_due']
+    # Four doses loaded, Monday to the next Monday
+    assert forecasts[2]['empty_at'] == datetime(2024, 1, 8, 9, 0)
+    assert forecasts[2]['days_left'] == 7.1 and not forecasts[2]['refill_due']
+    assert forecasts[3]['remaining'] == 0 and forecasts[3]['empty_at'] is None and forecasts[3]['refill_due']
+
+    later = NOW + timedelta(days=5)
+    tray, = forecast_trays(db, {2: 30}, later, tray_id=2)
+    assert tray['refill_due']
+
+
+def test_refill_alert_is_claimed_once_per_filling(db):
+    with db.transaction() as cursor:
+        assert claim_refill_alert(cursor, 3)
+        assert not claim_refill_alert(cursor, 3)
+        cursor.execute('UPDATE tray_settings SET dispense_count = 0, refill_alerted = 0 WHERE id = 3')
+        assert claim_refill_alert(cursor, 3)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Tests for the persistent FDA label cache
+"""
+
+import time
+
+from label_cache import LabelCache, FOUND, NOT_FOUND, ERROR
+
+
+class FakeFDA:
+    """Counts lookups and answers from a fixed label table"""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.calls = []
+        self.offline = False
+
+    def __call__(self, brand_name):
+        self.calls.append(brand_name)
+        if self.offline:
+            return ERROR, "Error fetching instructions: offline"
+        if brand_name.lower() in self.labels:
+            return FOUND, self.labels[brand_name.lower()]
+        return NOT_FOUND, "API error or medicine not found"
+
+
+def make_cache(tmp_path, **kwargs):
+    now = [1000.0]
+    cache = LabelCache(str(tmp_path / "labels.db"), clock=lambda: now[0], **kwargs)
+    return cache, now
+
+
+def test_hit_after_first_lookup(tmp_path):
+    """Brand names are normalized and only fetched once while fresh"""
+    cache, _ = make_cache(tmp_path)
+    fda = FakeFDA({'biogesic': 'Take 1 tablet every 4 hours'})
+
+    assert cache.get('Biogesic', fda) == 'Take 1 tablet every 4 hours'
+    assert cache.get('  BIOGESIC ', fda) == 'Take 1 tablet every 4 hours'
+    assert fda.calls == ['Biogesic']
+    assert cache.stats()['hits'] == 1
+
+
+def test_negative_results_are_cached_but_errors_are_not(tmp_path):
+    cache, now = make_cache(tmp_path, negative_ttl=60)
+    fda = FakeFDA({})
+
+    cache.get('Unknown', fda)
+    cache.get('Unknown', fda)
+    assert len(fda.calls) == 1
+
+    fda.offline = True
+    cache.get('Neozep', fda)
+    cache.get('Neozep', fda)
+    assert fda.calls[1:] == ['Neozep', 'Neozep']
+
+
+def test_stale_entry_served_while_refreshing(tmp_path):
+    cache, now = make_cache(tmp_path, ttl=60)
+    fda = FakeFDA({'biogesic': 'old directions'})
+    cache.get('Biogesic', fda)
+
+    fda.labels['biogesic'] = 'new directions'
+    now[0] += 120
+    assert cache.get('Biogesic', fda) == 'old directions'
+    for _ in range(100):
+        if cache.is_fresh('Biogesic'):
+            break
+        time.sleep(0.01)
+    assert cache.get('Biogesic', fda) == 'new directions'
+
+
+def test_lru_eviction_and_warm(tmp_path):
+    cache, now = make_cache(tmp_path, max_entries=2)
+    fda = FakeFDA({'a': '1', 'b': '2', 'c': '3'})
+
+    assert cache.warm(['A', 'B', 'a'], fda) == 2
+    now[0] += 1
+    cache.get('A', fda)  # B is now least recently used
+    now[0] += 1
+    cache.get('C', fda)
+    assert cache.stats()['entries'] == 2
+    assert cache.is_fresh('A') and cache.is_fresh('C')
+    assert not cache.is_fresh('B')
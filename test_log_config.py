@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for structured, queued and rate limited logging
+"""
+
+import json
+import logging
+import queue
+import time
+
+from log_config import (JsonFormatter, RateLimitFilter, NonBlockingQueueHandler, BatchedRotatingFileHandler,
+                        setup_logging, stop_logging)
+
+
+def make_record(msg, *args, level=logging.ERROR, **fields):
+    record = logging.LogRecord('scheduler', level, __file__, 1, msg, args, None)
+    record.__dict__.update(fields)
+    return record
+
+
+def test_json_record_carries_extra_fields():
+    entry = json.loads(JsonFormatter().format(make_record("Moving Tray %s", 2, level=logging.INFO, tray=2)))
+    assert entry['msg'] == "Moving Tray 2"
+    assert entry['level'] == 'INFO' and entry['logger'] == 'scheduler'
+    assert entry['tray'] == 2
+
+
+def test_repeated_errors_are_rate_limited():
+    now = [0.0]
+    limiter = RateLimitFilter(burst=3, period=60, clock=lambda: now[0])
+    template = "Error processing row for due check: %s, Error: %s"
+
+    passed = [limiter.filter(make_record(template, row, 'bad time')) for row in range(100)]
+    assert passed.count(True) == 3
+    # Other templates and info records are not affected
+    assert limiter.filter(make_record("Error processing tray %s, Error: %s", 1, 'x'))
+    assert all(limiter.filter(make_record("Moving Tray %s", 1, level=logging.INFO)) for _ in range(10))
+
+    now[0] = 61
+    record = make_record(template, 1, 'bad time')
+    assert limiter.filter(record)
+    assert record.suppressed == 97
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=2))
+    started = time.perf_counter()
+    for i in range(10):
+        handler.handle(make_record("Dose %s", i))
+    assert time.perf_counter() - started < 0.5
+    assert handler.dropped == 8
+    assert handler.queue.get_nowait().msg == "Dose 0"
+
+
+def test_log_file_rotates_at_max_bytes(tmp_path):
+    path = tmp_path / "dispenser.log"
+    handler = BatchedRotatingFileHandler(str(path), max_bytes=1000, backups=2, flush_seconds=0)
+    handler.setFormatter(JsonFormatter())
+    for i in range(100):
+        handler.handle(make_record("Medicine dispensed from Tray %s", i, level=logging.INFO))
+    handler.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['dispenser.log', 'dispenser.log.1', 'dispenser.log.2']
+    assert all(p.stat().st_size <= 1000 for p in tmp_path.iterdir())
+
+
+def test_setup_logging_writes_json_lines(tmp_path):
+    path = tmp_path / "dispenser.log"
+    setup_logging(str(path), level='INFO', console='off')
+    try:
+        logging.getLogger('dispense_pipeline').error("Error in %s stage for Tray %s: %s", 'motion', 1, 'stalled',
+                                                     extra={'stage': 'motion', 'tray': 1})
+    finally:
+        stop_logging()
+    entry = json.loads(path.read_text().splitlines()[-1])
+    assert entry['msg'] == "Error in motion stage for Tray 1: stalled"
+    assert (entry['stage'], entry['tray']) == ('motion', 1)
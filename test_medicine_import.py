@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Tests for the bulk medicine catalogue importer
+"""
+
+import io
+import json
+
+import pytest
+
+from db import Database
+from migrations import migrate
+from medicine_import import import_medicines, import_file
+from medicine_search import MedicineSearch
+
+CSV = """Generic Name,Brand Name,Dosage Strength,Dosage Form,Classification,Pharmacologic Category,Manufacturer
+Paracetamol,Biogesic,500mg,Tablet,Analgesic,Antipyretic,Unilab
+Ibuprofen,Advil,200mg,Capsule,NSAID,Analgesic,Pfizer
+,,,,,,
+"""
+
+
+def make_db(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        migrate(cursor)
+    return db
+
+
+def test_csv_import_skips_empty_rows(tmp_path):
+    db = make_db(tmp_path)
+    stats = import_medicines(db, io.StringIO(CSV), 'csv')
+    assert stats['rows'] == 2 and stats['skipped'] == 1
+    assert db.query('SELECT brand_name, manufacturer FROM medicine ORDER BY id') == [
+        ('Biogesic', 'Unilab'), ('Advil', 'Pfizer')]
+
+
+def test_reimport_upserts_on_natural_key(tmp_path):
+    db = make_db(tmp_path)
+    import_medicines(db, io.StringIO(CSV), 'csv')
+    updated = CSV.replace('Unilab', 'Unilab Inc.')
+    import_medicines(db, io.StringIO(updated), 'csv', batch_size=1)
+    assert db.query('SELECT COUNT(*) FROM medicine', one=True)[0] == 2
+    assert db.query("SELECT manufacturer FROM medicine WHERE brand_name = 'Biogesic'", one=True)[0] == 'Unilab Inc.'
+
+
+def test_jsonl_import_in_batches_rebuilds_search(tmp_path):
+    db = make_db(tmp_path)
+    path = tmp_path / "catalogue.jsonl"
+    with open(path, 'w') as f:
+        for i in range(1200):
+            f.write(json.dumps({'generic_name': 'Cetirizine', 'brand_name': f'Allerkid {i}',
+                                'dosage_strength': '10mg', 'dosage_form': 'Tablet'}) + '\n')
+    stats = import_file(db, str(path), batch_size=500)
+    assert stats['rows'] == 1200 and stats['batches'] == 3
+    assert stats['rows_per_second'] > 0
+
+    search = MedicineSearch(db)
+    assert search.search('allerkid')[1] == 1200
+
+    # Triggers are back, so later edits are indexed again
+    db.query("UPDATE medicine SET brand_name = 'Zyrtec' WHERE brand_name = 'Allerkid 7'")
+    assert search.search('zyrtec')[1] == 1
+
+
+def test_jsonl_line_that_is_not_an_object_is_reported(tmp_path):
+    db = make_db(tmp_path)
+    for line in ('[1, 2]', '"x"', '3'):
+        stream = io.StringIO(json.dumps({'generic_name': 'Paracetamol', 'brand_name': 'Biogesic'}) + '\n' + line + '\n')
+        with pytest.raises(ValueError, match='line 2: expected a JSON object'):
+            import_medicines(db, stream, 'jsonl')
+
+
+def test_malformed_csv_is_a_value_error(tmp_path):
+    db = make_db(tmp_path)
+    stream = io.StringIO(CSV + 'Cetirizine,"' + 'x' * 200000 + '",10mg,Tablet,,,\n')
+    with pytest.raises(ValueError, match='line 5: field larger than field limit'):
+        import_medicines(db, stream, 'csv')
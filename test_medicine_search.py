@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tests for the ranked full-text medicine search
+"""
+
+import medicine_search
+from db import Database
+from migrations import migrate
+from medicine_search import MedicineSearch, prefix_query
+
+MEDICINES = [
+    ('Paracetamol', 'Biogesic', '500mg', 'Tablet', 'Analgesic', 'Antipyretic', 'Unilab'),
+    ('Ibuprofen', 'Advil', '200mg', 'Capsule', 'NSAID', 'Analgesic', 'Pfizer'),
+    ('Biotin', 'Hairvit', '10mg', 'Capsule', 'Vitamin', 'Supplement', 'Biogenix'),
+    ('Amoxicillin', 'Amoxil', '500mg', 'Capsule', 'Antibiotic', 'Penicillin', 'GSK'),
+]
+
+
+def make_search(tmp_path, extra=0):
+    db = Database(str(tmp_path / "test.db"))
+    rows = MEDICINES + [(f'Generic {i}', f'Cetirizine {i}', '10mg', 'Tablet', 'Antihistamine', 'H1', 'Lab')
+                        for i in range(extra)]
+    with db.transaction() as cursor:
+        migrate(cursor)
+        cursor.executemany('''
+            INSERT INTO medicine (generic_name, brand_name, dosage_strength, dosage_form,
+                                  classification, pharmacologic_category, manufacturer)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    return db, MedicineSearch(db)
+
+
+def test_prefix_query_quotes_tokens():
+    assert prefix_query('Para 500"') == '"para"* AND "500"*'
+
+
+def test_prefix_match_ranks_brand_name_first(tmp_path):
+    db, search = make_search(tmp_path)
+    rows, total = search.search('bio')
+    # Biogesic matches on brand name, Hairvit only on generic name and manufacturer
+    assert total == 2
+    assert [row[2] for row in rows] == ['Biogesic', 'Hairvit']
+
+
+def test_searches_generic_name_and_classification(tmp_path):
+    db, search = make_search(tmp_path)
+    assert [row[2] for row in search.search('paracet')[0]] == ['Biogesic']
+    assert {row[2] for row in search.search('analgesic')[0]} == {'Biogesic', 'Advil'}
+
+
+def test_typo_falls_back_to_trigram(tmp_path):
+    db, search = make_search(tmp_path)
+    rows, total = search.search('paracetmol')
+    assert total >= 1
+    assert rows[0][1] == 'Paracetamol'
+
+
+def test_without_trigram_tokenizer_substrings_use_like(tmp_path, monkeypatch):
+    # SQLite before 3.34, e.g. Raspberry Pi OS Buster
+    monkeypatch.setattr(medicine_search, 'trigram_available', lambda cursor: False)
+    db, search = make_search(tmp_path)
+    assert db.query("SELECT 1 FROM sqlite_master WHERE name = 'medicine_trigram'") == []
+    assert [row[2] for row in search.search('bio')[0]] == ['Biogesic', 'Hairvit']
+    assert [row[2] for row in search.search('gesic')[0]] == ['Biogesic']
+
+
+def test_pagination(tmp_path):
+    db, search = make_search(tmp_path, extra=30)
+    first, total = search.search('cetirizine', page=1, per_page=25)
+    second, _ = search.search('cetirizine', page=2, per_page=25)
+    assert total == 30
+    assert len(first) == 25 and len(second) == 5
+    assert not {row[0] for row in first} & {row[0] for row in second}
+
+
+def test_lru_cache_and_invalidate(tmp_path):
+    db, search = make_search(tmp_path)
+    search.search('advil')
+    search.search('  ADVIL ')
+    assert search.stats()['hits'] == 1
+
+    db.query("UPDATE medicine SET brand_name = 'Medicol' WHERE brand_name = 'Advil'")
+    assert search.search('advil')[1] == 1  # Stale until invalidated
+    search.invalidate()
+    assert search.search('advil')[1] == 0
+
+
+def test_triggers_keep_index_in_sync(tmp_path):
+    db, search = make_search(tmp_path)
+    db.query("UPDATE medicine SET brand_name = 'Medicol' WHERE brand_name = 'Advil'")
+    db.query("DELETE FROM medicine WHERE brand_name = 'Amoxil'")
+    assert [row[2] for row in search.search('medicol')[0]] == ['Medicol']
+    assert 'Amoxil' not in [row[2] for row in search.search('amoxil')[0]]
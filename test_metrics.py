@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for the Prometheus metrics registry and exposition format
+"""
+
+import time
+
+from db import Database, TRANSACTION_SECONDS
+from metrics import Registry
+
+
+def test_counter_and_gauge_exposition():
+    registry = Registry()
+    checks = registry.counter('checks_total', 'Password checks', ['method', 'result'])
+    checks.inc('sha256', True)
+    checks.inc('sha256', True)
+    checks.inc('sha256', False, amount=3)
+    depth = registry.gauge('queue_depth', 'Queue depth', ['stage'])
+    depth.set(1.5, 'say "hi"\n')
+
+    text = registry.render()
+    assert '# TYPE checks_total counter' in text
+    assert 'checks_total{method="sha256",result="True"} 2' in text
+    assert 'checks_total{method="sha256",result="False"} 3' in text
+    assert 'queue_depth{stage="say \\"hi\\"\\n"} 1.5' in text
+    assert text.endswith('\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency', ['route'], buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        latency.observe(value, 'index')
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{route="index",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{route="index",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{route="index",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="index"} 2.65' in lines
+    assert 'latency_seconds_count{route="index"} 4' in lines
+    assert latency.snapshot('index') == (4, 2.65)
+
+
+def test_collectors_run_at_scrape_time():
+    registry = Registry()
+    hits = registry.counter('cache_hits_total', 'Hits', ['cache'])
+    depth = registry.gauge('queue_depth', 'Depth')
+    stats = {'hits': 0, 'depth': 0}
+    registry.add_collector(lambda: (hits.set_total(stats['hits'], 'audio'), depth.set(stats['depth'])))
+
+    stats.update(hits=7, depth=2)
+    text = registry.render()
+    assert '# TYPE cache_hits_total counter' in text
+    assert 'cache_hits_total{cache="audio"} 7' in text and 'queue_depth 2' in text
+    # Re-registering returns the metric that already holds the values
+    assert registry.counter('cache_hits_total', 'Hits', ['cache']) is hits
+
+
+def test_db_time_is_labelled_by_caller(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        cursor.execute('CREATE TABLE t (x INTEGER)')
+    db.query('SELECT * FROM t')
+
+    count, _ = TRANSACTION_SECONDS.snapshot('test_db_time_is_labelled_by_caller')
+    assert count == 2
+
+
+def test_observe_overhead_is_negligible():
+    registry = Registry()
+    latency = registry.histogram('overhead_seconds', 'Overhead', ['route'])
+    started = time.perf_counter()
+    for i in range(100000):
+        latency.observe(i / 100000, 'index')
+    # A few microseconds per observation, the cheapest dispense step takes milliseconds
+    assert time.perf_counter() - started < 1.0
+    assert latency.snapshot('index')[0] == 100000
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Tests for the versioned schema migrations and the hot query plans
+"""
+
+import sqlite3
+
+import pytest
+
+from migrations import migrate, schema_version, MIGRATIONS, table_columns
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    migrate(cursor)
+    yield cursor
+    conn.close()
+
+
+def query_plan(cursor, query, args=()):
+    cursor.execute(f'EXPLAIN QUERY PLAN {query}', args)
+    return ' | '.join(row[3] for row in cursor.fetchall())
+
+
+def test_migrations_are_recorded_and_idempotent(cursor):
+    assert schema_version(cursor) == MIGRATIONS[-1][0]
+    assert migrate(cursor) == MIGRATIONS[-1][0]
+
+
+def test_upgrades_legacy_database():
+    """A database from before name/dispense_count existed gains the columns"""
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    cursor.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL UNIQUE, password TEXT NOT NULL)')
+    cursor.execute('''CREATE TABLE tray_settings (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                      tray_number INTEGER NOT NULL, description TEXT NOT NULL, alert BOOLEAN,
+                      dispense_time DATETIME, interval TEXT, color TEXT)''')
+    cursor.execute("INSERT INTO tray_settings (user_id, tray_number, description, dispense_time) VALUES (1, 1, 'A', '2024-01-01 08:00:00')")
+    cursor.execute("INSERT INTO tray_settings (user_id, tray_number, description, dispense_time) VALUES (2, 1, 'B', '2024-01-01T09:00')")
+    migrate(cursor)
+
+    assert {'name', 'dispense_count'} <= table_columns(cursor, 'tray_settings')
+    assert 'is_admin' in table_columns(cursor, 'users')
+    cursor.execute('SELECT description, dispense_time FROM tray_settings')
+    assert cursor.fetchall() == [('A', '2024-01-01T08:00')]
+    # The second prescription for tray 1 is kept aside, not deleted
+    cursor.execute('SELECT id, user_id, description FROM tray_settings_conflicts')
+    assert cursor.fetchall() == [(2, 2, 'B')]
+    conn.close()
+
+
+def test_duplicate_medicines_are_kept_aside_and_nulls_untouched():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    cursor.execute('''CREATE TABLE medicine (id INTEGER PRIMARY KEY AUTOINCREMENT, generic_name TEXT, brand_name TEXT,
+                      dosage_strength TEXT, dosage_form TEXT, classification TEXT,
+                      pharmacologic_category TEXT, manufacturer TEXT)''')
+    cursor.executemany('INSERT INTO medicine (generic_name, brand_name, dosage_strength, dosage_form) VALUES (?, ?, ?, ?)', [
+        ('Paracetamol', 'Biogesic', '500mg', 'Tablet'),
+        ('Paracetamol', 'Biogesic', '500mg', 'Tablet'),
+        ('Ibuprofen', 'Advil', None, 'Tablet'),
+        ('Ibuprofen', 'Advil', None, 'Tablet'),
+    ])
+    migrate(cursor)
+    cursor.execute('SELECT id, dosage_strength FROM medicine ORDER BY id')
+    assert cursor.fetchall() == [(2, '500mg'), (3, None), (4, None)]
+    cursor.execute('SELECT id FROM medicine_conflicts')
+    assert cursor.fetchall() == [(1,)]
+    conn.close()
+
+
+def test_tray_number_is_unique(cursor):
+    cursor.execute("INSERT INTO tray_settings (user_id, tray_number, description) VALUES (1, 1, 'A')")
+    with pytest.raises(sqlite3.IntegrityError):
+        cursor.execute("INSERT INTO tray_settings (user_id, tray_number, description) VALUES (2, 1, 'B')")
+
+
+def test_tray_lookups_use_indexes(cursor):
+    plan = query_plan(cursor, 'SELECT * FROM tray_settings WHERE tray_number = ?', (1,))
+    assert 'USING INDEX idx_tray_settings_tray_number' in plan
+    plan = query_plan(cursor, 'SELECT tray_number, description, dispense_count, name FROM tray_settings WHERE user_id = ?', (1,))
+    assert 'USING INDEX idx_tray_settings_user_id' in plan
+
+
+def test_dashboard_history_needs_no_sort(cursor):
+    plan = query_plan(cursor, 'SELECT username, tray_number, medicine_description, dispense_time FROM dispense_history '
+                              'WHERE user_id = ? ORDER BY dispense_time DESC LIMIT 10', (1,))
+    assert 'idx_dispense_history_user_time' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_today_count_uses_time_index(cursor):
+    plan = query_plan(cursor, 'SELECT COUNT(*) FROM dispense_history WHERE dispense_time >= ? AND dispense_time < ?',
+                      ('2024-01-01', '2024-01-02'))
+    assert 'idx_dispense_history_time' in plan
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Tests for missed-dose catch-up after the dispenser has been off
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from db import Database
+from migrations import migrate
+from missed_doses import check_policy, plan_catch_up, record_missed
+from recurrence import EveryRule
+from scheduler import DispenseScheduler, FakeClock
+
+START = datetime(2024, 1, 1, 8, 0)
+EIGHT_HOURS = timedelta(hours=8)
+
+
+def test_next_occurrence_is_constant_time():
+    rule = EveryRule(8, START)
+    assert rule.next_after(START - timedelta(minutes=1)) == START
+    assert rule.next_after(START) == START + EIGHT_HOURS
+    assert rule.next_after(START + timedelta(hours=9)) == START + timedelta(hours=16)
+
+    started = time.perf_counter()
+    ten_years = START + timedelta(days=3652, minutes=5)
+    assert EveryRule(1, START).next_after(ten_years) == START + timedelta(days=3652, hours=1)
+    assert time.perf_counter() - started < 0.01
+
+
+def test_unknown_policy_is_refused():
+    check_policy('deliver_one')
+    with pytest.raises(ValueError):
+        check_policy('deliver')
+
+
+def test_on_time_dose_is_always_delivered():
+    for policy in ('skip', 'deliver_one', 'alert'):
+        plan = plan_catch_up(START, EIGHT_HOURS, START + timedelta(minutes=10), policy)
+        assert plan.deliver == START and plan.missed == [] and not plan.alert
+        assert plan.next_due == START + EIGHT_HOURS
+
+
+@pytest.mark.parametrize('policy, delivered, missed', [
+    ('skip', None, 64),
+    ('deliver_one', START + timedelta(days=21), 63),
+    ('alert', None, 64),
+])
+def test_three_weeks_of_downtime(policy, delivered, missed):
+    now = START + timedelta(days=21, hours=1)  # Latest occurrence an hour ago, past the grace period
+    plan = plan_catch_up(START, EIGHT_HOURS, now, policy)
+    assert plan.deliver == delivered
+    assert len(plan.missed) == missed
+    assert plan.missed[0] == START
+    assert plan.alert == (policy == 'alert')
+    assert plan.next_due == START + timedelta(days=21, hours=8)
+
+
+def test_back_in_grace_of_latest_dose_delivers_it():
+    now = START + timedelta(days=14, minutes=5)
+    plan = plan_catch_up(START, EIGHT_HOURS, now, 'skip')
+    assert plan.deliver == START + timedelta(days=14)
+    assert len(plan.missed) == 14 * 3
+    assert plan.next_due == START + timedelta(days=14, hours=8)
+
+
+def test_missed_doses_recorded_in_bulk(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    plan = plan_catch_up(START, timedelta(hours=1), START + timedelta(weeks=4, hours=2, minutes=45), 'skip')
+    with db.transaction() as cursor:
+        migrate(cursor)
+        assert record_missed(cursor, 1, 1, 'Biogesic', plan.missed, 'skipped') == 4 * 7 * 24 + 3
+    assert db.stats['transactions'] == 1
+    rows = db.query('SELECT MIN(scheduled_time), COUNT(*) FROM missed_doses WHERE action = ?', ('skipped',))
+    assert rows[0] == ('2024-01-01 08:00:00', 675)
+
+
+def test_scheduler_dispatches_once_after_weeks_off():
+    clock = FakeClock(START + timedelta(weeks=3, hours=3))
+    schedule = {1: START, 2: START + timedelta(hours=4)}
+    dispensed = []
+
+    def on_due(tray_id):
+        plan = plan_catch_up(schedule[tray_id], EIGHT_HOURS, clock.now(), 'deliver_one')
+        if plan.deliver:
+            dispensed.append((tray_id, plan.deliver))
+        schedule[tray_id] = plan.next_due
+        return plan.next_due
+
+    scheduler = DispenseScheduler(lambda: [(t, t, due.strftime("%Y-%m-%dT%H:%M")) for t, due in schedule.items()],
+                                  on_due, clock=clock)
+    assert scheduler.run_pending() == 2
+    assert scheduler.run_pending() == 0
+    assert dispensed == [(1, START + timedelta(weeks=3)), (2, START + timedelta(weeks=3, hours=-4))]
+    assert all(due > clock.now() for due in schedule.values())
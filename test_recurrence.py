@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Tests for structured dispense schedules and their catch-up
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from db import Database
+from migrations import migrate
+from missed_doses import plan_catch_up
+from recurrence import (EVERY_DAY, EveryRule, TimesRule, compile_schedule, from_json, load_rule,
+                        parse_schedule)
+from tray_state import TrayStateCache
+
+START = datetime(2024, 1, 1, 7, 30)  # A Monday
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('8', EveryRule(8, START)),
+    ('8h', EveryRule(8, START)),
+    ('Every 6 hours', EveryRule(6, START)),
+    ('08:00 and 20:00 daily', TimesRule([(8, 0), (20, 0)])),
+    ('Mon/Wed/Fri 9am', TimesRule([(9, 0)], 0b0010101)),
+    ('weekdays 7:15am, 9:30 pm', TimesRule([(7, 15), (21, 30)], 0b0011111)),
+    ('Tuesday and Saturday 12pm', TimesRule([(12, 0)], 0b0100010)),
+    ('daily', TimesRule([(7, 30)])),
+])
+def test_parse_examples(text, expected):
+    assert parse_schedule(text, START) == expected
+
+
+@pytest.mark.parametrize('text', ['', 'twice a month', '0', '500 hours', '25:00 daily',
+                                  'twice daily', '8 hours daily', 'Mon 8'])
+def test_parse_errors_explain_themselves(text):
+    with pytest.raises(ValueError) as error:
+        parse_schedule(text, START)
+    assert str(error.value)
+
+
+def test_next_occurrences_in_one_call():
+    rule = parse_schedule('08:00 and 20:00 daily', START)
+    assert rule.occurrences(START, 3) == [datetime(2024, 1, 1, 8), datetime(2024, 1, 1, 20), datetime(2024, 1, 2, 8)]
+    assert EveryRule(8, START).occurrences(START, 2) == [START + timedelta(hours=8), START + timedelta(hours=16)]
+
+
+def test_weekday_mask_skips_days_off():
+    rule = parse_schedule('Mon/Wed/Fri 9am', START)
+    assert [dt.strftime('%a %d') for dt in rule.occurrences(START, 4)] == ['Mon 01', 'Wed 03', 'Fri 05', 'Mon 08']
+    assert rule.latest_at_or_before(datetime(2024, 1, 7, 23, 0)) == datetime(2024, 1, 5, 9)
+    assert rule.describe() == '09:00 on Mon, Wed, Fri'
+
+
+def test_json_round_trip():
+    for rule in (EveryRule(12, START), TimesRule([(20, 0), (8, 0)], 0b1100000)):
+        stored = rule.to_json()
+        assert from_json(stored) == rule
+        assert from_json(stored).to_json() == stored
+    assert json.loads(TimesRule([(8, 0)]).to_json()) == {'times': ['08:00'], 'weekday_mask': EVERY_DAY}
+
+
+def test_compile_moves_first_dose_onto_the_schedule():
+    schedule, first = compile_schedule('08:00 and 20:00 daily', '2024-01-01T09:00')
+    assert first == '2024-01-01T20:00'
+    assert from_json(schedule) == TimesRule([(8, 0), (20, 0)])
+    assert compile_schedule('8', '2024-01-01T09:00')[1] == '2024-01-01T09:00'
+    with pytest.raises(ValueError):
+        compile_schedule('8', '')
+
+
+def test_rows_from_before_schedules_fall_back_to_interval_text():
+    assert load_rule(None, '12 hours', START) == EveryRule(12, START)
+    assert load_rule(None, 'whenever', START) == EveryRule(1, START)
+    assert load_rule('{"times": ["08:00"], "weekday_mask": 127}', '12', START) == TimesRule([(8, 0)])
+
+
+def test_catch_up_with_times_of_day_over_weeks_off():
+    rule = parse_schedule('Mon/Wed/Fri 9am', START)
+    due = datetime(2024, 1, 1, 9)
+    now = datetime(2024, 1, 22, 12)  # Three weeks later, a Monday three hours after the dose
+    plan = plan_catch_up(due, rule, now, 'deliver_one')
+    assert plan.deliver == datetime(2024, 1, 22, 9)
+    assert len(plan.missed) == 9
+    assert plan.next_due == datetime(2024, 1, 24, 9)
+
+    plan = plan_catch_up(due, rule, datetime(2024, 1, 22, 9, 10), 'skip')
+    assert plan.deliver == datetime(2024, 1, 22, 9)  # Within the grace period
+
+
+def test_existing_trays_are_backfilled_and_shown(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        migrate(cursor)
+        cursor.execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+        cursor.execute('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, color)
+            VALUES (1, 1, 'Biogesic 500mg', '2024-01-01T08:00', '8 hrs', 'red')
+        ''')
+        # Run the schedule migration again as if the row predated it
+        cursor.execute('PRAGMA user_version = 7')
+        migrate(cursor)
+    stored = db.query('SELECT schedule FROM tray_settings', one=True)[0]
+    assert from_json(stored) == EveryRule(8, datetime(2024, 1, 1, 8))
+
+    tray, = TrayStateCache(db).snapshot()
+    assert tray['schedule'] == 'Every 8 hours'
+    assert tray['upcoming'] == ['January 01, 2024, 08:00 AM', 'January 01, 2024, 04:00 PM',
+                                'January 02, 2024, 12:00 AM']
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Tests for the event-driven dispense scheduler using a fake clock
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from scheduler import DispenseScheduler, FakeClock
+
+START = datetime(2024, 1, 1, 8, 0)
+
+
+def make_scheduler(rows, interval_hours=None):
+    """Build a scheduler over an in-memory tray table"""
+    clock = FakeClock(START)
+    dispensed = []
+
+    def on_due(tray_id):
+        dispensed.append((tray_id, clock.now()))
+        if interval_hours is None:
+            return None
+        return clock.now() + timedelta(hours=interval_hours)
+
+    schedule = {tray_id: (tray_number, due) for tray_id, (tray_number, due) in rows.items()}
+    scheduler = DispenseScheduler(
+        lambda: [(tray_id, number, due.strftime("%Y-%m-%dT%H:%M")) for tray_id, (number, due) in schedule.items()],
+        on_due, clock=clock)
+    return scheduler, clock, dispensed, schedule
+
+
+def test_dispatches_in_deadline_order():
+    """Trays fire in order of their due time, ties broken by tray number"""
+    rows = {
+        10: (2, START + timedelta(minutes=5)),
+        11: (1, START + timedelta(minutes=5)),
+        12: (3, START + timedelta(minutes=1)),
+    }
+    scheduler, clock, dispensed, _ = make_scheduler(rows)
+
+    assert scheduler.run_pending() == 0
+    assert scheduler.next_deadline() == START + timedelta(minutes=1)
+
+    clock.advance(60)
+    assert scheduler.run_pending() == 1
+    clock.advance(240)
+    assert scheduler.run_pending() == 2
+    assert [tray_id for tray_id, _ in dispensed] == [12, 11, 10]
+    assert scheduler.stats['max_lateness'] == 0.0
+
+
+def test_reschedules_from_on_due():
+    """The next due time returned by on_due is pushed back on the heap"""
+    rows = {1: (1, START + timedelta(minutes=1))}
+    scheduler, clock, dispensed, _ = make_scheduler(rows, interval_hours=8)
+
+    clock.advance(60)
+    scheduler.run_pending()
+    assert scheduler.next_deadline() == START + timedelta(hours=8, minutes=1)
+    clock.advance(8 * 3600)
+    scheduler.run_pending()
+    assert len(dispensed) == 2
+
+
+def test_failed_dispatch_is_retried():
+    """A tray whose on_due raised is dispatched again after the retry delay"""
+    clock = FakeClock(START)
+    calls = []
+
+    def on_due(tray_id):
+        calls.append(clock.now())
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        return None
+
+    scheduler = DispenseScheduler(lambda: [(1, 1, "2024-01-01T08:00")], on_due, clock=clock, retry_seconds=10)
+    assert scheduler.run_pending() == 1
+    assert scheduler.next_deadline() == START + timedelta(seconds=10)
+    clock.advance(10)
+    assert scheduler.run_pending() == 1
+    assert calls == [START, START + timedelta(seconds=10)]
+    assert scheduler.stats['retries'] == 1
+
+
+def test_notify_changed_reloads_schedule():
+    """Tray edits replace stale deadlines instead of adding duplicates"""
+    rows = {1: (1, START + timedelta(minutes=30))}
+    scheduler, clock, dispensed, schedule = make_scheduler(rows)
+    scheduler.run_pending()
+
+    schedule[1] = (1, START + timedelta(minutes=2))
+    scheduler.notify_changed()
+    scheduler.run_pending()
+    assert scheduler.next_deadline() == START + timedelta(minutes=2)
+
+    del schedule[1]
+    scheduler.notify_changed()
+    scheduler.run_pending()
+    assert scheduler.next_deadline() is None
+    clock.advance(3600)
+    assert scheduler.run_pending() == 0
+    assert dispensed == []
+
+
+def test_run_loop_sleeps_until_deadline():
+    """The background loop only wakes on clock advances and tray changes"""
+    rows = {1: (1, START + timedelta(minutes=10))}
+    scheduler, clock, dispensed, _ = make_scheduler(rows)
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+    try:
+        time.sleep(0.05)
+        assert dispensed == []
+        clock.advance(600)
+        for _ in range(100):
+            if dispensed:
+                break
+            time.sleep(0.01)
+        assert dispensed == [(1, START + timedelta(minutes=10))]
+        assert scheduler.stats['wakeups'] <= 2
+    finally:
+        scheduler.stop()
+        thread.join(timeout=1)
+    assert not thread.is_alive()
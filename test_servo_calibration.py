@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Tests for servo calibration profiles and computed settle times
+"""
+
+from datetime import datetime
+
+import pytest
+
+import servo_calibration
+from rpi_servo import ServoController
+from scheduler import FakeClock
+from servo_calibration import ServoProfile, load_profiles, save_profiles
+from servo_drivers import PCA9685Driver, FakeI2CBus, SimulatedServoDriver
+from tray_registry import TrayRegistry
+
+
+def test_settle_time_follows_travel_and_speed():
+    profile = ServoProfile(speed=450, settle=0.05)
+    assert profile.settle_time(0, 90) == pytest.approx(0.25)
+    assert profile.settle_time(90, 90) == pytest.approx(0.05)
+    # Unknown start, assume the far end
+    assert profile.settle_time(None, 30) == pytest.approx(150 / 450 + 0.05)
+
+
+def test_calibrated_profile_shortens_dispense_cycle():
+    clock = FakeClock(datetime(2024, 1, 1, 8, 0))
+    registry = TrayRegistry([{'number': 1, 'pin': 29}, {'number': 2, 'pin': 31}])
+    profiles = {2: ServoProfile(speed=600, dwell=0.4)}
+    controller = ServoController(registry, SimulatedServoDriver(clock), clock, profiles)
+    controller.move(1, 0)
+    controller.move(2, 0)
+
+    # Default: 0.35s each way plus the tray's 1s dwell, the old fixed sleeps took 2s
+    assert controller.dispense(1, "Biogesic") == pytest.approx(1.7)
+    assert controller.dispense(2, "Biogesic") == pytest.approx(0.8)
+
+
+def test_profile_pulse_range_reaches_driver():
+    bus = FakeI2CBus()
+    driver = PCA9685Driver(bus)
+    tray = TrayRegistry([{'number': 1, 'channel': 0}]).get(1)
+    driver.set_angle(tray, 180, ServoProfile(min_pulse_us=500, max_pulse_us=2500))
+    # 2500us of a 20ms period
+    assert bus.writes[-1][2][2:] == [512 & 0xFF, 512 >> 8]
+
+
+def test_cli_saves_profiles(tmp_path, monkeypatch):
+    path = str(tmp_path / "calibration.json")
+    monkeypatch.setattr(servo_calibration, 'SERVO_CALIBRATION', path)
+    monkeypatch.setattr(servo_calibration.load_profiles, '__defaults__', (path,))
+    monkeypatch.setattr(servo_calibration.save_profiles, '__defaults__', (path,))
+    assert servo_calibration.main(['set', '3', 'speed=480', 'dwell=0.3']) == 0
+    assert servo_calibration.main(['set', '3', 'min_pulse_us=520']) == 0
+
+    profile = load_profiles(path)[3]
+    assert (profile.speed, profile.dwell, profile.min_pulse_us) == (480, 0.3, 520)
+    with pytest.raises(ValueError):
+        servo_calibration.main(['set', '3', 'torque=9'])
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    save_profiles({1: ServoProfile(speed=350), 12: ServoProfile(dwell=0.5)}, path)
+    profiles = load_profiles(path)
+    assert sorted(profiles) == [1, 12]
+    assert profiles[1].speed == 350 and profiles[12].dwell == 0.5
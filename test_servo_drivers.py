@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Tests for the servo driver backends against the fake I2C bus and pigpio daemon
+"""
+
+import pytest
+
+import rpi_servo
+from rpi_servo import ServoController
+from servo_drivers import PCA9685Driver, PigpioDriver, FakeI2CBus, FakePigpio, create_driver, pulse_width
+from tray_registry import TrayRegistry
+
+ADDRESS = 0x40
+
+
+def make_driver():
+    bus = FakeI2CBus()
+    return bus, PCA9685Driver(bus, address=ADDRESS)
+
+
+def channel_registers(bus, channel):
+    base = PCA9685Driver.LED0_ON_L + 4 * channel
+    return [bus.read_byte_data(ADDRESS, base + i) for i in range(4)]
+
+
+def test_pulse_width_is_clamped():
+    assert pulse_width(0) == 400
+    assert pulse_width(90) == 1400
+    assert pulse_width(270) == 2400
+    assert pulse_width(90, 500, 2500) == 1500
+
+
+def test_pca9685_sets_50hz_prescale_and_wakes():
+    bus, driver = make_driver()
+    assert bus.read_byte_data(ADDRESS, PCA9685Driver.PRESCALE) == 121
+    mode1 = bus.read_byte_data(ADDRESS, PCA9685Driver.MODE1)
+    assert not mode1 & PCA9685Driver.SLEEP
+    assert mode1 & PCA9685Driver.AUTO_INCREMENT
+
+
+def test_pca9685_angle_and_release():
+    bus, driver = make_driver()
+    registry = TrayRegistry([{'number': 5, 'channel': 12}, {'number': 6}])
+    driver.set_angle(registry.get(5), 90)
+    # 1400us of a 20ms period
+    assert channel_registers(bus, 12) == [0, 0, 287 & 0xFF, 287 >> 8]
+    driver.release(registry.get(5))
+    assert channel_registers(bus, 12) == [0, 0, 0, 0x10]
+    # Without a channel, tray N uses channel N - 1
+    driver.set_angle(registry.get(6), 0)
+    assert channel_registers(bus, 5)[2] == 82
+
+
+def test_controller_dispenses_sixteen_trays(monkeypatch):
+    monkeypatch.setattr(rpi_servo.time, 'sleep', lambda seconds: None)
+    bus, driver = make_driver()
+    registry = TrayRegistry([{'number': n, 'channel': n - 1, 'open_angle': 120} for n in range(1, 17)])
+    controller = ServoController(registry, driver)
+    for number in registry.numbers():
+        controller.dispense(number, 'Biogesic')
+
+    # open, release, close, release on every channel
+    channel_writes = [register for _, register, values in bus.writes if len(values) == 4]
+    assert len(channel_writes) == 16 * 4
+    for number in registry.numbers():
+        assert channel_registers(bus, number - 1) == [0, 0, 0, 0x10]
+
+    controller.cleanup()
+    assert bus.read_byte_data(ADDRESS, PCA9685Driver.MODE1) == PCA9685Driver.SLEEP
+
+
+def test_pigpio_pulses_stay_in_the_daemon_range():
+    pi = FakePigpio()
+    driver = PigpioDriver(pi=pi)
+    tray = TrayRegistry([{'number': 1, 'pin': 29}]).get(1)
+    driver.set_angle(tray, 90)
+    assert pi.pulses[5] == 1400  # BOARD 29 is BCM 5
+    # The default close angle would be 400us, which pigpio refuses
+    driver.set_angle(tray, 0)
+    assert pi.pulses[5] == 500
+    driver.release(tray)
+    assert pi.pulses[5] == 0
+    driver.cleanup()
+    assert pi.stopped
+
+
+def test_unknown_driver():
+    with pytest.raises(ValueError):
+        create_driver('stepper')
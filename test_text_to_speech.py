@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Tests for the pluggable speech engines and fallback
+"""
+
+import wave
+
+from audio_cache import AudioCache
+from text_to_speech import SpeechSynthesizer, SpeechEngine, NullEngine, create_synthesizer
+
+
+class BrokenEngine(SpeechEngine):
+    name = 'broken'
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def synthesize(self, text, path):
+        self.calls += 1
+        raise OSError("network unreachable")
+
+
+def test_null_engine_writes_playable_wav(tmp_path):
+    path = str(tmp_path / "out.wav")
+    NullEngine().synthesize("Tray 1: Biogesic was dispensed.", path)
+    with wave.open(path) as wav_file:
+        assert wav_file.getnchannels() == 1
+        assert wav_file.getnframes() > 0
+
+
+def test_falls_back_and_skips_failed_engine(tmp_path):
+    now = [0.0]
+    broken = BrokenEngine()
+    synthesizer = SpeechSynthesizer([broken, NullEngine()], retry_after=60, clock=lambda: now[0])
+    cache = AudioCache(str(tmp_path))
+
+    path, engine = synthesizer.render("first", cache)
+    assert engine.name == 'null' and path.endswith('.wav')
+    synthesizer.render("second", cache)
+    assert broken.calls == 1
+
+    now[0] += 61
+    synthesizer.render("third", cache)
+    assert broken.calls == 2
+
+
+def test_create_synthesizer_ignores_unknown_names():
+    synthesizer = create_synthesizer("espeak-ng, null")
+    assert [engine.name for engine in synthesizer.engines] == ['null']
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Tests for the live tray event broadcaster behind /events and /events.json
+"""
+
+import json
+import threading
+import time
+
+from db import Database
+from migrations import migrate
+from tray_events import TrayEventBroadcaster
+from tray_state import TrayStateCache
+
+
+def make_broadcaster(tmp_path, **kwargs):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        migrate(cursor)
+        cursor.execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+        cursor.execute('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, color, name)
+            VALUES (1, 1, 'Biogesic 500mg', '2024-01-01T08:00', '8', 'red', NULL)
+        ''')
+    state = TrayStateCache(db, lambda: {1: 30})
+    return db, state, TrayEventBroadcaster(state, **kwargs)
+
+
+def parse(message):
+    fields = dict(line.split(': ', 1) for line in message.strip().splitlines())
+    return int(fields['id']), fields['event'], json.loads(fields['data'])
+
+
+def next_event(stream):
+    message = next(stream)
+    while message.startswith(':'):
+        message = next(stream)
+    return parse(message)
+
+
+def test_only_changed_trays_are_broadcast(tmp_path):
+    db, state, events = make_broadcaster(tmp_path)
+    assert events.broadcast_changes() == 0  # Baseline
+    assert events.broadcast_changes() == 0  # Countdown moved, nothing else
+
+    state.update(1, dispense_count=1)
+    assert events.broadcast_changes() == 1
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM tray_settings WHERE tray_number = 1')
+    state.invalidate()
+    assert events.broadcast_changes() == 1
+
+    kinds = [(event, data['tray_number'], data.get('dispense_count')) for _, event, data in events.events_since(0)]
+    assert kinds == [('tray', 1, 1), ('tray_removed', 1, None)]
+
+
+def test_stream_sends_snapshot_then_deltas(tmp_path):
+    db, state, events = make_broadcaster(tmp_path, keepalive=0.05)
+    events.start()
+    try:
+        stream = events.stream()
+        assert next(stream).startswith('retry:')
+        event_id, event, data = parse(next(stream))
+        assert event == 'snapshot' and data['trays'][0]['description'] == 'Biogesic 500mg'
+
+        assert next(stream) == ': keepalive\n\n'
+        assert events.subscribers == 1
+        state.update(1, dispense_count=5)
+        event_id, event, data = next_event(stream)
+        assert (event, data['dispense_count']) == ('tray', 5)
+
+        events.publish('dispense', {'tray_number': 1, 'medicine': 'Biogesic 500mg'})
+        assert next_event(stream)[1] == 'dispense'
+        stream.close()
+        assert events.subscribers == 0
+    finally:
+        events.stop()
+
+
+def test_stream_resumes_after_last_event_id(tmp_path):
+    db, state, events = make_broadcaster(tmp_path, history=2, keepalive=0.05)
+    for n in range(3):
+        events.publish('dispense', {'n': n})
+    stream = events.stream(last_id=2)
+    next(stream)
+    assert parse(next(stream))[:2] == (3, 'dispense')
+    # Event 1 has left the history, start over from a snapshot
+    stream = events.stream(last_id=0)
+    next(stream)
+    assert parse(next(stream))[1] == 'snapshot'
+    events.stop()
+
+
+def test_polling_fallback_waits_for_changes(tmp_path):
+    db, state, events = make_broadcaster(tmp_path)
+    first = events.poll()
+    assert first['last_id'] == 0 and first['snapshot'][0]['tray_number'] == 1
+
+    started = time.monotonic()
+    assert events.poll(first['last_id'], wait=0.05) == {'last_id': 0, 'events': []}
+    assert time.monotonic() - started >= 0.04
+
+    timer = threading.Timer(0.05, events.publish, ('dispense', {'tray_number': 1}))
+    timer.start()
+    body = events.poll(0, wait=5)
+    assert body['last_id'] == 1 and body['events'][0]['event'] == 'dispense'
+    # A client from before a restart is ahead of us and gets a fresh snapshot
+    assert 'snapshot' in events.poll(50)
+
+
+def test_public_subscribers_see_only_the_login_page_fields(tmp_path):
+    db, state, events = make_broadcaster(tmp_path, keepalive=0.05)
+    events.publish('missed_dose', {'tray_number': 1, 'username': 'alice'})
+    events.publish('tray', state.snapshot()[0])
+    body = events.poll(0, public=True)
+    assert body['last_id'] == 2 and [e['event'] for e in body['events']] == ['tray']
+    assert 'username' not in body['events'][0]['data']
+    assert 'username' not in events.poll(public=True)['snapshot'][0]
+    assert 'username' in events.poll()['snapshot'][0]
+
+    stream = events.stream(public=True)
+    next(stream)
+    event_id, event, data = parse(next(stream))
+    assert event == 'snapshot'
+    assert set(data['trays'][0]) <= {'tray_number', 'description', 'next_dispense', 'dispense_count', 'capacity', 'countdown'}
+    stream = events.stream(last_id=0, public=True)
+    next(stream)
+    assert parse(next(stream))[:2] == (2, 'tray')
+    events.stop()
+
+
+def test_one_snapshot_load_per_change_for_all_subscribers(tmp_path):
+    db, state, events = make_broadcaster(tmp_path, keepalive=0.05)
+    events.start()
+    try:
+        streams = [events.stream() for _ in range(20)]
+        for stream in streams:
+            next(stream), next(stream)
+        loads = state.loads
+        with db.transaction() as cursor:
+            cursor.execute("UPDATE tray_settings SET description = 'Advil' WHERE tray_number = 1")
+        state.invalidate()
+        for stream in streams:
+            assert next_event(stream)[2]['description'] == 'Advil'
+        assert state.loads == loads + 1
+    finally:
+        events.stop()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Tests for the tray registry
+"""
+
+import json
+
+import pytest
+
+from tray_registry import TrayRegistry, TrayConfig, load_registry
+
+
+def test_default_registry_matches_original_unit(tmp_path):
+    registry = load_registry(str(tmp_path / "missing.json"))
+    assert registry.numbers() == [1, 2]
+    assert registry.get(1).pin == 29 and registry.get(2).pin == 31
+    assert registry.capacity(2) == 30
+
+
+def test_load_sixteen_trays_from_json(tmp_path):
+    path = tmp_path / "trays.json"
+    trays = [{'number': n, 'channel': n - 1, 'capacity': 60, 'dwell': 0.5} for n in range(16, 0, -1)]
+    path.write_text(json.dumps(trays))
+    registry = load_registry(str(path))
+    assert len(registry) == 16
+    assert [tray.number for tray in registry] == list(range(1, 17))
+    assert registry.get('12').channel == 11
+    assert registry.get(12).open_angle == 90
+
+
+def test_unknown_and_duplicate_trays():
+    registry = TrayRegistry([TrayConfig(1, pin=29)])
+    assert 1 in registry and '1' in registry
+    assert 3 not in registry and None not in registry
+    with pytest.raises(KeyError):
+        registry.get(3)
+    with pytest.raises(ValueError):
+        registry.add({'number': 1, 'pin': 31})
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for the in-memory tray status snapshot
+"""
+
+from datetime import datetime
+
+from db import Database
+from migrations import migrate
+from tray_state import TrayStateCache
+
+DUE = datetime(2024, 1, 1, 8, 0)
+
+
+def make_cache(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    with db.transaction() as cursor:
+        migrate(cursor)
+        cursor.execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+        cursor.execute('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, color, name)
+            VALUES (1, 1, 'Biogesic 500mg', '2024-01-01T08:00', '8', 'red', NULL)
+        ''')
+    now = [DUE.timestamp() - 90]
+    cache = TrayStateCache(db, lambda: {1: 30, 2: 30}, clock=lambda: now[0])
+    return db, cache, now
+
+
+def test_renders_do_no_sql_or_parsing(tmp_path):
+    db, cache, now = make_cache(tmp_path)
+    tray = cache.snapshot()[0]
+    assert tray['countdown'] == 90
+    assert tray['next_dispense'] == "January 01, 2024, 08:00 AM"
+    assert (tray['username'], tray['capacity']) == ('alice', 30)
+
+    transactions = db.stats['transactions']
+    now[0] += 60
+    for _ in range(100):
+        assert cache.snapshot()[0]['countdown'] == 30
+    assert db.stats['transactions'] == transactions
+    assert cache.loads == 1
+
+    now[0] += 3600
+    assert cache.snapshot()[0]['countdown'] == 0
+
+
+def test_write_through_update_keeps_snapshot(tmp_path):
+    db, cache, now = make_cache(tmp_path)
+    cache.snapshot()
+    cache.update(1, dispense_count=4, dispense_time='2024-01-01T16:00')
+    tray = cache.snapshot()[0]
+    assert tray['dispense_count'] == 4
+    assert tray['next_dispense'] == "January 01, 2024, 04:00 PM"
+    assert tray['countdown'] == 90 + 8 * 3600
+    assert cache.loads == 1 and cache.version == 1
+
+
+def test_invalidate_reloads_changed_rows(tmp_path):
+    db, cache, now = make_cache(tmp_path)
+    cache.snapshot()
+    with db.transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO tray_settings (user_id, tray_number, description, dispense_time, interval, color, name)
+            VALUES (1, 2, 'Advil', 'not a time', '8', 'blue', 'Bob')
+        ''')
+    assert len(cache.snapshot()) == 1  # Not told yet
+    cache.invalidate()
+
+    trays = {t['tray_number']: t for t in cache.snapshot()}
+    assert cache.loads == 2
+    assert trays[2]['username'] == 'Bob'
+    assert trays[2]['countdown'] is None and trays[2]['next_dispense'] == 'not a time'
@@ -0,0 +1,215 @@
+"""
+Pluggable speech synthesis.
+
+Every engine writes one phrase to an audio file. SpeechSynthesizer tries
+the configured engines in order and falls back to the next one when an
+engine is missing or fails, so announcements keep working offline.
+
+Engine order comes from SPEECH_ENGINES, e.g. "piper,gtts,pyttsx3,null".
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import wave
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+SPEECH_ENGINES = os.getenv('SPEECH_ENGINES', 'piper,gtts,pyttsx3,null')
+PIPER_MODEL = os.getenv('PIPER_MODEL', 'models/en_US-lessac-medium.onnx')
+
+SYNTHESIS_SECONDS = metrics.histogram('dispenser_tts_synthesis_seconds', 'Speech synthesis time on audio cache misses',
+                                      ['engine'], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+
+
+class SpeechEngine:
+    """Base class, subclasses implement load() and synthesize()"""
+
+    name = 'base'
+    extension = 'wav'
+
+    def __init__(self):
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def voice(self):
+        """Identifies the voice in audio cache keys"""
+        return self.name
+
+    def load(self):
+        pass
+
+    def ensure_loaded(self):
+        with self._lock:
+            if not self._loaded:
+                self.load()
+                self._loaded = True
+
+    def synthesize(self, text, path):
+        raise NotImplementedError
+
+
+class GTTSEngine(SpeechEngine):
+    """Google Translate TTS, needs the network"""
+
+    name = 'gtts'
+    extension = 'mp3'
+
+    def __init__(self, lang='en'):
+        super().__init__()
+        self.lang = lang
+
+    def load(self):
+        from gtts import gTTS
+        self._gtts = gTTS
+
+    def synthesize(self, text, path):
+        self.ensure_loaded()
+        self._gtts(text=text, lang=self.lang, slow=False).save(path)
+
+
+class Pyttsx3Engine(SpeechEngine):
+    """Offline eSpeak/SAPI voices through pyttsx3"""
+
+    name = 'pyttsx3'
+
+    def load(self):
+        import pyttsx3
+        self._engine = pyttsx3.init()
+
+    def synthesize(self, text, path):
+        self.ensure_loaded()
+        # The pyttsx3 driver loop is not reentrant
+        with self._lock:
+            self._engine.save_to_file(text, path)
+            self._engine.runAndWait()
+
+
+class PiperEngine(SpeechEngine):
+    """Offline neural voice, the ONNX model stays resident after the first load"""
+
+    name = 'piper'
+
+    def __init__(self, model_path=PIPER_MODEL):
+        super().__init__()
+        self.model_path = model_path
+
+    @property
+    def voice(self):
+        return f"piper:{os.path.basename(self.model_path)}"
+
+    def load(self):
+        if not os.path.exists(self.model_path):
+            raise FileNotFoundError(f"Piper model not found: {self.model_path}")
+        from piper.voice import PiperVoice
+        self._voice = PiperVoice.load(self.model_path)
+
+    def synthesize(self, text, path):
+        self.ensure_loaded()
+        with wave.open(path, 'wb') as wav_file:
+            # piper-tts >= 1.3 renamed synthesize() to synthesize_wav()
+            if hasattr(self._voice, 'synthesize_wav'):
+                self._voice.synthesize_wav(text, wav_file)
+            else:
+                self._voice.synthesize(text, wav_file)
+
+
+class NullEngine(SpeechEngine):
+    """Writes silent WAV files, used as last resort and for offline benchmarks"""
+
+    name = 'null'
+    sample_rate = 22050  # Same as piper and eSpeak so the PCM sink can stream it
+
+    def synthesize(self, text, path):
+        # Roughly the duration a real voice would need for the phrase
+        seconds = min(0.3 * len(text.split()), 30)
+        with wave.open(path, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+            wav_file.writeframes(b'\x00\x00' * int(self.sample_rate * seconds))
+
+
+ENGINES = {
+    'gtts': GTTSEngine,
+    'pyttsx3': Pyttsx3Engine,
+    'piper': PiperEngine,
+    'null': NullEngine,
+}
+
+
+class SpeechSynthesizer:
+    """Tries engines in order, skipping ones that recently failed"""
+
+    def __init__(self, engines, retry_after=300, clock=time.monotonic):
+        self.engines = engines
+        self.retry_after = retry_after
+        self.clock = clock
+        self._failed = {}  # engine name -> time of last failure
+
+    def candidates(self):
+        now = self.clock()
+        return [engine for engine in self.engines
+                if now - self._failed.get(engine.name, -self.retry_after) >= self.retry_after]
+
+    def render(self, text, audio_cache=None, lang='en'):
+        """Return (path, engine) of an audio file for text"""
+        last_error = None
+        for engine in self.candidates():
+            def synthesize(text, path, engine=engine):
+                started = time.perf_counter()
+                engine.synthesize(text, path)
+                SYNTHESIS_SECONDS.observe(time.perf_counter() - started, engine.name)
+
+            try:
+                if audio_cache is not None:
+                    path = audio_cache.get_or_render(text, lang, engine.voice, synthesize, engine.extension)
+                else:
+                    path = f"speak.{engine.extension}"
+                    synthesize(text, path)
+                return path, engine
+            except Exception as e:
+                log.warning("Speech engine %s failed, falling back: %s", engine.name, e, extra={'engine': engine.name})
+                self._failed[engine.name] = self.clock()
+                last_error = e
+        raise RuntimeError(f"No speech engine available: {last_error}")
+
+
+def create_synthesizer(names=SPEECH_ENGINES):
+    engines = [ENGINES[name.strip()]() for name in names.split(',') if name.strip() in ENGINES]
+    return SpeechSynthesizer(engines)
+
+
+def benchmark(names, text, repeat=5):
+    """Time cold and warm synthesis of text for each engine, without the audio cache"""
+    results = {}
+    for name in names:
+        engine = ENGINES[name]()
+        path = f"bench_{name}.{engine.extension}"
+        timings = []
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                engine.synthesize(text, path)
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            print(f"{name}: unavailable ({e})")
+            continue
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        results[name] = timings
+        print(f"{name}: first {timings[0]:.3f}s, warm avg {sum(timings[1:]) / max(len(timings) - 1, 1):.3f}s")
+    return results
+
+
+if __name__ == '__main__':
+    # Usage: python text_to_speech.py [engine,engine,...] [text]
+    names = sys.argv[1].split(',') if len(sys.argv) > 1 else list(ENGINES)
+    text = sys.argv[2] if len(sys.argv) > 2 else "Tray 1: Biogesic was dispensed. Please take your medicine now."
+    benchmark(names, text)
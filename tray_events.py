@@ -0,0 +1,175 @@
+"""
+Live tray status for the kiosk and admin screens.
+
+One background thread watches the tray snapshot; when it changes the
+thread diffs it against what was last broadcast and appends one "tray"
+event per changed tray to a short history. Dispenses are appended as
+"dispense" events by the pipeline. Every open page reads that same
+history, over Server-Sent Events from /events or by polling
+/events.json where EventSource is not available, so the cost of a
+change does not grow with the number of screens.
+
+Countdowns are not diffed, pages count down locally and every event
+carries the current countdown to correct them.
+
+Subscribers without a session (the kiosk on /login) get the public view:
+only the tray fields the login page shows and no dispense or missed
+dose events, so usernames and schedules stay behind the login.
+"""
+
+import json
+import logging
+import threading
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Seconds between SSE comments that keep proxies from closing an idle stream
+KEEPALIVE_SECONDS = 15
+
+# Longest wait /events.json may ask for
+MAX_POLL_WAIT = 25
+
+
+def format_event(event_id, event, data):
+    """One Server-Sent Events message"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+# Tray fields shown on /login, all an unauthenticated subscriber receives
+PUBLIC_FIELDS = ('tray_number', 'description', 'next_dispense', 'dispense_count', 'capacity', 'countdown')
+
+# Events an unauthenticated subscriber receives, with their data made public
+PUBLIC_EVENTS = ('snapshot', 'tray', 'tray_removed')
+
+
+def public_tray(tray):
+    return {k: tray[k] for k in PUBLIC_FIELDS if k in tray}
+
+
+def public_view(event, data):
+    """What an unauthenticated subscriber may see of an event, None to leave it out"""
+    if event not in PUBLIC_EVENTS:
+        return None
+    if event == 'snapshot':
+        return {'trays': [public_tray(t) for t in data['trays']]}
+    return public_tray(data)
+
+
+def _without_countdown(tray):
+    return {k: v for k, v in tray.items() if k != 'countdown'}
+
+
+class TrayEventBroadcaster:
+    """Diffs the tray snapshot on change and fans events out to every subscriber"""
+
+    def __init__(self, state, history=256, keepalive=KEEPALIVE_SECONDS):
+        self.state = state
+        self.keepalive = keepalive
+        self._history = deque(maxlen=history)  # (id, event, data)
+        self._cond = threading.Condition()
+        self._changed = threading.Event()
+        self._trays = None  # tray number -> last broadcast status
+        self._thread = None
+        self._stopped = False
+        self.last_id = 0
+        self.subscribers = 0
+        state.add_listener(self._changed.set)
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="tray-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._changed.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def publish(self, event, data):
+        with self._cond:
+            self.last_id += 1
+            self._history.append((self.last_id, event, data))
+            self._cond.notify_all()
+        return self.last_id
+
+    def _run(self):
+        self.broadcast_changes()  # Baseline
+        while True:
+            self._changed.wait()
+            self._changed.clear()
+            if self._stopped:
+                return
+            try:
+                self.broadcast_changes()
+            except Exception as e:
+                log.error("Error broadcasting tray changes: %s", e)
+
+    def broadcast_changes(self):
+        """Publish a tray event for every tray that differs from the last broadcast"""
+        trays = {t['tray_number']: t for t in self.state.snapshot()}
+        previous, self._trays = self._trays, {n: _without_countdown(t) for n, t in trays.items()}
+        if previous is None:
+            return 0
+        published = 0
+        for number, tray in trays.items():
+            if previous.get(number) != self._trays[number]:
+                self.publish('tray', tray)
+                published += 1
+        for number in previous.keys() - trays.keys():
+            self.publish('tray_removed', {'tray_number': number})
+            published += 1
+        return published
+
+    def events_since(self, last_id, timeout=0):
+        """Events after last_id, waiting up to timeout for one; None when last_id has left the history"""
+        with self._cond:
+            if timeout:
+                self._cond.wait_for(lambda: self.last_id > last_id or self._stopped, timeout)
+            if last_id > self.last_id or (self._history and last_id < self._history[0][0] - 1):
+                # Ahead of us (we restarted) or too far behind to replay
+                return None
+            return [e for e in self._history if e[0] > last_id]
+
+    def poll(self, since=None, wait=0, public=False):
+        """JSON polling fallback: new events, or the whole snapshot on the first poll or when since cannot be resumed"""
+        events = self.events_since(since, min(wait, MAX_POLL_WAIT)) if since is not None else None
+        if events is None:
+            last_id = self.last_id
+            trays = self.state.snapshot()
+            return {'last_id': last_id, 'snapshot': [public_tray(t) for t in trays] if public else trays}
+        body = []
+        for i, event, data in events:
+            if public:
+                data = public_view(event, data)
+                if data is None:
+                    continue
+            body.append({'id': i, 'event': event, 'data': data})
+        return {'last_id': events[-1][0] if events else since, 'events': body}
+
+    def stream(self, last_id=None, public=False):
+        """Server-Sent Events generator for one subscriber, resuming after last_id when given"""
+        view = public_view if public else (lambda event, data: data)
+        with self._cond:
+            self.subscribers += 1
+        try:
+            yield "retry: 3000\n\n"
+            events = self.events_since(last_id) if last_id is not None else None
+            while not self._stopped:
+                if events is None:
+                    last_id = self.last_id
+                    yield format_event(last_id, 'snapshot', view('snapshot', {'trays': self.state.snapshot()}))
+                elif events:
+                    for last_id, event, data in events:
+                        data = view(event, data)
+                        if data is not None:
+                            yield format_event(last_id, event, data)
+                else:
+                    yield ": keepalive\n\n"
+                events = self.events_since(last_id, self.keepalive)
+        finally:
+            with self._cond:
+                self.subscribers -= 1
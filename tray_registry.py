@@ -0,0 +1,92 @@
+"""
+Tray registry.
+
+Maps each tray number to the pin or channel that drives its servo, the
+open and close angles, how long the gate stays open and how many doses
+the tray holds. The defaults describe the original two-tray unit; larger
+units list their trays in a JSON file named by TRAY_CONFIG:
+
+    [{"number": 1, "pin": 29}, {"number": 2, "pin": 31, "capacity": 60}, ...]
+"""
+
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+TRAY_CONFIG = os.getenv('TRAY_CONFIG', 'trays.json')
+
+# (tray number, BOARD pin) of the original unit, SG90 servos on GPIO 32/33
+DEFAULT_TRAYS = [
+    {'number': 1, 'pin': 29},
+    {'number': 2, 'pin': 31},
+]
+
+
+class TrayConfig:
+    """Hardware settings for one tray"""
+
+    def __init__(self, number, pin=None, channel=None, open_angle=90, close_angle=0, dwell=1.0, capacity=30):
+        self.number = int(number)
+        self.pin = pin
+        self.channel = channel  # Output on a servo driver board instead of a GPIO pin
+        self.open_angle = open_angle
+        self.close_angle = close_angle
+        self.dwell = dwell
+        self.capacity = capacity
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class TrayRegistry:
+    """Tray number -> TrayConfig"""
+
+    def __init__(self, trays=()):
+        self._trays = {}
+        for tray in trays:
+            self.add(tray)
+
+    def add(self, tray):
+        if not isinstance(tray, TrayConfig):
+            tray = TrayConfig(**tray)
+        if tray.number in self._trays:
+            raise ValueError(f"Tray {tray.number} is configured twice")
+        self._trays[tray.number] = tray
+        return tray
+
+    def get(self, tray_number):
+        """Return the tray, raises KeyError for a tray this unit does not have"""
+        try:
+            return self._trays[int(tray_number)]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(f"Unknown tray {tray_number}") from None
+
+    def __contains__(self, tray_number):
+        try:
+            return int(tray_number) in self._trays
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return iter(sorted(self._trays.values(), key=lambda tray: tray.number))
+
+    def __len__(self):
+        return len(self._trays)
+
+    def numbers(self):
+        return sorted(self._trays)
+
+    def capacity(self, tray_number):
+        return self.get(tray_number).capacity
+
+
+def load_registry(path=TRAY_CONFIG):
+    """Read the tray list from path, or the two-tray default if it does not exist"""
+    if path and os.path.exists(path):
+        with open(path) as f:
+            trays = json.load(f)
+        log.info("Loaded %s trays from %s", len(trays), path)
+        return TrayRegistry(trays)
+    return TrayRegistry(DEFAULT_TRAYS)
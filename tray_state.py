@@ -0,0 +1,144 @@
+"""
+In-memory snapshot of the tray status shown on every page.
+
+The kiosk reloads /login, /dashboard and /tray_setup constantly, so the
+joined tray_settings/users rows are loaded once and kept with their
+display strings and an epoch deadline already worked out. A page render
+only subtracts the clock from each deadline: no SQL, no date parsing.
+Each tray's schedule is compiled once too, for its description and the
+next few dose times.
+
+Writers keep the snapshot current: the dispense hot path updates a
+tray's count or next time in place, anything else that changes tray rows
+calls invalidate() and the next render reloads. version increases on
+every change, and listeners added with add_listener() are called after it.
+"""
+
+import threading
+import time
+
+from recurrence import load_rule, parse_time
+
+DISPLAY_FORMAT = "%B %d, %Y, %I:%M %p"
+UPCOMING_DOSES = 3
+
+
+def parse_deadline(dispense_time):
+    """(epoch seconds, display string) for a stored dispense time"""
+    if not dispense_time:
+        return None, "N/A"
+    try:
+        dt = parse_time(dispense_time)
+    except (TypeError, ValueError):
+        return None, dispense_time
+    return dt.timestamp(), dt.strftime(DISPLAY_FORMAT)
+
+
+def upcoming_doses(rule, dispense_time, count=UPCOMING_DOSES):
+    """Display strings for the stored next dose and the ones after it"""
+    try:
+        due = parse_time(dispense_time)
+    except (TypeError, ValueError):
+        return []
+    return [dt.strftime(DISPLAY_FORMAT) for dt in [due] + rule.occurrences(due, count - 1)]
+
+
+class TrayStateCache:
+    """Write-through tray status snapshot, reloaded only after invalidate()"""
+
+    def __init__(self, db, capacities=None, clock=time.time):
+        self.db = db
+        self.capacities = capacities or (lambda: {})
+        self.clock = clock
+        self._trays = None  # tray number -> entry, None until loaded
+        self._rules = {}  # tray number -> recurrence rule, kept out of the entries so they stay JSON
+        self._lock = threading.Lock()
+        self.version = 0
+        self.loads = 0
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """listener() runs after every update() or invalidate(), on the writer's thread"""
+        self._listeners.append(listener)
+
+    def _changed(self):
+        for listener in self._listeners:
+            listener()
+
+    def _load(self):
+        rows = self.db.query('''
+            SELECT ts.tray_number, ts.description, ts.dispense_time, ts.dispense_count,
+                   ts.name, u.username, ts.schedule, ts.interval, ts.capacity
+            FROM tray_settings ts
+            LEFT JOIN users u ON ts.user_id = u.id
+        ''')
+        capacities = self.capacities()
+        trays = {}
+        rules = {}
+        for (tray_number, description, dispense_time, dispense_count, name, username,
+             schedule, interval, capacity) in rows:
+            deadline, next_dispense = parse_deadline(dispense_time)
+            try:
+                rule = load_rule(schedule, interval, parse_time(dispense_time))
+            except (TypeError, ValueError):
+                rule = None
+            rules[tray_number] = rule
+            trays[tray_number] = {
+                'tray_number': tray_number,
+                'description': description,
+                'next_dispense': next_dispense,
+                'deadline': deadline,
+                'dispense_count': dispense_count,
+                'capacity': capacity or capacities.get(tray_number),
+                # Use name if available, otherwise fall back to username
+                'username': name if name else username if username else "Unknown",
+                'schedule': rule.describe() if rule else None,
+                'upcoming': upcoming_doses(rule, dispense_time) if rule else [],
+            }
+        self.loads += 1
+        self._rules = rules
+        return trays
+
+    def snapshot(self):
+        """Status of every tray with the countdown in seconds from now"""
+        with self._lock:
+            if self._trays is None:
+                self._trays = self._load()
+            entries = list(self._trays.values())
+        now = self.clock()
+        status = []
+        for entry in entries:
+            tray = dict(entry)
+            deadline = tray.pop('deadline')
+            tray['countdown'] = max(0, int(deadline - now)) if deadline is not None else None
+            status.append(tray)
+        return status
+
+    def update(self, tray_number, **fields):
+        """Write-through for a tray whose row was just changed, e.g. dispense_count or dispense_time"""
+        with self._lock:
+            self.version += 1
+            entry = self._trays.get(tray_number) if self._trays is not None else None
+            if entry is None:
+                # Not loaded yet, or a tray we have not seen: load it with everything else
+                self._trays = None
+            else:
+                if 'dispense_time' in fields:
+                    dispense_time = fields.pop('dispense_time')
+                    entry['deadline'], entry['next_dispense'] = parse_deadline(dispense_time)
+                    rule = self._rules.get(tray_number)
+                    entry['upcoming'] = upcoming_doses(rule, dispense_time) if rule else []
+                entry.update(fields)
+        self._changed()
+
+    def invalidate(self):
+        """Tray rows changed in a way update() does not cover, reload on the next snapshot"""
+        with self._lock:
+            self.version += 1
+            self._trays = None
+        self._changed()
+
+    def stats(self):
+        with self._lock:
+            return {'version': self.version, 'loads': self.loads,
+                    'trays': len(self._trays) if self._trays is not None else None}
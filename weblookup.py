@@ -1,49 +1,113 @@
 import requests
 import re
-from gtts import gTTS
+import logging
 import os
-import time
+import sys
+import sqlite3
 
-def fetch_fda_instruction(brand_name):
+from label_cache import LabelCache, FOUND, NOT_FOUND, ERROR
+from audio_cache import AudioCache
+from text_to_speech import create_synthesizer
+from audio_player import AudioPlayer, REMINDER
+
+log = logging.getLogger(__name__)
+
+FDA_TIMEOUT = float(os.getenv('FDA_TIMEOUT', 5))
+
+label_cache = LabelCache()
+audio_cache = AudioCache()
+speech = create_synthesizer()
+audio_player = AudioPlayer()
+
+def query_fda_label(brand_name):
+    """Query api.fda.gov, returns (status, directions) for the label cache"""
     url = f"https://api.fda.gov/drug/label.json?search=openfda.brand_name:{brand_name}&limit=1"
     try:
-        response = requests.get(url)
+        response = requests.get(url, timeout=FDA_TIMEOUT)
         if response.status_code == 200:
             data = response.json()
             try:
                 directions = data['results'][0].get('dosage_and_administration', ["No directions found"])[0]
-                return directions
+                return FOUND, directions
             except (KeyError, IndexError):
-                return "No instruction available"
+                return NOT_FOUND, "No instruction available"
+        elif response.status_code == 404:
+            return NOT_FOUND, "API error or medicine not found"
         else:
-            return "API error or medicine not found"
+            return ERROR, "API error or medicine not found"
     except Exception as e:
-        return f"Error fetching instructions: {e}"
+        return ERROR, f"Error fetching instructions: {e}"
+
+def fetch_fda_instruction(brand_name):
+    return label_cache.get(brand_name, query_fda_label)
 
 def clean_directions(text):
     # Remove repeated 'Directions' or similar at the start
     cleaned = re.sub(r'^(Directions\s*)+', '', text, flags=re.IGNORECASE).strip()
     return cleaned
 
-def get_directions_and_speak(brand_name, tray_number=None):
+def get_directions(brand_name):
     directions = fetch_fda_instruction(brand_name)
-    cleaned = clean_directions(directions)
+    return clean_directions(directions)
+
+def dispense_message(tray_number, brand_name):
+    return f"Tray {tray_number}: {brand_name} was dispensed. Please take your medicine now."
+
+def render_speech(text):
+    """Return an audio file for text, synthesizing it only on a cache miss"""
+    path, engine = speech.render(text, audio_cache)
+    return path
+
+def play_speech(text, **kwargs):
+    """Queue text on the playback worker, returns without waiting for audio"""
+    return audio_player.say(render_speech(text), **kwargs)
+
+def speak_directions(cleaned, brand_name, tray_number=None):
     try:
         # Speak directions
-        tts = gTTS(text=cleaned, lang='en', slow=False)
-        tts.save("speak.mp3")
-        os.system("mpg123 speak.mp3")
-        os.remove("speak.mp3")
-        time.sleep(3)  # <-- Add this line
-        # Speak tray/medicine message 3 times with 10s delay
+        directions = play_speech(cleaned)
+        # Speak tray/medicine message 3 times, 3s after the directions and 10s apart
         if tray_number is not None:
-            message = f"Tray {tray_number}: {brand_name} was dispensed. Please take your medicine now."
-            for _ in range(3):
-                tts = gTTS(text=message, lang='en', slow=False)
-                tts.save("speak.mp3")
-                os.system("mpg123 speak.mp3")
-                os.remove("speak.mp3")
-                time.sleep(10)
+            message = dispense_message(tray_number, brand_name)
+            play_speech(message, priority=REMINDER, repeat=3, gap=10, delay=3, after=directions)
     except Exception as e:
         cleaned += f"\n(TTS error: {e})"
     return cleaned
+
+def get_directions_and_speak(brand_name, tray_number=None):
+    cleaned = get_directions(brand_name)
+    return speak_directions(cleaned, brand_name, tray_number)
+
+def warm_label_cache(database='users.db'):
+    """Pre-fetch FDA labels for every medicine configured in tray_settings"""
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT description FROM tray_settings')
+    descriptions = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    # Lookups use the first word of the description, same as dispensing does
+    brand_names = [d.split()[0] for d in descriptions if d and d.split()]
+    fetched = label_cache.warm(brand_names, query_fda_label)
+    log.info("Label cache warmed: %s label(s) fetched", fetched)
+    return fetched
+
+def prerender_tray_audio(tray_number, description):
+    """Synthesize the announcements for a tray ahead of its first dispense"""
+    if not description or not description.split():
+        return
+    brand_name = description.split()[0]
+    try:
+        render_speech(dispense_message(tray_number, brand_name))
+        render_speech(get_directions(brand_name))
+    except Exception as e:
+        log.error("Error pre-rendering audio for Tray %s: %s", tray_number, e)
+
+
+if __name__ == '__main__':
+    # Usage: python weblookup.py warm [users.db]
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm':
+        from log_config import setup_logging
+        setup_logging(log_file='')
+        warm_label_cache(sys.argv[2] if len(sys.argv) > 2 else 'users.db')
+    else:
+        print("Usage: python weblookup.py warm [database]")